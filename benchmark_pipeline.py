@@ -0,0 +1,832 @@
+
+import argparse
+import base64
+import contextlib
+import importlib.util
+import io
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import final_project_drafting as pipeline
+
+
+# Offline stand-in for the Google Text Search, Nearby Search and Geocoding APIs
+# and the Yelp Business Search API. Payloads are generated from the query, so
+# the same search always returns the same restaurants. About
+# STUB_SHARED_FRACTION of the Yelp businesses are the same restaurant as the
+# Google place at that index, so cross-provider matching has real work to do.
+# Area searches (Nearby Search, Yelp by latitude/longitude) draw on a fixed map
+# with STUB_SETTINGS["restaurants_per_cell"] restaurants in every
+# STUB_CELL_DEGREES square, and every geocoded city is a
+# STUB_SETTINGS["city_span_degrees"] square of that map.
+GOOGLE_STUB_PATH = "/maps/api/place/textsearch/json"
+GOOGLE_NEARBY_STUB_PATH = "/maps/api/place/nearbysearch/json"
+GOOGLE_GEOCODE_STUB_PATH = "/maps/api/geocode/json"
+YELP_STUB_PATH = "/v3/businesses/search"
+STUB_SETTINGS = {"google_page_size": 20, "google_pages": 3, "yelp_total": 240, "latency_seconds": 0.0,
+                 "restaurants_per_cell": 6, "city_span_degrees": 0.08}
+STUB_CELL_DEGREES = 0.01
+STUB_METERS_PER_DEGREE = 111320.0
+STUB_SHARED_FRACTION = 0.6
+STUB_NAME_WORDS = ["Blue", "Golden", "Red", "Little", "Old", "Lucky", "Green", "Royal", "Happy", "Silver"]
+STUB_NAME_KINDS = ["Dragon", "Garden", "Kitchen", "Grill", "Bistro", "Diner", "Taqueria", "Noodle House", "Cafe", "Pizzeria"]
+STUB_STREETS = ["Main", "State", "Liberty", "Washington", "Huron", "Division", "Packard", "Maple", "Oak", "Fifth"]
+STUB_SUFFIXES = ["St", "Street", "Ave", "Avenue", "Rd", "Blvd"]
+
+# Benchmark defaults. Businesses are spread over synthetic cities of
+# BENCHMARK_CITY_SIZE businesses per provider each.
+BENCHMARK_SIZES = [1000, 10000, 100000]
+BENCHMARK_CITY_SIZE = 1000
+BENCHMARK_FETCH_CITIES = 20
+BENCHMARK_TILED_CITIES = 2
+BENCHMARK_CACHE_ENTRIES = 5000
+BENCHMARK_QUERY_ITERATIONS = 200
+BENCHMARK_RENDER_ITERATIONS = 5
+BENCHMARK_TOLERANCE = 0.25
+
+
+def make_restaurant(search_term, index):
+    """
+    Generates the name and street address of a synthetic restaurant.
+
+    Parameters
+    ----------
+    search_term: str
+        The "city, state" search term.
+    index: int
+        The restaurant's position in the city.
+
+    Returns
+    -------
+    tuple
+        The name, house number and street name.
+    """
+    rnd = random.Random(f"{search_term}|{index}")
+    name = f"{rnd.choice(STUB_NAME_WORDS)} {rnd.choice(STUB_NAME_KINDS)} {index}"
+    return name, rnd.randint(1, 9999), rnd.choice(STUB_STREETS)
+
+
+def make_google_place(search_term, index):
+    """
+    Generates one Google Text Search result.
+
+    Parameters
+    ----------
+    search_term: str
+        The "city, state" search term.
+    index: int
+        The restaurant's position in the city.
+
+    Returns
+    -------
+    dict
+        The place, shaped like the Google response.
+    """
+    name, number, street = make_restaurant(search_term, index)
+    rnd = random.Random(f"{search_term}|google|{index}")
+    place = {"place_id": f"stub-google-{zlib.crc32(search_term.encode())}-{index}", "name": name,
+             "formatted_address": f"{number} {street} {rnd.choice(STUB_SUFFIXES)}, {search_term.title()}",
+             "rating": round(rnd.uniform(1, 5), 1), "user_ratings_total": rnd.randint(0, 5000)}
+    if rnd.random() < 0.9:
+        place["price_level"] = rnd.randint(0, 4)
+    return place
+
+
+def make_yelp_business(search_term, index):
+    """
+    Generates one Yelp Business Search result, which is the same
+    restaurant as the Google place at that index for about
+    STUB_SHARED_FRACTION of the indexes.
+
+    Parameters
+    ----------
+    search_term: str
+        The "city, state" search term.
+    index: int
+        The business's position in the city.
+
+    Returns
+    -------
+    dict
+        The business, shaped like the Yelp response.
+    """
+    shared = random.Random(f"{search_term}|shared|{index}").random() < STUB_SHARED_FRACTION
+    name, number, street = make_restaurant(search_term if shared else f"{search_term} (yelp)", index)
+    rnd = random.Random(f"{search_term}|yelp|{index}")
+    business = {"id": f"stub-yelp-{zlib.crc32(search_term.encode())}-{index}", "alias": name.lower().replace(" ", "-"),
+                "name": name, "rating": rnd.choice([1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0]),
+                "review_count": rnd.randint(0, 3000), "phone": "+15555550100",
+                "location": {"display_address": [f"{number} {street} {rnd.choice(STUB_SUFFIXES)}", search_term.title()]}}
+    if rnd.random() < 0.9:
+        business["price"] = "$" * rnd.randint(1, 4)
+    return business
+
+
+def make_city_bounds(search_term):
+    """
+    Places a city on the stub map.
+
+    Parameters
+    ----------
+    search_term: str
+        The "city, state" address.
+
+    Returns
+    -------
+    tuple
+        The (south, west, north, east) bounds, in degrees.
+    """
+    rnd = random.Random(f"{search_term}|geocode")
+    south, west = rnd.uniform(30, 45), rnd.uniform(-120, -75)
+    span = STUB_SETTINGS["city_span_degrees"]
+    return south, west, south + span, west + span
+
+
+def find_restaurants_near(latitude, longitude, radius):
+    """
+    Lists the stub map's restaurants within a circle, nearest first.
+
+    Parameters
+    ----------
+    latitude: float
+        The center's latitude.
+    longitude: float
+        The center's longitude.
+    radius: float
+        The radius in meters.
+
+    Returns
+    -------
+    list
+        (cell name, index in the cell, latitude, longitude) for
+        every restaurant in the circle.
+    """
+    latitude_reach = radius / STUB_METERS_PER_DEGREE
+    longitude_reach = radius / (STUB_METERS_PER_DEGREE * math.cos(math.radians(latitude)))
+    found = []
+    for row in range(math.floor((latitude - latitude_reach) / STUB_CELL_DEGREES),
+                     math.floor((latitude + latitude_reach) / STUB_CELL_DEGREES) + 1):
+        for column in range(math.floor((longitude - longitude_reach) / STUB_CELL_DEGREES),
+                            math.floor((longitude + longitude_reach) / STUB_CELL_DEGREES) + 1):
+            cell = f"cell {row} {column}"
+            for index in range(STUB_SETTINGS["restaurants_per_cell"]):
+                rnd = random.Random(f"{cell}|{index}")
+                place_latitude = (row + rnd.random()) * STUB_CELL_DEGREES
+                place_longitude = (column + rnd.random()) * STUB_CELL_DEGREES
+                distance = math.hypot((place_latitude - latitude) / latitude_reach,
+                                      (place_longitude - longitude) / longitude_reach)
+                if distance <= 1:
+                    found.append((distance, cell, index, place_latitude, place_longitude))
+    return [restaurant[1:] for restaurant in sorted(found)]
+
+
+def build_geocode_response(params):
+    """
+    Builds a Google Geocoding response for the address parameter.
+
+    Parameters
+    ----------
+    params: dict
+        The request's query parameters.
+
+    Returns
+    -------
+    dict
+        The response, with the city's bounds.
+    """
+    south, west, north, east = make_city_bounds(params.get("address", ""))
+    geometry = {"bounds": {"southwest": {"lat": south, "lng": west}, "northeast": {"lat": north, "lng": east}},
+                "location": {"lat": (south + north) / 2, "lng": (west + east) / 2}}
+    return {"status": "OK", "results": [{"geometry": geometry}]}
+
+
+def build_google_page(params):
+    """
+    Builds a Google Text Search or Nearby Search response page,
+    following the pagetoken parameter.
+
+    Parameters
+    ----------
+    params: dict
+        The request's query parameters.
+
+    Returns
+    -------
+    dict
+        The response page, with a next_page_token unless it is the
+        last page.
+    """
+    if "pagetoken" in params:
+        page, search_term = base64.urlsafe_b64decode(params["pagetoken"]).decode().split("|", 1)
+        page = int(page)
+    elif "location" in params:
+        page, search_term = 0, f"@{params['location']},{params.get('radius', 0)}"
+    else:
+        page, search_term = 0, params.get("query", "")
+
+    page_size = STUB_SETTINGS["google_page_size"]
+    indexes = range(page * page_size, (page + 1) * page_size)
+    if search_term.startswith("@"):
+        latitude, longitude, radius = [float(value) for value in search_term[1:].split(",")]
+        nearby = find_restaurants_near(latitude, longitude, radius)
+        results = []
+        for cell, index, place_latitude, place_longitude in nearby[indexes.start:indexes.stop]:
+            place = make_google_place(cell, index)
+            place["vicinity"] = place.pop("formatted_address")
+            place["geometry"] = {"location": {"lat": place_latitude, "lng": place_longitude}}
+            results.append(place)
+        has_next_page = len(nearby) > indexes.stop
+    else:
+        results = [make_google_place(search_term, index) for index in indexes]
+        has_next_page = True
+
+    google_data = {"status": "OK" if results else "ZERO_RESULTS", "results": results, "html_attributions": []}
+    if has_next_page and page + 1 < STUB_SETTINGS["google_pages"]:
+        google_data["next_page_token"] = base64.urlsafe_b64encode(f"{page + 1}|{search_term}".encode()).decode()
+    return google_data
+
+
+def build_yelp_page(params):
+    """
+    Builds a Yelp Business Search response page for the offset and
+    limit parameters, searching a location or, given latitude,
+    longitude and radius, an area of the stub map.
+
+    Parameters
+    ----------
+    params: dict
+        The request's query parameters.
+
+    Returns
+    -------
+    dict
+        The response page with the total number of businesses.
+    """
+    offset = int(params.get("offset", 0))
+    limit = int(params.get("limit", 20))
+    if "latitude" in params:
+        nearby = find_restaurants_near(float(params["latitude"]), float(params["longitude"]), float(params.get("radius", 0)))
+        businesses = []
+        for cell, index, latitude, longitude in nearby[offset:offset + limit]:
+            business = make_yelp_business(cell, index)
+            business["coordinates"] = {"latitude": latitude, "longitude": longitude}
+            businesses.append(business)
+        return {"total": len(nearby), "businesses": businesses}
+
+    search_term = params.get("location", "")
+    last = min(offset + limit, STUB_SETTINGS["yelp_total"])
+    return {"total": STUB_SETTINGS["yelp_total"],
+            "businesses": [make_yelp_business(search_term, index) for index in range(offset, last)]}
+
+
+class StubApiHandler(BaseHTTPRequestHandler):
+    """
+    Answers Google and Yelp search and Google geocoding requests
+    with synthetic payloads, after STUB_SETTINGS["latency_seconds"]
+    of simulated latency.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        time.sleep(STUB_SETTINGS["latency_seconds"])
+
+        if url.path in (GOOGLE_STUB_PATH, GOOGLE_NEARBY_STUB_PATH):
+            status, payload = 200, build_google_page(params)
+        elif url.path == GOOGLE_GEOCODE_STUB_PATH:
+            status, payload = 200, build_geocode_response(params)
+        elif url.path == YELP_STUB_PATH:
+            status, payload = 200, build_yelp_page(params)
+        else:
+            status, payload = 404, {"error": {"code": "NOT_FOUND", "description": url.path}}
+
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(host="127.0.0.1", port=0):
+    """
+    Starts the stub API server on a background thread.
+
+    Parameters
+    ----------
+    host: str
+        The address to listen on.
+    port: int
+        The port to listen on. 0 picks a free port.
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        The running server.
+    """
+    server = ThreadingHTTPServer((host, port), StubApiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def use_stub_apis(server):
+    """
+    Points the pipeline at the stub server: base URLs, placeholder
+    API keys (so no real key files are needed or sent), no wait
+    before Google page tokens and no client-side rate limiting.
+
+    Parameters
+    ----------
+    server: ThreadingHTTPServer
+        The running stub server.
+
+    Returns
+    -------
+    None
+    """
+    host, port = server.server_address[:2]
+    pipeline.google_baseurl = f"http://{host}:{port}{GOOGLE_STUB_PATH}?"
+    pipeline.google_nearby_baseurl = f"http://{host}:{port}{GOOGLE_NEARBY_STUB_PATH}"
+    pipeline.google_geocode_baseurl = f"http://{host}:{port}{GOOGLE_GEOCODE_STUB_PATH}"
+    pipeline.yelp_baseurl = f"http://{host}:{port}{YELP_STUB_PATH}"
+    pipeline.GOOGLE_PAGE_TOKEN_DELAY_SECONDS = 0.0
+    for provider in pipeline.RATE_LIMITS:
+        pipeline.RATE_LIMITS[provider] = {"requests_per_second": 1e9, "burst": 1e9}
+
+    google_secrets = types.ModuleType("google_secrets")
+    google_secrets.google_api_key = "offline-benchmark"
+    yelp_secrets = types.ModuleType("yelp_secrets")
+    yelp_secrets.yelp_client_id = "offline-benchmark"
+    yelp_secrets.yelp_api_key = "offline-benchmark"
+    sys.modules["google_secrets"] = google_secrets
+    sys.modules["yelp_secrets"] = yelp_secrets
+
+
+def use_database(file_name):
+    """
+    Switches the pipeline to a fresh harvest database file and
+    creates its tables.
+
+    Parameters
+    ----------
+    file_name: str
+        The database path.
+
+    Returns
+    -------
+    None
+    """
+    if pipeline.conn is not None:
+        pipeline.conn.close()
+        pipeline.conn = None
+    pipeline.DATABASE_FILE_NAME = file_name
+    pipeline.create_tables()
+
+
+def summarize_timings(stage, size, timings, items_per_operation=1):
+    """
+    Turns a list of per-operation timings into one benchmark result.
+
+    Parameters
+    ----------
+    stage: str
+        The benchmark name.
+    size: int
+        The number of businesses per provider in the database.
+    timings: list
+        The seconds taken by each operation.
+    items_per_operation: int
+        The items (rows, lookups...) handled by each operation, for
+        the throughput.
+
+    Returns
+    -------
+    dict
+        "stage", "size", "operations", "seconds", "items_per_second",
+        and the "p50_ms"/"p95_ms"/"max_ms" operation latencies.
+    """
+    ordered = sorted(timings)
+    total = sum(timings)
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    return {"stage": stage, "size": size, "operations": len(timings), "seconds": total,
+            "items_per_second": len(timings) * items_per_operation / total if total > 0 else float("inf"),
+            "p50_ms": percentile(0.5), "p95_ms": percentile(0.95), "max_ms": ordered[-1] * 1000}
+
+
+def time_call(function, *args):
+    """
+    Runs a function with its console output discarded.
+
+    Parameters
+    ----------
+    function: callable
+        The function to time.
+    *args
+        Its arguments.
+
+    Returns
+    -------
+    tuple
+        The seconds taken and the function's return value.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = function(*args)
+        return time.perf_counter() - start, result
+
+
+def benchmark_fetch(city_count):
+    """
+    Harvests city_count cities from the stub APIs with every page,
+    then again from the in-memory cache, then from the cache
+    database alone.
+
+    Parameters
+    ----------
+    city_count: int
+        The number of cities to fetch.
+
+    Returns
+    -------
+    list
+        The fetch_cold, fetch_memory_cache and fetch_disk_cache
+        results.
+    """
+    search_terms = [f"stub city {index}, michigan" for index in range(city_count)]
+    results = []
+    for stage in ["fetch_cold", "fetch_memory_cache", "fetch_disk_cache"]:
+        if stage == "fetch_disk_cache":
+            with contextlib.redirect_stdout(io.StringIO()):
+                pipeline.flush_cache_writes()
+            for memory_cache in pipeline.MEMORY_CACHES.values():
+                memory_cache.clear()
+        timings = [time_call(pipeline.fetch_city_data, search_term, True)[0] for search_term in search_terms]
+        results.append(summarize_timings(stage, 0, timings))
+    return results
+
+
+def benchmark_tiled_fetch(city_count):
+    """
+    Harvests city_count whole cities tile by tile from the stub
+    APIs (geocoding, Nearby Search and Yelp area searches,
+    splitting the crowded tiles), then again from the cache.
+
+    Parameters
+    ----------
+    city_count: int
+        The number of cities to harvest.
+
+    Returns
+    -------
+    list
+        The fetch_tiled_cold and fetch_tiled_cache results, counting
+        the restaurants found per second.
+    """
+    search_terms = [f"stub tiled city {index}, michigan" for index in range(city_count)]
+    results = []
+    for stage in ["fetch_tiled_cold", "fetch_tiled_cache"]:
+        timings = []
+        restaurants = 0
+        for search_term in search_terms:
+            seconds, (google_data, yelp_data) = time_call(pipeline.fetch_city_data, search_term, True, True)
+            timings.append(seconds)
+            restaurants += len(google_data["results"]) + len(yelp_data["businesses"])
+        results.append(summarize_timings(stage, 0, timings, restaurants / len(search_terms)))
+    return results
+
+
+def benchmark_cache_lookups(entry_count):
+    """
+    Measures lookup_cache for entry_count stored responses, from
+    memory and from the cache database.
+
+    Parameters
+    ----------
+    entry_count: int
+        The number of responses to store and look up.
+
+    Returns
+    -------
+    list
+        The cache_store, cache_lookup_memory and cache_lookup_disk
+        results.
+    """
+    response = build_yelp_page({"location": "cache benchmark", "limit": 50})
+    keys = [f"BENCHMARK---{index}" for index in range(entry_count)]
+
+    def store_all():
+        for key in keys:
+            pipeline.store_cache("yelp", key, response)
+        pipeline.flush_cache_writes()
+
+    store_seconds, _ = time_call(store_all)
+    results = [summarize_timings("cache_store", 0, [store_seconds], entry_count)]
+
+    random.Random(0).shuffle(keys)
+    memory_seconds, _ = time_call(lambda: [pipeline.lookup_cache("yelp", key) for key in keys])
+    pipeline.MEMORY_CACHES["yelp"].clear()
+    disk_timings = [time_call(pipeline.lookup_cache, "yelp", key)[0] for key in keys]
+    pipeline.MEMORY_CACHES["yelp"].clear()
+    results.append(summarize_timings("cache_lookup_memory", 0, [memory_seconds], entry_count))
+    results.append(summarize_timings("cache_lookup_disk", 0, disk_timings))
+    return results
+
+
+def benchmark_ingest(size):
+    """
+    Ingests size synthetic businesses per provider, one city of
+    BENCHMARK_CITY_SIZE at a time, and matches each city.
+
+    Parameters
+    ----------
+    size: int
+        The number of businesses per provider.
+
+    Returns
+    -------
+    tuple
+        The ingest and match results, and the list of cities stored.
+    """
+    city_pairs = [(f"bench city {index}", "michigan") for index in range(max(1, size // BENCHMARK_CITY_SIZE))]
+    city_size = min(size, BENCHMARK_CITY_SIZE)
+    ingest_timings = []
+    match_timings = []
+    for city, state in city_pairs:
+        search_term = f"{city}, {state}"
+        google_data = {"results": [make_google_place(search_term, index) for index in range(city_size)]}
+        yelp_data = {"businesses": [make_yelp_business(search_term, index) for index in range(city_size)]}
+        ingest_timings.append(time_call(pipeline.ingest_city_data, google_data, yelp_data, city, state)[0])
+        match_timings.append(time_call(pipeline.match_city_businesses, city, state)[0])
+    return [summarize_timings("ingest", size, ingest_timings, 2 * city_size),
+            summarize_timings("match", size, match_timings, 2 * city_size)], city_pairs
+
+
+def benchmark_queries(size, city_pairs, iterations):
+    """
+    Times the price level aggregate (rollup) and statistics
+    (NumPy) queries for random cities and for every city at once.
+
+    Parameters
+    ----------
+    size: int
+        The number of businesses per provider in the database.
+    city_pairs: list
+        The cities stored.
+    iterations: int
+        The number of per-city queries of each kind. 0 skips the
+        per-city queries.
+
+    Returns
+    -------
+    list
+        The aggregate_city, aggregate_all, statistics_city and
+        statistics_all results.
+    """
+    rnd = random.Random(size)
+    views = [(provider, metric) for provider in pipeline.AGGREGATE_SOURCES for metric in pipeline.ROLLUP_COLUMNS]
+    picks = [(rnd.choice(city_pairs), rnd.choice(views)) for _ in range(iterations)]
+
+    aggregate_city = [time_call(pipeline.aggregate_by_price_level, provider, metric, city, state)[0]
+                      for (city, state), (provider, metric) in picks]
+    aggregate_all = [time_call(pipeline.aggregate_by_price_level, provider, metric)[0] for provider, metric in views]
+    statistics_city = [time_call(pipeline.compute_price_level_statistics, provider, city, state)[0]
+                       for (city, state), (provider, _) in picks[:max(1, iterations // 10)]]
+    statistics_all = [time_call(pipeline.compute_price_level_statistics, provider)[0] for provider in pipeline.AGGREGATE_SOURCES]
+    stages = [("aggregate_city", aggregate_city), ("aggregate_all", aggregate_all),
+              ("statistics_city", statistics_city), ("statistics_all", statistics_all)]
+    return [summarize_timings(stage, size, timings) for stage, timings in stages if timings]
+
+
+def benchmark_render(size, city_pairs, iterations, output_directory):
+    """
+    Times building a one-city dashboard figure and exporting it to
+    static HTML. Skipped when plotly is not installed.
+
+    Parameters
+    ----------
+    size: int
+        The number of businesses per provider in the database.
+    city_pairs: list
+        The cities stored.
+    iterations: int
+        The number of dashboards to build and export.
+    output_directory: str
+        Where to write the HTML files.
+
+    Returns
+    -------
+    list
+        The render_figure and render_export results, or nothing
+        when plotly is missing.
+    """
+    if importlib.util.find_spec("plotly") is None:
+        print("\nplotly is not installed, skipping the render benchmarks\n")
+        return []
+
+    figure_timings = [time_call(pipeline.build_dashboard_figure, [city_pair])[0] for city_pair in city_pairs[:iterations]]
+    export_timings = [time_call(pipeline.export_dashboards, [city_pair], output_directory)[0] for city_pair in city_pairs[:iterations]]
+    return [summarize_timings("render_figure", size, figure_timings),
+            summarize_timings("render_export", size, export_timings)]
+
+
+def compare_to_baseline(results, baseline_results, tolerance):
+    """
+    Finds the benchmarks whose throughput fell by more than
+    tolerance compared with a saved run.
+
+    Parameters
+    ----------
+    results: list
+        This run's results.
+    baseline_results: list
+        The saved run's results.
+    tolerance: float
+        The allowed slowdown, e.g. 0.25 for 25%.
+
+    Returns
+    -------
+    list
+        (stage, size, baseline items/s, current items/s) for every
+        regression.
+    """
+    baseline = {(result["stage"], result["size"]): result["items_per_second"] for result in baseline_results}
+    regressions = []
+    for result in results:
+        previous = baseline.get((result["stage"], result["size"]))
+        if previous and result["items_per_second"] < previous * (1 - tolerance):
+            regressions.append((result["stage"], result["size"], previous, result["items_per_second"]))
+    return regressions
+
+
+def print_results(results):
+    """
+    Prints the benchmark results as a table.
+
+    Parameters
+    ----------
+    results: list
+        The benchmark results.
+
+    Returns
+    -------
+    None
+    """
+    print(f"\n{'stage':<20} {'size':>8} {'ops':>6} {'items/s':>12} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+    for result in results:
+        print(f"{result['stage']:<20} {result['size']:>8} {result['operations']:>6} {result['items_per_second']:>12.1f} "
+              f"{result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['max_ms']:>9.2f}")
+    print()
+
+
+def run_benchmarks(sizes, fetch_cities, cache_entries, query_iterations, render_iterations, tiled_cities=BENCHMARK_TILED_CITIES):
+    """
+    Runs the whole suite in a temporary directory against the stub
+    APIs: fetch, tiled fetch and cache once, then ingest, matching,
+    queries and rendering on a fresh database for every size.
+
+    Parameters
+    ----------
+    sizes: list
+        The numbers of businesses per provider to benchmark.
+    fetch_cities: int
+        The number of cities fetched from the stub APIs.
+    cache_entries: int
+        The number of responses in the cache benchmark.
+    query_iterations: int
+        The number of per-city aggregate queries per size.
+    render_iterations: int
+        The number of dashboards rendered per size.
+    tiled_cities: int
+        The number of whole cities harvested tile by tile.
+
+    Any count of 0 skips its benchmarks.
+
+    Returns
+    -------
+    list
+        Every benchmark result.
+    """
+    server = start_stub_server()
+    use_stub_apis(server)
+    results = []
+    original_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_directory:
+        os.chdir(work_directory)
+        try:
+            pipeline.CACHE_DB_FILE_NAME = os.path.join(work_directory, "api_cache.sqlite")
+            use_database(os.path.join(work_directory, "fetch.sqlite"))
+
+            print()
+            if fetch_cities > 0:
+                print(f"Fetching {fetch_cities} cities from the stub APIs...")
+                results.extend(benchmark_fetch(fetch_cities))
+            if tiled_cities > 0:
+                print(f"Harvesting {tiled_cities} whole cities tile by tile from the stub APIs...")
+                results.extend(benchmark_tiled_fetch(tiled_cities))
+            if cache_entries > 0:
+                print(f"Storing and looking up {cache_entries} cache entries...")
+                results.extend(benchmark_cache_lookups(cache_entries))
+
+            for size in sizes:
+                print(f"Benchmarking {size} businesses per provider...")
+                use_database(os.path.join(work_directory, f"harvest_{size}.sqlite"))
+                ingest_results, city_pairs = benchmark_ingest(size)
+                results.extend(ingest_results)
+                results.extend(benchmark_queries(size, city_pairs, query_iterations))
+                if render_iterations > 0:
+                    results.extend(benchmark_render(size, city_pairs, render_iterations, os.path.join(work_directory, "dashboards")))
+        finally:
+            # Close both databases before the directory goes, so nothing is
+            # left to flush into it when the program exits.
+            if pipeline.conn is not None:
+                pipeline.conn.close()
+                pipeline.conn = None
+            if pipeline.cache_conn is not None:
+                pipeline.flush_cache_writes()
+                pipeline.cache_conn.close()
+                pipeline.cache_conn = None
+                pipeline.cache_store_ready = False
+            os.chdir(original_directory)
+    server.shutdown()
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the harvest pipeline offline against stub Google and Yelp APIs.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    stub_parser = subparsers.add_parser("stub", help="only run the stub API server")
+    stub_parser.add_argument("--host", default="127.0.0.1")
+    stub_parser.add_argument("--port", type=int, default=8600)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmark suite (the default)")
+    run_parser.add_argument("--sizes", default=",".join(str(size) for size in BENCHMARK_SIZES),
+                            help="comma-separated businesses per provider, e.g. 1000,1000000")
+    run_parser.add_argument("--fetch-cities", type=int, default=BENCHMARK_FETCH_CITIES, help="cities fetched page by page (0 to skip)")
+    run_parser.add_argument("--tiled-cities", type=int, default=BENCHMARK_TILED_CITIES,
+                            help="whole cities harvested tile by tile (0 to skip)")
+    run_parser.add_argument("--cache-entries", type=int, default=BENCHMARK_CACHE_ENTRIES, help="responses stored and looked up (0 to skip)")
+    run_parser.add_argument("--query-iterations", type=int, default=BENCHMARK_QUERY_ITERATIONS, help="per-city queries per size (0 to skip)")
+    run_parser.add_argument("--render-iterations", type=int, default=BENCHMARK_RENDER_ITERATIONS, help="dashboards rendered per size (0 to skip)")
+    run_parser.add_argument("--json", metavar="FILE", help="save the results to FILE")
+    run_parser.add_argument("--baseline", metavar="FILE", help="fail if throughput dropped compared with a saved --json run")
+    run_parser.add_argument("--tolerance", type=float, default=BENCHMARK_TOLERANCE, help="allowed slowdown against --baseline")
+
+    for command_parser in [stub_parser, run_parser]:
+        command_parser.add_argument("--google-pages", type=int, default=STUB_SETTINGS["google_pages"], help="Google result pages per search")
+        command_parser.add_argument("--google-page-size", type=int, default=STUB_SETTINGS["google_page_size"])
+        command_parser.add_argument("--yelp-total", type=int, default=STUB_SETTINGS["yelp_total"], help="Yelp businesses per search")
+        command_parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated latency of every API response")
+        command_parser.add_argument("--restaurants-per-cell", type=int, default=STUB_SETTINGS["restaurants_per_cell"],
+                                    help=f"restaurants in every {STUB_CELL_DEGREES} degree square of the area search map")
+
+    args = parser.parse_args(sys.argv[1:] or ["run"])
+
+    STUB_SETTINGS.update({"google_pages": args.google_pages, "google_page_size": args.google_page_size,
+                          "yelp_total": args.yelp_total, "latency_seconds": args.latency_ms / 1000,
+                          "restaurants_per_cell": args.restaurants_per_cell})
+
+    if args.command == "stub":
+        server = ThreadingHTTPServer((args.host, args.port), StubApiHandler)
+        print(f"\nStub APIs on http://{args.host}:{args.port}{GOOGLE_STUB_PATH}, {GOOGLE_NEARBY_STUB_PATH}, "
+              f"{GOOGLE_GEOCODE_STUB_PATH} and {YELP_STUB_PATH} (Ctrl-C to stop)\n")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        quit()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    results = run_benchmarks(sizes, args.fetch_cities, args.cache_entries, args.query_iterations, args.render_iterations,
+                             args.tiled_cities)
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            regressions = compare_to_baseline(results, json.load(baseline_file), args.tolerance)
+        for stage, size, previous, current in regressions:
+            print(f"[Regression] {stage} at size {size}: {previous:.1f} -> {current:.1f} items/s")
+        if regressions:
+            sys.exit(1)
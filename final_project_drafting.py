@@ -1,10 +1,33 @@
 
-import requests
+import argparse
+import ast
+import atexit
+import csv
+import functools
+import hashlib
+import importlib
 import json
+import math
+import os
+import queue
+import random
+import re
 import sqlite3
-import plotly.graph_objects as go
-import google_secrets
-import yelp_secrets
+import sys
+import unicodedata
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from difflib import SequenceMatcher
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qsl, urlsplit
+# asyncio, requests, numpy, plotly and the google_secrets/yelp_secrets key files are
+# imported inside the functions that use them, so commands that never call
+# an API or draw a chart start without loading them.
 
 
 states = ['alaska', 'alabama', 'arkansas', 'arizona', 'california', 'colorado', 
@@ -19,326 +42,5064 @@ states = ['alaska', 'alabama', 'arkansas', 'arizona', 'california', 'colorado',
 
 
 GOOGLE_CACHE_FILE_NAME = 'google_cache.json'
-GOOGLE_CACHE_DICT = {}
+GOOGLE_CACHE_DICT = OrderedDict()
 
 YELP_CACHE_FILE_NAME = 'yelp_cache.json'
-YELP_CACHE_DICT = {}
+YELP_CACHE_DICT = OrderedDict()
+
+# In-memory tier in front of the cache database: unique_key -> [response, created_at]
+MEMORY_CACHES = {"google": GOOGLE_CACHE_DICT, "yelp": YELP_CACHE_DICT}
+MEMORY_CACHE_MAX_ENTRIES = 500
+
+CACHE_DB_FILE_NAME = 'api_cache.sqlite'
+cache_conn = None
+cache_cur = None
+cache_lock = threading.RLock()
+cache_store_ready = False
+last_cache_entry_id = 0
+
+# Hashes of the records this process knows are in Api_Cache_Record, so a record
+# repeated across responses is only compressed and inserted once. Forgotten
+# whenever unreferenced records are swept.
+stored_cache_record_hashes = set()
+STORED_CACHE_RECORD_HASHES_MAX = 200000
+
+# How responses are stored in the cache database. "records" keeps each business
+# record once, under a hash of its content, in Api_Cache_Record; the rest of the
+# response and the record hashes go in Api_Cache. "json" stores each response
+# verbatim, as older versions did. CACHE_COMPRESSION is None, "zlib" or "lzma".
+# With CACHE_STRIP_FIELDS, records keep only CACHE_KEPT_FIELDS (a nested field
+# lists the subfields kept), i.e. what ingest and matching read.
+CACHE_FORMAT = "records"
+CACHE_COMPRESSION = "zlib"
+CACHE_STRIP_FIELDS = True
+CACHE_RECORD_LISTS = {"google": "results", "yelp": "businesses"}
+CACHE_KEPT_FIELDS = {
+    "google": {"place_id": None, "name": None, "formatted_address": None, "vicinity": None, "rating": None,
+               "user_ratings_total": None, "price_level": None, "geometry": ["location", "viewport", "bounds"]},
+    "yelp": {"id": None, "alias": None, "name": None, "location": ["display_address"], "phone": None,
+             "rating": None, "review_count": None, "price": None, "coordinates": None},
+}
+
+# Cache writes and access-time updates are buffered and written in batches.
+CACHE_FLUSH_BATCH_SIZE = 50
+CACHE_FLUSH_INTERVAL_SECONDS = 5.0
+PENDING_CACHE_WRITES = []
+PENDING_CACHE_TOUCHES = {}
+
+# Cache keys are a hash of the endpoint and its params, without the credentials,
+# so rotating an API key keeps the cache. Keys written by older versions start
+# with LEGACY_CACHE_KEY_PREFIX and are converted when the cache store is opened.
+CACHE_KEY_EXCLUDED_PARAMS = ("key",)
+LEGACY_CACHE_KEY_PREFIX = "UNIQUE_KEY---"
+
+# Requests that missed the cache and are being fetched: (provider, unique_key) -> Future.
+# Workers asking for the same key meanwhile wait for that result instead of calling the API.
+IN_FLIGHT_REQUESTS = {}
+in_flight_lock = threading.Lock()
+
+# Per-provider cache bounds. Set any limit to None to disable it.
+CACHE_LIMITS = {
+    "google": {"max_entries": 5000, "max_bytes": 256 * 1024 * 1024, "ttl_seconds": 30 * 24 * 60 * 60},
+    "yelp": {"max_entries": 5000, "max_bytes": 256 * 1024 * 1024, "ttl_seconds": 30 * 24 * 60 * 60},
+}
+
+CACHE_STATS = {
+    "google": {"hits": 0, "misses": 0, "expirations": 0, "evictions": 0, "coalesced": 0},
+    "yelp": {"hits": 0, "misses": 0, "expirations": 0, "evictions": 0, "coalesced": 0},
+}
+
+DATABASE_FILE_NAME = "harvested_data.sqlite"
+conn = None
+connection_lock = threading.Lock()
+db_lock = threading.Lock()
+
+google_baseurl = "https://maps.googleapis.com/maps/api/place/textsearch/json?"
+google_nearby_baseurl = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+google_geocode_baseurl = "https://maps.googleapis.com/maps/api/geocode/json"
+yelp_baseurl = "https://api.yelp.com/v3/businesses/search"
+language = "en"
+place_type = "restaurant"
+category = "restaurants, All"
+
+# Paginated harvest mode. Google serves at most 3 pages of 20 results and a
+# next_page_token only becomes valid a short time after it is issued. Yelp
+# serves at most 240 results per search, 50 per page.
+HARVEST_ALL_PAGES = False
+GOOGLE_MAX_PAGES = 3
+GOOGLE_PAGE_SIZE = 20
+GOOGLE_PAGE_TOKEN_DELAY_SECONDS = 2.0
+YELP_PAGE_SIZE = 50
+YELP_MAX_RESULTS = 240
+YELP_PAGE_WORKERS = 4
+
+# Tiled harvest mode, for coverage beyond the per-search caps. The city's bounding
+# box, from the Geocoding API, is cut into cells about TILE_SIZE_METERS across.
+# Each cell is searched by location (Google Nearby Search, Yelp by coordinates)
+# with every page of results, and a cell whose results reach a provider's cap is
+# split into four for that provider, up to TILE_MAX_DEPTH times. Results outside
+# the box are dropped and results found by several cells are kept once.
+HARVEST_TILED = False
+TILE_SIZE_METERS = 4000
+TILE_MAX_DEPTH = 3
+TILE_WORKERS = 4
+YELP_MAX_RADIUS_METERS = 40000
+EARTH_RADIUS_METERS = 6371000
+
+# How a city was harvested, as recorded in Harvest_Log so a refresh searches it
+# the same way: mode -> (all_pages, tiled). Cities logged before modes were
+# recorded have the mode "unknown".
+HARVEST_MODES = {"first_page": (False, False), "all_pages": (True, False), "tiled": (False, True)}
+
+# Refresh mode. CACHE_REFRESH makes every search go to the APIs, replacing the
+# cached responses rather than reading them. The refresh command re-harvests
+# cities last harvested more than REFRESH_MAX_AGE_HOURS ago.
+CACHE_REFRESH = False
+REFRESH_MAX_AGE_HOURS = 24
+
+# Token bucket per provider: sustained requests per second and burst size.
+RATE_LIMITS = {
+    "google": {"requests_per_second": 10.0, "burst": 10},
+    "yelp": {"requests_per_second": 5.0, "burst": 5},
+}
+RATE_LIMIT_BUCKETS = {}
+rate_limit_lock = threading.Lock()
+
+# Pooled keep-alive HTTP sessions, one per provider, shared by every thread.
+# Timeouts are (connect, read) in seconds.
+HTTP_POOL_SIZE = 16
+HTTP_TIMEOUT_SECONDS = (5.0, 30.0)
+HTTP_COMPRESSION = True
+HTTP_SESSIONS = {}
+http_session_lock = threading.Lock()
+
+# Retries for throttled (429) and failed (5xx) requests, with jittered exponential backoff.
+# RETRY_MAX_DELAY_SECONDS also bounds the Retry-After a provider may ask for.
+MAX_REQUEST_RETRIES = 5
+RETRY_BASE_DELAY_SECONDS = 1.0
+RETRY_MAX_DELAY_SECONDS = 60.0
+RETRYABLE_STATUS_CODES = [429, 500, 502, 503, 504]
+GOOGLE_RETRYABLE_STATUSES = ["OVER_QUERY_LIMIT", "UNKNOWN_ERROR"]
+
+# Ingest is quiet unless asked; rows are written with executemany in chunks.
+VERBOSE_INGEST = False
+INGEST_PROGRESS = False
+INGEST_CHUNK_SIZE = 500
+
+# Batch harvesting of many cities from a CSV or JSON list.
+BATCH_WORKERS = 4
+BATCH_PROGRESS_FILE_NAME = 'batch_progress.txt'
+
+# Per-stage instrumentation: stage -> call count, wall time, slowest call,
+# bytes handled and failures. Stages can nest (a chart includes its
+# aggregate query), so their times are inclusive.
+STAGE_METRICS = {}
+metrics_lock = threading.Lock()
+METRICS_STARTED_AT = time.time()
+
+
+class ApiRequestError(Exception):
+    """
+    Raised when a Google or Yelp request fails, or is still being
+    throttled after MAX_REQUEST_RETRIES retries. Failed responses
+    are never cached.
+    """
+
+
+@contextmanager
+def measure_stage(stage):
+    """
+    Times the code in the with block and adds it to STAGE_METRICS.
+    The block may add to the yielded dict's "bytes" entry; an
+    exception counts as an error and is passed on.
+
+    Parameters
+    ----------
+    stage: str
+        The stage name, e.g. "http_request.google".
+
+    Returns
+    -------
+    dict
+        The measurement, whose "bytes" the block may set.
+    """
+    measurement = {"bytes": 0}
+    failed = False
+    start = time.perf_counter()
+    try:
+        yield measurement
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        with metrics_lock:
+            metrics = STAGE_METRICS.setdefault(stage, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes": 0, "errors": 0})
+            metrics["calls"] += 1
+            metrics["seconds"] += seconds
+            metrics["max_seconds"] = max(metrics["max_seconds"], seconds)
+            metrics["bytes"] += measurement["bytes"]
+            metrics["errors"] += failed
+
+
+def timed_stage(stage):
+    """
+    Decorator recording every call of a function as a stage in
+    STAGE_METRICS.
+
+    Parameters
+    ----------
+    stage: str
+        The stage name.
+
+    Returns
+    -------
+    function
+        The decorator.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure_stage(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def build_metrics_report():
+    """
+    Collects the stage metrics and cache counters of this run.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    dict
+        "started_at" (Unix time), "elapsed_seconds", "stages"
+        (stage -> "calls", "seconds", "max_seconds", "bytes" and
+        "errors") and "cache" (provider -> CACHE_STATS counters).
+    """
+    with metrics_lock:
+        stages = {stage: dict(metrics) for stage, metrics in sorted(STAGE_METRICS.items())}
+    return {"started_at": METRICS_STARTED_AT, "elapsed_seconds": time.time() - METRICS_STARTED_AT,
+            "stages": stages, "cache": {provider: dict(stats) for provider, stats in CACHE_STATS.items()}}
+
+
+def format_prometheus_metrics():
+    """
+    Renders build_metrics_report in the Prometheus text exposition
+    format.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    str
+        The metrics, one sample per line.
+    """
+    report = build_metrics_report()
+    families = [
+        ("harvest_stage_calls_total", "counter", "Calls of each pipeline stage.", "calls"),
+        ("harvest_stage_seconds_total", "counter", "Wall time spent in each pipeline stage.", "seconds"),
+        ("harvest_stage_max_seconds", "gauge", "Slowest single call of each pipeline stage.", "max_seconds"),
+        ("harvest_stage_bytes_total", "counter", "Bytes received or written by each pipeline stage.", "bytes"),
+        ("harvest_stage_errors_total", "counter", "Calls of each pipeline stage that raised an error.", "errors"),
+    ]
+    lines = []
+    for name, metric_type, description, key in families:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for stage, metrics in report["stages"].items():
+            lines.append(f'{name}{{stage="{stage}"}} {metrics[key]}')
+
+    lines.append("# HELP harvest_cache_events_total API response cache hits, misses, expirations, evictions and requests shared with another thread.")
+    lines.append("# TYPE harvest_cache_events_total counter")
+    for provider, stats in report["cache"].items():
+        for event, count in stats.items():
+            lines.append(f'harvest_cache_events_total{{provider="{provider}",event="{event}"}} {count}')
+    lines.append("# HELP harvest_elapsed_seconds Seconds since the program started.")
+    lines.append("# TYPE harvest_elapsed_seconds gauge")
+    lines.append(f"harvest_elapsed_seconds {report['elapsed_seconds']}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics_report(json_file_name=None, prometheus_file_name=None):
+    """
+    Saves the metrics of this run as JSON and/or Prometheus text.
+
+    Parameters
+    ----------
+    json_file_name: str
+        Where to write the JSON report, or None.
+    prometheus_file_name: str
+        Where to write the Prometheus text, or None.
+
+    Returns
+    -------
+    None
+    """
+    if json_file_name:
+        with open(json_file_name, 'w') as json_file:
+            json.dump(build_metrics_report(), json_file, indent=2)
+    if prometheus_file_name:
+        with open(prometheus_file_name, 'w') as prometheus_file:
+            prometheus_file.write(format_prometheus_metrics())
+
+
+def profile_call(profile_file_name, function, *args):
+    """
+    Runs a function under cProfile and saves the profile, for
+    looking at one search in detail. Threads started during the
+    call (the concurrent Google/Yelp fetches) get their own
+    profiler and are merged into the same file.
+
+    Parameters
+    ----------
+    profile_file_name: str
+        Where to write the profile (read it with python -m pstats).
+    function: callable
+        The function to profile.
+    *args
+        Its arguments.
+
+    Returns
+    -------
+    The function's return value.
+    """
+    import cProfile
+    import pstats
+
+    profilers = [cProfile.Profile()]
+
+    def profile_new_thread(*hook_args):
+        thread_profiler = cProfile.Profile()
+        profilers.append(thread_profiler)
+        thread_profiler.enable()
+
+    threading.setprofile(profile_new_thread)
+    try:
+        return profilers[0].runcall(function, *args)
+    finally:
+        threading.setprofile(None)
+        pstats.Stats(*profilers).dump_stats(profile_file_name)
+        print(f"\nProfile written to {profile_file_name} (view with: python -m pstats {profile_file_name})\n", file=sys.stderr)
+
+
+def acquire_rate_limit_token(provider):
+    """
+    Waits until the provider's token bucket has a token, then
+    takes it. Buckets refill at RATE_LIMITS[provider]
+    ["requests_per_second"] and hold at most ["burst"] tokens,
+    and are shared by every thread in the process.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+
+    Returns
+    -------
+    None
+    """
+    limits = RATE_LIMITS[provider]
+    while True:
+        with rate_limit_lock:
+            now = time.monotonic()
+            bucket = RATE_LIMIT_BUCKETS.setdefault(provider, {"tokens": float(limits["burst"]), "updated": now})
+            bucket["tokens"] = min(float(limits["burst"]), bucket["tokens"] + (now - bucket["updated"]) * limits["requests_per_second"])
+            bucket["updated"] = now
+            if bucket["tokens"] >= 1:
+                bucket["tokens"] -= 1
+                return
+            wait_seconds = (1 - bucket["tokens"]) / limits["requests_per_second"]
+        time.sleep(wait_seconds)
+
+
+def get_http_session(provider):
+    """
+    Returns the provider's shared HTTP session, creating it on first
+    use. The session keeps up to HTTP_POOL_SIZE connections alive,
+    so later requests skip the TCP and TLS handshakes.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+
+    Returns
+    -------
+    requests.Session
+        The provider's session.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    with http_session_lock:
+        session = HTTP_SESSIONS.get(provider)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, pool_block=True)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["Accept-Encoding"] = "gzip, deflate" if HTTP_COMPRESSION else "identity"
+            HTTP_SESSIONS[provider] = session
+            if len(HTTP_SESSIONS) == 1:
+                atexit.register(close_http_sessions)
+        return session
+
+
+def close_http_sessions():
+    """
+    Closes every shared HTTP session and its pooled connections.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    with http_session_lock:
+        for session in HTTP_SESSIONS.values():
+            session.close()
+        HTTP_SESSIONS.clear()
+
+
+def parse_retry_after(retry_after):
+    """
+    Converts a Retry-After header, given either in seconds or
+    as an HTTP date, to a number of seconds to wait.
+
+    Parameters
+    ----------
+    retry_after: str
+        The header value, or None.
+
+    Returns
+    -------
+    float or None
+        The delay in seconds, or None if the header is
+        missing or unreadable.
+    """
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt):
+    """
+    Picks a random delay between zero and an exponentially growing
+    ceiling ("full jitter"), so retrying threads spread out.
+
+    Parameters
+    ----------
+    attempt: int
+        The number of attempts that have already failed, minus one.
+
+    Returns
+    -------
+    float
+        The delay in seconds.
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+
+
+def is_error_response(provider, data):
+    """
+    Tells whether a decoded response is an API error rather than
+    results: a Google status other than OK or ZERO_RESULTS, or a
+    Yelp "error" object. Such responses are never cached.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    data: dict
+        The decoded response.
+
+    Returns
+    -------
+    bool
+        True for an error response.
+    """
+    if not isinstance(data, dict):
+        return True
+    if provider == "google":
+        return data.get("status") not in ("OK", "ZERO_RESULTS")
+    return "error" in data
+
+
+def request_with_retries(provider, url, params, headers=None):
+    """
+    Sends a GET request over the provider's shared session, through
+    its rate limiter, and returns the decoded JSON. 429 and 5xx responses, Google
+    OVER_QUERY_LIMIT/UNKNOWN_ERROR statuses, Google page tokens
+    that are not valid yet and connection errors are retried,
+    waiting for Retry-After when the provider sends it and
+    backing off otherwise. A Retry-After longer than
+    RETRY_MAX_DELAY_SECONDS fails the request at once rather than
+    holding the worker.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    url: str
+        The API endpoint.
+    params: dict
+        The query parameters.
+    headers: dict
+        Extra request headers, if any.
+
+    Returns
+    -------
+    dict
+        The decoded response.
+
+    Raises
+    ------
+    ApiRequestError
+        If the request fails with a non-retryable error, asks to
+        be retried after more than RETRY_MAX_DELAY_SECONDS, or
+        keeps failing after MAX_REQUEST_RETRIES retries.
+    """
+    import requests
+
+    failure = None
+    retry_after = None
+    for attempt in range(MAX_REQUEST_RETRIES + 1):
+        if attempt > 0:
+            delay = retry_after if retry_after is not None else backoff_delay(attempt - 1)
+            print(f"\n{provider.capitalize()} request failed ({failure}), retrying in {delay:.1f}s\n")
+            time.sleep(delay)
+
+        retry_after = None
+        acquire_rate_limit_token(provider)
+        try:
+            with measure_stage(f"http_request.{provider}") as measurement:
+                response = get_http_session(provider).get(url, params=params, headers=headers, timeout=HTTP_TIMEOUT_SECONDS)
+                measurement["bytes"] = len(response.content)
+        except requests.RequestException as error:
+            failure = str(error)
+            continue
+
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            failure = f"HTTP {response.status_code}"
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None and retry_after > RETRY_MAX_DELAY_SECONDS:
+                raise ApiRequestError(f"{provider} request failed with HTTP {response.status_code} and asked to "
+                                      f"retry after {retry_after:.0f}s, more than {RETRY_MAX_DELAY_SECONDS:.0f}s")
+            continue
+        if response.status_code >= 400:
+            raise ApiRequestError(f"{provider} request failed with HTTP {response.status_code}: {response.text[:200]}")
+
+        try:
+            with measure_stage(f"json_parse.{provider}") as measurement:
+                measurement["bytes"] = len(response.content)
+                data = json.loads(response.text)
+        except ValueError:
+            failure = "response was not JSON"
+            continue
+
+        if is_error_response(provider, data):
+            if provider == "yelp":
+                raise ApiRequestError(f"yelp request failed: {data.get('error')}")
+            status = data.get("status")
+            if status in GOOGLE_RETRYABLE_STATUSES or (status == "INVALID_REQUEST" and "pagetoken" in params):
+                failure = status
+                continue
+            raise ApiRequestError(f"google request failed with status {status}: {data.get('error_message', '')}")
+        return data
+
+    raise ApiRequestError(f"{provider} request still failing after {MAX_REQUEST_RETRIES} retries ({failure})")
+
+
+def build_google_params(search_term, page_token=None):
+    """
+    Builds the Google Text Search query parameters for a search term,
+    or the Nearby Search parameters for an area, optionally for a
+    later page of the results.
+
+    Parameters
+    ----------
+    search_term: str or tuple
+        The "city, state" search term, or a (latitude, longitude,
+        radius in meters) circle to search.
+    page_token: str
+        The next_page_token from the previous page, if any.
+
+    Returns
+    -------
+    params: dict
+        The query parameters.
+    """
+    import google_secrets
+
+    if isinstance(search_term, tuple):
+        latitude, longitude, radius = search_term
+        params = {"location": f"{latitude:.6f},{longitude:.6f}", "radius": round(radius),
+                  "key": google_secrets.google_api_key, "language": language, "type": place_type}
+    else:
+        params = {"query": search_term, "key": google_secrets.google_api_key, "language": language, "type": place_type}
+    if page_token is not None:
+        params["pagetoken"] = page_token
+    return params
+
+
+def build_yelp_params(search_term, offset=0, limit=YELP_PAGE_SIZE):
+    """
+    Builds the Yelp Business Search query parameters for a search term
+    or an area, optionally for a later page of the results.
+
+    Parameters
+    ----------
+    search_term: str or tuple
+        The "city, state" search term, or a (latitude, longitude,
+        radius in meters) circle to search.
+    offset: int
+        The index of the first business to return.
+    limit: int
+        The number of businesses to return, at most 50.
+
+    Returns
+    -------
+    params: dict
+        The query parameters.
+    """
+    if isinstance(search_term, tuple):
+        latitude, longitude, radius = search_term
+        params = {"categories": category, "latitude": round(latitude, 6), "longitude": round(longitude, 6),
+                  "radius": min(round(radius), YELP_MAX_RADIUS_METERS), "locale": "en_US", "limit": limit}
+    else:
+        params = {"categories": category, "location": search_term, "locale": "en_US", "limit": limit}
+    if offset > 0:
+        params["offset"] = offset
+    return params
+
+
+def fetch_google_data(google_baseurl, search_term, page_token=None):
+    """
+    Takes a URL and a search term (both strings)
+    in order to retrieve a JSON object of 
+    Google data for up to 20 results relevant
+    to the given search term. Then returns the
+    JSON as a Python dictionary.
+
+    Parameters
+    ----------
+    google_baseurl: str
+        The URL forming the base of the API query.
+    search_term: str or tuple
+        The "city, state" search term, or a (latitude,
+        longitude, radius in meters) area.
+    page_token: str
+        The next_page_token of the previous page, to fetch
+        the following page instead of the first one.
+
+    Returns
+    ----------
+    google_data: dict
+        A Python dictionary rendered from
+        JSON, comprising the search results, 
+        maximum 20.
+    """
+    if page_token is not None:
+        time.sleep(GOOGLE_PAGE_TOKEN_DELAY_SECONDS)
+    params = build_google_params(search_term, page_token)
+    google_data = request_with_retries("google", google_baseurl, params)
+    return google_data
+
+
+def fetch_yelp_data(yelp_baseurl, search_term, offset=0, limit=YELP_PAGE_SIZE):
+    """
+    Takes a URL and a search term (both strings)
+    in order to retrieve a JSON object of 
+    Yelp data for up to 50 results relevant
+    to the given search term. Then returns the
+    JSON as a Python dictionary.
+
+    Parameters
+    ----------
+    yelp_baseurl: str
+        The URL forming the base of the API query.
+    search_term: str or tuple
+        The "city, state" search term, or a (latitude,
+        longitude, radius in meters) area.
+    offset: int
+        The index of the first business to return.
+    limit: int
+        The number of businesses to return, at most 50.
+
+    Returns
+    ----------
+    yelp_data: dict
+        A Python dictionary rendered from
+        JSON, comprising the search results, 
+        maximum 50.
+    """
+    import yelp_secrets
+
+    headers = {"Authorization": f"Bearer {yelp_secrets.yelp_api_key}"}
+    params = build_yelp_params(search_term, offset, limit)
+    yelp_data = request_with_retries("yelp", yelp_baseurl, params, headers)
+    return yelp_data
+
+
+def construct_cache_key(baseurl, params):
+    """
+    Hashes a canonical form of an API request, so the same
+    baseurl and params give the same key whatever the order of
+    the params. Params in CACHE_KEY_EXCLUDED_PARAMS, such as the
+    API key, are left out.
+
+    Parameters
+    ----------
+    baseurl: string
+        The URL for the API endpoint
+    params: dict
+        A dictionary of param:value pairs
+
+    Returns
+    -------
+    string
+        The hex digest of the request.
+    """
+    kept_params = {name: value for name, value in params.items() if name not in CACHE_KEY_EXCLUDED_PARAMS}
+    canonical = json.dumps([str(baseurl), kept_params], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def construct_unique_key_google(google_baseurl, params):
+    """
+    Constructs a key that is guaranteed to uniquely and 
+    repeatably identify an API request by its baseurl and params
+    
+    Parameters
+    ----------
+    google_baseurl: string
+        The URL for the API endpoint
+    params: dict
+        A dictionary of param:value pairs
+    
+    Returns
+    -------
+    string
+        the unique key as a string
+    """
+    return construct_cache_key(google_baseurl, params)
+
+
+def construct_unique_key_yelp(yelp_baseurl, params):
+    ''' constructs a key that is guaranteed to uniquely and 
+    repeatably identify an API request by its baseurl and params
+    
+    Parameters
+    ----------
+    yelp_baseurl: string
+        The URL for the API endpoint
+    params: dict
+        A dictionary of param:value pairs
+    
+    Returns
+    -------
+    string
+        the unique key as a string
+    '''
+    return construct_cache_key(yelp_baseurl, params)
+
+
+def convert_legacy_cache_key(legacy_key):
+    """
+    Rebuilds the current cache key of a request from a key
+    written by older versions, which had the form
+    UNIQUE_KEY---<baseurl>---<params>---<api key>.
+
+    Parameters
+    ----------
+    legacy_key: str
+        The old key.
+
+    Returns
+    -------
+    str or None
+        The current key, or None if legacy_key cannot be parsed.
+    """
+    if not legacy_key.startswith(LEGACY_CACHE_KEY_PREFIX):
+        return None
+    request_text = legacy_key[len(LEGACY_CACHE_KEY_PREFIX):].rsplit("---", 1)[0]
+    if "---" not in request_text:
+        return None
+    baseurl, params_text = request_text.split("---", 1)
+    try:
+        params = ast.literal_eval(params_text)
+    except (ValueError, SyntaxError):
+        return None
+    if not isinstance(params, dict):
+        return None
+    return construct_cache_key(baseurl, params)
+
+
+create_api_cache = '''
+    CREATE TABLE IF NOT EXISTS "Api_Cache" (
+        'provider' TEXT NOT NULL,
+        'cache_key' TEXT NOT NULL,
+        'response' TEXT NOT NULL,
+        'created_at' REAL NOT NULL DEFAULT 0,
+        'last_access' REAL NOT NULL DEFAULT 0,
+        'size_bytes' INTEGER NOT NULL DEFAULT 0,
+        'encoding' TEXT NOT NULL DEFAULT 'json',
+        'entry_id' INTEGER,
+        PRIMARY KEY (provider, cache_key)
+    );
+'''
+
+# Business records shared by cached responses, and which response (by its
+# entry_id) uses which record at which position. Refs go away with their
+# response; records no response refers to are swept by
+# delete_orphan_api_cache_records.
+create_api_cache_record = '''
+    CREATE TABLE IF NOT EXISTS "Api_Cache_Record" (
+        'record_hash' BLOB PRIMARY KEY,
+        'record' BLOB NOT NULL
+    ) WITHOUT ROWID;
+'''
+
+create_api_cache_ref = '''
+    CREATE TABLE IF NOT EXISTS "Api_Cache_Ref" (
+        'entry_id' INTEGER NOT NULL,
+        'position' INTEGER NOT NULL,
+        'record_hash' BLOB NOT NULL,
+        PRIMARY KEY (entry_id, position)
+    ) WITHOUT ROWID;
+'''
+
+create_api_cache_ref_index = '''
+    CREATE INDEX IF NOT EXISTS "Api_Cache_Ref_By_Record"
+    ON Api_Cache_Ref (record_hash);
+'''
+
+create_api_cache_delete_trigger = '''
+    CREATE TRIGGER IF NOT EXISTS "Api_Cache_Delete_Refs"
+    AFTER DELETE ON Api_Cache
+    BEGIN
+        DELETE FROM Api_Cache_Ref
+        WHERE entry_id = OLD.entry_id;
+    END;
+'''
+
+insert_api_cache_record = '''
+    INSERT OR IGNORE INTO Api_Cache_Record
+    VALUES (?, ?)
+'''
+
+insert_api_cache_ref = '''
+    INSERT INTO Api_Cache_Ref
+    VALUES (?, ?, ?)
+'''
+
+delete_api_cache_refs = '''
+    DELETE FROM Api_Cache_Ref
+    WHERE entry_id = (SELECT entry_id FROM Api_Cache WHERE provider = ? AND cache_key = ?)
+'''
+
+select_api_cache_records = '''
+    SELECT record_i.record
+    FROM Api_Cache_Ref AS ref_i
+    JOIN Api_Cache_Record AS record_i
+    ON record_i.record_hash = ref_i.record_hash
+    WHERE ref_i.entry_id = ?
+    ORDER BY ref_i.position
+'''
+
+select_max_api_cache_entry_id = '''
+    SELECT COALESCE(MAX(entry_id), 0)
+    FROM Api_Cache
+'''
+
+delete_orphan_api_cache_records = '''
+    DELETE FROM Api_Cache_Record
+    WHERE NOT EXISTS (
+        SELECT 1 FROM Api_Cache_Ref
+        WHERE Api_Cache_Ref.record_hash = Api_Cache_Record.record_hash
+    )
+'''
+
+select_json_api_cache = '''
+    SELECT provider, cache_key, response, created_at, last_access
+    FROM Api_Cache
+    WHERE encoding = 'json'
+'''
+
+create_api_cache_lru_index = '''
+    CREATE INDEX IF NOT EXISTS "Api_Cache_LRU"
+    ON Api_Cache (provider, last_access);
+'''
+
+select_api_cache = '''
+    SELECT response, created_at, encoding, entry_id
+    FROM Api_Cache
+    WHERE provider = ? AND cache_key = ?
+'''
+
+insert_api_cache = '''
+    INSERT OR REPLACE INTO Api_Cache (provider, cache_key, response, created_at, last_access, size_bytes, encoding, entry_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+select_api_cache_key = '''
+    SELECT 1
+    FROM Api_Cache
+    WHERE provider = ? AND cache_key = ?
+'''
+
+touch_api_cache = '''
+    UPDATE Api_Cache
+    SET last_access = ?
+    WHERE provider = ? AND cache_key = ?
+'''
+
+delete_api_cache = '''
+    DELETE FROM Api_Cache
+    WHERE provider = ? AND cache_key = ?
+'''
+
+delete_expired_api_cache = '''
+    DELETE FROM Api_Cache
+    WHERE provider = ? AND created_at < ?
+'''
+
+select_api_cache_totals = '''
+    SELECT COUNT(*), COALESCE(SUM(size_bytes), 0)
+    FROM Api_Cache
+    WHERE provider = ?
+'''
+
+select_api_cache_lru = '''
+    SELECT cache_key, size_bytes, entry_id
+    FROM Api_Cache
+    WHERE provider = ?
+    ORDER BY last_access
+'''
+
+# An entry's size_bytes only counts its own payload. The records it uses are
+# counted once each, however many entries share them.
+select_api_cache_record_bytes = '''
+    SELECT COALESCE(SUM(LENGTH(record_i.record)), 0)
+    FROM Api_Cache_Record AS record_i
+    WHERE record_i.record_hash IN (
+        SELECT ref_i.record_hash
+        FROM Api_Cache_Ref AS ref_i
+        JOIN Api_Cache AS cache_i
+        ON cache_i.entry_id = ref_i.entry_id
+        WHERE cache_i.provider = ?)
+'''
+
+select_api_cache_record_refs = '''
+    SELECT ref_i.entry_id, ref_i.record_hash, LENGTH(record_i.record)
+    FROM Api_Cache AS cache_i
+    JOIN Api_Cache_Ref AS ref_i
+    ON ref_i.entry_id = cache_i.entry_id
+    JOIN Api_Cache_Record AS record_i
+    ON record_i.record_hash = ref_i.record_hash
+    WHERE cache_i.provider = ?
+'''
+
+select_legacy_api_cache_keys = f'''
+    SELECT provider, cache_key
+    FROM Api_Cache
+    WHERE cache_key GLOB '{LEGACY_CACHE_KEY_PREFIX}*'
+'''
+
+rename_api_cache_key = '''
+    UPDATE OR IGNORE Api_Cache
+    SET cache_key = ?
+    WHERE provider = ? AND cache_key = ?
+'''
+
+delete_legacy_api_cache_keys = f'''
+    DELETE FROM Api_Cache
+    WHERE cache_key GLOB '{LEGACY_CACHE_KEY_PREFIX}*'
+'''
+
+
+@timed_stage("cache_legacy_load")
+def load_cache(CACHE_FILE_NAME):
+    """
+    Opens a legacy JSON cache file if it exists and loads the JSON into
+    a cache dictionary.
+    if the cache file doesn't exist, creates a new cache dictionary.
+    Only used to migrate old JSON caches into the cache database.
+    
+    Parameters
+    ----------
+    CACHE_FILE_NAME: str
+        The name of the JSON cache file to read.
+    
+    Returns
+    -------
+    The opened cache: dict
+    """
+    try:
+        cache_file = open(CACHE_FILE_NAME, 'r')
+        cache_file_contents = cache_file.read()
+        cache = json.loads(cache_file_contents)
+        cache_file.close()
+    except:
+        cache = {}
+    return cache
+
+
+def redact_legacy_cache_key(legacy_key):
+    """
+    Removes the API key from a key written by older versions: the
+    last ---<api key> part of the UNIQUE_KEY form, and the
+    configured Google and Yelp keys wherever else they appear.
+
+    Parameters
+    ----------
+    legacy_key: str
+        The old key.
+
+    Returns
+    -------
+    str
+        The key without the API key.
+    """
+    if legacy_key.startswith(LEGACY_CACHE_KEY_PREFIX) and legacy_key.count("---") >= 2:
+        legacy_key = legacy_key.rsplit("---", 1)[0] + "---<api key removed>"
+    for module_name, attribute in [("google_secrets", "google_api_key"), ("yelp_secrets", "yelp_api_key")]:
+        try:
+            api_key = getattr(importlib.import_module(module_name), attribute)
+        except (ImportError, AttributeError):
+            continue
+        if api_key:
+            legacy_key = legacy_key.replace(api_key, "<api key removed>")
+    return legacy_key
+
+
+def migrate_json_cache(provider, CACHE_FILE_NAME):
+    """
+    Copies every entry of a legacy JSON cache file, and of the
+    <file>.migrated copy older versions left behind, into the
+    cache database under its current key. Entries already in the
+    database are kept, and error responses (e.g. throttling), which
+    older versions cached, are dropped (see is_error_response).
+    A file whose entries were all handled is deleted, since its
+    keys contain the API key; one with entries whose key cannot be
+    converted is rewritten with only those entries, their keys
+    redacted, so they are not lost.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    CACHE_FILE_NAME: str
+        The name of the JSON cache file to migrate.
+
+    Returns
+    -------
+    int
+        The number of entries read from the JSON files.
+    """
+    read_count = 0
+    for file_name in [CACHE_FILE_NAME + '.migrated', CACHE_FILE_NAME]:
+        if not os.path.exists(file_name):
+            continue
+
+        cache = load_cache(file_name)
+        now = time.time()
+        entries = {}
+        unconverted = {}
+        for legacy_key, response in cache.items():
+            unique_key = convert_legacy_cache_key(legacy_key)
+            if unique_key is None:
+                unconverted[redact_legacy_cache_key(legacy_key)] = response
+                continue
+            if is_error_response(provider, response):
+                continue
+            cache_cur.execute(select_api_cache_key, [provider, unique_key])
+            if cache_cur.fetchone() is None:
+                entries[unique_key] = [provider, unique_key, strip_cached_fields(provider, response), now]
+        write_cache_entries(list(entries.values()))
+        cache_conn.commit()
+        enforce_cache_limits(provider)
+        read_count += len(cache)
+
+        # A file already reduced to the entries that cannot be read (or that
+        # cannot be read at all) is left as it is.
+        if unconverted == cache:
+            continue
+        if unconverted:
+            with open(file_name, 'w') as cache_file:
+                json.dump(unconverted, cache_file)
+            print(f"\nMigrated {len(entries)} of {len(cache)} {provider} cache entries from {file_name}; "
+                  f"kept the {len(unconverted)} it could not read there, without the API key\n")
+        else:
+            os.remove(file_name)
+            print(f"\nMigrated {len(entries)} of {len(cache)} {provider} cache entries from {file_name} and deleted it\n")
+    return read_count
+
+
+def migrate_legacy_cache_keys():
+    """
+    Renames cache entries stored under keys written by older
+    versions to their current keys. Entries whose key cannot be
+    parsed, or whose current key is already taken, are dropped.
+    Callers must hold cache_lock.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    int
+        The number of entries renamed.
+    """
+    cache_cur.execute(select_legacy_api_cache_keys)
+    renames = []
+    for provider, legacy_key in cache_cur.fetchall():
+        unique_key = convert_legacy_cache_key(legacy_key)
+        if unique_key is not None:
+            renames.append([unique_key, provider, legacy_key])
+    cache_cur.executemany(rename_api_cache_key, renames)
+    renamed = max(cache_cur.rowcount, 0)
+    cache_cur.execute(delete_legacy_api_cache_keys)
+    if cache_cur.rowcount > 0:
+        cache_cur.execute(delete_orphan_api_cache_records)
+        stored_cache_record_hashes.clear()
+    cache_conn.commit()
+    return renamed
+
+
+def initialize_cache_store():
+    """
+    Opens the cache database, creates the cache table if needed,
+    migrates the legacy
+    Google and Yelp JSON cache files into it and starts the
+    background writer for buffered cache writes. Safe to call
+    more than once.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    global cache_store_ready, cache_conn, cache_cur, last_cache_entry_id
+    with cache_lock:
+        if cache_store_ready:
+            return
+        cache_conn = sqlite3.connect(CACHE_DB_FILE_NAME, check_same_thread=False)
+        cache_cur = cache_conn.cursor()
+        cache_cur.execute(create_api_cache)
+        upgrade_cache_table()
+        cache_cur.execute(create_api_cache_lru_index)
+        cache_cur.execute(create_api_cache_record)
+        cache_cur.execute(create_api_cache_ref)
+        cache_cur.execute(create_api_cache_ref_index)
+        cache_cur.execute(create_api_cache_delete_trigger)
+        cache_conn.commit()
+        cache_cur.execute(select_max_api_cache_entry_id)
+        last_cache_entry_id = cache_cur.fetchone()[0]
+        stored_cache_record_hashes.clear()
+        migrate_legacy_cache_keys()
+        cache_store_ready = True
+        migrate_json_cache("google", GOOGLE_CACHE_FILE_NAME)
+        migrate_json_cache("yelp", YELP_CACHE_FILE_NAME)
+
+    atexit.register(flush_cache_writes)
+    flusher = threading.Thread(target=run_cache_flusher, daemon=True)
+    flusher.start()
+
+
+def upgrade_cache_table():
+    """
+    Adds the expiry and eviction bookkeeping columns, and the
+    payload encoding and entry id columns, to a cache table created before they
+    existed. Entries that predate the bookkeeping columns are
+    treated as created and last used right now; entries that
+    predate the encoding column are verbatim JSON.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    cache_cur.execute("PRAGMA table_info(Api_Cache)")
+    existing_columns = [row[1] for row in cache_cur.fetchall()]
+    if "created_at" not in existing_columns:
+        now = time.time()
+        cache_cur.execute("ALTER TABLE Api_Cache ADD COLUMN created_at REAL NOT NULL DEFAULT 0")
+        cache_cur.execute("ALTER TABLE Api_Cache ADD COLUMN last_access REAL NOT NULL DEFAULT 0")
+        cache_cur.execute("ALTER TABLE Api_Cache ADD COLUMN size_bytes INTEGER NOT NULL DEFAULT 0")
+        cache_cur.execute("UPDATE Api_Cache SET created_at = ?, last_access = ?, size_bytes = LENGTH(response)", [now, now])
+    if "encoding" not in existing_columns:
+        cache_cur.execute("ALTER TABLE Api_Cache ADD COLUMN encoding TEXT NOT NULL DEFAULT 'json'")
+        cache_cur.execute("ALTER TABLE Api_Cache ADD COLUMN entry_id INTEGER")
+
+
+def compress_payload(data, compression):
+    """
+    Compresses bytes with the named method.
+
+    Parameters
+    ----------
+    data: bytes
+        The bytes to compress.
+    compression: str
+        "zlib", "lzma" or "none".
+
+    Returns
+    -------
+    bytes
+        The compressed bytes.
+    """
+    if compression == "zlib":
+        return zlib.compress(data, 6)
+    if compression == "lzma":
+        import lzma
+        return lzma.compress(data)
+    return data
+
+
+def decompress_payload(data, compression):
+    """
+    Reverses compress_payload.
+
+    Parameters
+    ----------
+    data: bytes
+        The compressed bytes.
+    compression: str
+        "zlib", "lzma" or "none".
+
+    Returns
+    -------
+    bytes
+        The original bytes.
+    """
+    if compression == "zlib":
+        return zlib.decompress(data)
+    if compression == "lzma":
+        import lzma
+        return lzma.decompress(data)
+    return bytes(data)
+
+
+def strip_cached_fields(provider, response):
+    """
+    Drops the fields of each business record that ingest,
+    matching and tiling never read (photos, opening hours...),
+    when CACHE_STRIP_FIELDS is on.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    response: dict
+        The API response.
+
+    Returns
+    -------
+    dict
+        A copy of the response with trimmed records, or the
+        response itself when stripping is off.
+    """
+    list_key = CACHE_RECORD_LISTS[provider]
+    if not CACHE_STRIP_FIELDS or not isinstance(response.get(list_key), list):
+        return response
+
+    kept_fields = CACHE_KEPT_FIELDS[provider]
+    records = []
+    for record in response[list_key]:
+        stripped = {}
+        for field, subfields in kept_fields.items():
+            if field not in record:
+                continue
+            if subfields is not None and isinstance(record[field], dict):
+                stripped[field] = {subfield: record[field][subfield] for subfield in subfields if subfield in record[field]}
+            else:
+                stripped[field] = record[field]
+        records.append(stripped)
+    stripped_response = dict(response)
+    stripped_response[list_key] = records
+    return stripped_response
+
+
+def encode_cache_entry(provider, response):
+    """
+    Converts a response into its CACHE_FORMAT storage form.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    response: dict
+        The API response.
+
+    Returns
+    -------
+    tuple
+        The stored payload (str or bytes), its encoding ("json" or
+        "records+<compression>") and the list of (record_hash,
+        record_text) business records it refers to, in order, still
+        uncompressed.
+    """
+    if CACHE_FORMAT == "json":
+        return json.dumps(response), "json", []
+
+    compression = CACHE_COMPRESSION or "none"
+    list_key = CACHE_RECORD_LISTS[provider]
+    envelope = dict(response)
+    records = []
+    for record in envelope.pop(list_key, None) or []:
+        record_text = json.dumps(record, sort_keys=True, separators=(",", ":")).encode()
+        # The compression is part of the hash, so entries written under another
+        # CACHE_COMPRESSION never share (and mis-decode) each other's records.
+        record_hash = hashlib.blake2b(record_text, digest_size=16, person=compression.encode()).digest()
+        records.append((record_hash, record_text))
+    envelope["_record_count"] = len(records)
+    payload = compress_payload(json.dumps(envelope, separators=(",", ":")).encode(), compression)
+    return payload, f"records+{compression}", records
+
+
+def decode_cache_entry(provider, entry_id, payload, encoding):
+    """
+    Rebuilds a cached response from its stored form. Callers must
+    hold cache_lock.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    entry_id: int
+        The entry's id, to find its records.
+    payload: str or bytes
+        The stored payload.
+    encoding: str
+        How it was stored, from encode_cache_entry.
+
+    Returns
+    -------
+    dict or None
+        The response, or None if some of its records are missing.
+    """
+    if encoding == "json":
+        return json.loads(payload)
+
+    compression = encoding.split("+", 1)[1]
+    response = json.loads(decompress_payload(payload, compression))
+    cache_cur.execute(select_api_cache_records, [entry_id])
+    record_texts = [decompress_payload(row[0], compression) for row in cache_cur.fetchall()]
+    if len(record_texts) != response.pop("_record_count", len(record_texts)):
+        return None
+    response[CACHE_RECORD_LISTS[provider]] = json.loads(b"[" + b",".join(record_texts) + b"]")
+    return response
+
+
+def write_cache_entries(entries):
+    """
+    Encodes responses and writes them to the cache database under
+    new entry ids, replacing any entry with the same key, without
+    committing. Callers must hold cache_lock.
+
+    Parameters
+    ----------
+    entries: list
+        [provider, unique_key, response, created_at] lists. When a
+        key appears more than once, the last one wins.
+
+    Returns
+    -------
+    int
+        The bytes written: the payloads, plus the records that were
+        not stored yet.
+    """
+    global last_cache_entry_id
+    if len(stored_cache_record_hashes) > STORED_CACHE_RECORD_HASHES_MAX:
+        stored_cache_record_hashes.clear()
+    # Only the last write of each key is stored: every row gets a new entry_id,
+    # and the refs of a row replaced within the same batch would never be deleted.
+    latest_entries = {}
+    for entry in entries:
+        latest_entries[(entry[0], entry[1])] = entry
+
+    rows = []
+    record_rows = []
+    ref_rows = []
+    for provider, unique_key, response, created_at in latest_entries.values():
+        payload, encoding, records = encode_cache_entry(provider, response)
+        for record_hash, record_text in records:
+            if record_hash not in stored_cache_record_hashes:
+                stored_cache_record_hashes.add(record_hash)
+                record_rows.append([record_hash, compress_payload(record_text, encoding.split("+", 1)[1])])
+        last_cache_entry_id += 1
+        rows.append([provider, unique_key, payload, created_at, created_at, len(payload), encoding, last_cache_entry_id])
+        ref_rows.extend([last_cache_entry_id, position, record_hash] for position, (record_hash, _) in enumerate(records))
+
+    cache_cur.executemany(delete_api_cache_refs, [row[:2] for row in rows])
+    cache_cur.executemany(insert_api_cache, rows)
+    cache_cur.executemany(insert_api_cache_record, record_rows)
+    cache_cur.executemany(insert_api_cache_ref, ref_rows)
+    return sum(row[5] for row in rows) + sum(len(row[1]) for row in record_rows)
+
+
+def compact_cache_store():
+    """
+    Re-stores every verbatim JSON cache entry in the current
+    CACHE_FORMAT, drops unreferenced records and vacuums the cache
+    database so the freed space is returned to the disk.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    tuple
+        The number of entries converted, and the cache database
+        size in bytes before and after.
+    """
+    initialize_cache_store()
+    flush_cache_writes()
+    size_before = os.path.getsize(CACHE_DB_FILE_NAME)
+    converted = 0
+    with cache_lock:
+        if CACHE_FORMAT != "json":
+            cache_cur.execute(select_json_api_cache)
+            rows = cache_cur.fetchall()
+            for provider, unique_key, payload, created_at, last_access in rows:
+                response = strip_cached_fields(provider, json.loads(payload))
+                write_cache_entries([[provider, unique_key, response, created_at]])
+                cache_cur.execute(touch_api_cache, [last_access, provider, unique_key])
+            converted = len(rows)
+        cache_cur.execute(delete_orphan_api_cache_records)
+        stored_cache_record_hashes.clear()
+        cache_conn.commit()
+        cache_cur.execute("VACUUM")
+    return converted, size_before, os.path.getsize(CACHE_DB_FILE_NAME)
+
+
+@timed_stage("cache_lookup")
+def lookup_cache(provider, unique_key):
+    """
+    Looks a response up in the in-memory tier first, then in the
+    cache database, reading only that one entry. Responses found
+    on disk are kept in memory for the rest of the session.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    unique_key: str
+        The key built by construct_unique_key_google/yelp.
+
+    Returns
+    -------
+    dict or None
+        The cached response, or None on a cache miss
+        or when the entry is older than the provider's TTL.
+    """
+    initialize_cache_store()
+    now = time.time()
+    ttl_seconds = CACHE_LIMITS[provider]["ttl_seconds"]
+    memory_cache = MEMORY_CACHES[provider]
+
+    with cache_lock:
+        if unique_key in memory_cache:
+            response, created_at = memory_cache[unique_key]
+            if ttl_seconds is not None and now - created_at > ttl_seconds:
+                del memory_cache[unique_key]
+                CACHE_STATS[provider]["expirations"] += 1
+                CACHE_STATS[provider]["misses"] += 1
+                return None
+            memory_cache.move_to_end(unique_key)
+            PENDING_CACHE_TOUCHES[(provider, unique_key)] = now
+            CACHE_STATS[provider]["hits"] += 1
+            return response
+
+        cache_cur.execute(select_api_cache, [provider, unique_key])
+        row = cache_cur.fetchone()
+        if row is None:
+            CACHE_STATS[provider]["misses"] += 1
+            return None
+
+        if ttl_seconds is not None and now - row[1] > ttl_seconds:
+            cache_cur.execute(delete_api_cache, [provider, unique_key])
+            cache_conn.commit()
+            CACHE_STATS[provider]["expirations"] += 1
+            CACHE_STATS[provider]["misses"] += 1
+            return None
+
+        response = decode_cache_entry(provider, row[3], row[0], row[2])
+        if response is None:
+            cache_cur.execute(delete_api_cache, [provider, unique_key])
+            cache_conn.commit()
+            CACHE_STATS[provider]["misses"] += 1
+            return None
+        remember_in_memory(provider, unique_key, response, row[1])
+        PENDING_CACHE_TOUCHES[(provider, unique_key)] = now
+        CACHE_STATS[provider]["hits"] += 1
+        return response
+
+
+def store_cache(provider, unique_key, response):
+    """
+    Puts a response, trimmed by strip_cached_fields, in the
+    in-memory tier and queues it for the cache database. Queued
+    writes are flushed once
+    CACHE_FLUSH_BATCH_SIZE of them are waiting, by the background
+    writer, or when the program exits.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    unique_key: str
+        The key built by construct_unique_key_google/yelp.
+    response: dict
+        The API response to cache.
+
+    Returns
+    -------
+    None
+    """
+    initialize_cache_store()
+    now = time.time()
+    response = strip_cached_fields(provider, response)
+    with cache_lock:
+        remember_in_memory(provider, unique_key, response, now)
+        PENDING_CACHE_WRITES.append([provider, unique_key, response, now])
+        if len(PENDING_CACHE_WRITES) >= CACHE_FLUSH_BATCH_SIZE:
+            flush_cache_writes()
+
+
+def remember_in_memory(provider, unique_key, response, created_at):
+    """
+    Adds a response to a provider's in-memory tier, dropping the
+    least recently used entries beyond MEMORY_CACHE_MAX_ENTRIES.
+    Dropped entries stay in the cache database.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    unique_key: str
+        The key built by construct_unique_key_google/yelp.
+    response: dict
+        The API response.
+    created_at: float
+        When the response was fetched, as a Unix timestamp.
+
+    Returns
+    -------
+    None
+    """
+    memory_cache = MEMORY_CACHES[provider]
+    with cache_lock:
+        memory_cache[unique_key] = [response, created_at]
+        memory_cache.move_to_end(unique_key)
+        while len(memory_cache) > MEMORY_CACHE_MAX_ENTRIES:
+            memory_cache.popitem(last=False)
+
+
+def flush_cache_writes():
+    """
+    Writes every queued response and access-time update to the
+    cache database in one transaction, then applies the cache
+    limits of each provider that received new entries.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    int
+        The number of responses written.
+    """
+    with cache_lock:
+        if not PENDING_CACHE_WRITES and not PENDING_CACHE_TOUCHES:
+            return 0
+
+        with measure_stage("cache_flush") as measurement:
+            touches = [[last_access, provider, unique_key] for (provider, unique_key), last_access in PENDING_CACHE_TOUCHES.items()]
+            measurement["bytes"] = write_cache_entries(PENDING_CACHE_WRITES)
+            cache_cur.executemany(touch_api_cache, touches)
+            cache_conn.commit()
+            for provider in set(entry[0] for entry in PENDING_CACHE_WRITES):
+                enforce_cache_limits(provider)
+
+        written = len(PENDING_CACHE_WRITES)
+        PENDING_CACHE_WRITES.clear()
+        PENDING_CACHE_TOUCHES.clear()
+        return written
+
+
+def run_cache_flusher():
+    """
+    Background loop that flushes buffered cache writes every
+    CACHE_FLUSH_INTERVAL_SECONDS.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    while True:
+        time.sleep(CACHE_FLUSH_INTERVAL_SECONDS)
+        flush_cache_writes()
+
+
+def enforce_cache_limits(provider):
+    """
+    Removes expired entries for a provider, then evicts the least
+    recently used entries until the provider is back under its
+    configured entry count and byte size. Business records no
+    longer used by any entry are deleted too.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+
+    Returns
+    -------
+    int
+        The number of entries evicted (expired entries not included).
+    """
+    limits = CACHE_LIMITS[provider]
+    with cache_lock:
+        return evict_cache_entries(provider, limits)
+
+
+def evict_cache_entries(provider, limits):
+    """
+    Does the work of enforce_cache_limits. Callers must hold cache_lock.
+    The byte size is the entries' own payloads plus each business
+    record they use, counted once however many entries share it,
+    and an eviction only frees the records no remaining entry uses.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    limits: dict
+        The provider's entry of CACHE_LIMITS.
+
+    Returns
+    -------
+    int
+        The number of entries evicted.
+    """
+    removed_count = 0
+    if limits["ttl_seconds"] is not None:
+        cache_cur.execute(delete_expired_api_cache, [provider, time.time() - limits["ttl_seconds"]])
+        CACHE_STATS[provider]["expirations"] += cache_cur.rowcount
+        removed_count += cache_cur.rowcount
+
+    cache_cur.execute(select_api_cache_totals, [provider])
+    entry_count, total_bytes = cache_cur.fetchone()
+    max_entries = limits["max_entries"]
+    max_bytes = limits["max_bytes"]
+    if max_bytes is not None:
+        cache_cur.execute(select_api_cache_record_bytes, [provider])
+        total_bytes += cache_cur.fetchone()[0]
+
+    evicted_keys = []
+    if (max_entries is not None and entry_count > max_entries) or (max_bytes is not None and total_bytes > max_bytes):
+        # entry_id -> its record hashes, and how many entries use each record
+        entry_records = {}
+        record_refs = {}
+        record_sizes = {}
+        if max_bytes is not None:
+            cache_cur.execute(select_api_cache_record_refs, [provider])
+            for entry_id, record_hash, record_size in cache_cur.fetchall():
+                entry_records.setdefault(entry_id, []).append(record_hash)
+                record_refs[record_hash] = record_refs.get(record_hash, 0) + 1
+                record_sizes[record_hash] = record_size
+
+        cache_cur.execute(select_api_cache_lru, [provider])
+        for cache_key, size_bytes, entry_id in cache_cur.fetchall():
+            over_entries = max_entries is not None and entry_count > max_entries
+            over_bytes = max_bytes is not None and total_bytes > max_bytes
+            if not over_entries and not over_bytes:
+                break
+            evicted_keys.append([provider, cache_key])
+            MEMORY_CACHES[provider].pop(cache_key, None)
+            entry_count -= 1
+            total_bytes -= size_bytes
+            for record_hash in entry_records.pop(entry_id, []):
+                record_refs[record_hash] -= 1
+                if record_refs[record_hash] == 0:
+                    total_bytes -= record_sizes[record_hash]
+        cache_cur.executemany(delete_api_cache, evicted_keys)
+
+    if removed_count + len(evicted_keys) > 0:
+        cache_cur.execute(delete_orphan_api_cache_records)
+        stored_cache_record_hashes.clear()
+    cache_conn.commit()
+    CACHE_STATS[provider]["evictions"] += len(evicted_keys)
+    return len(evicted_keys)
+
+
+def format_cache_stats():
+    """
+    Builds a one-line-per-provider summary of cache hits,
+    misses, expirations, evictions and shared in-flight
+    requests for this session.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    str
+        The formatted counters.
+    """
+    lines = []
+    for provider, stats in CACHE_STATS.items():
+        lines.append(f"{provider}: {stats['hits']} hits, {stats['misses']} misses, "
+                     f"{stats['expirations']} expired, {stats['evictions']} evicted, "
+                     f"{stats['coalesced']} shared")
+    return "\n".join(lines)
+
+
+def print_cache_stats():
+    """
+    Prints the session's cache counters to standard error, so
+    they do not mix with the JSON or CSV a command prints. Run
+    when the program exits.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    print("\nAPI cache this session:\n" + format_cache_stats() + "\n", file=sys.stderr)
+
+
+def request_once(provider, unique_key, fetch):
+    """
+    Looks a request up in the cache, and on a miss (or always,
+    with CACHE_REFRESH) calls fetch and caches its result. While
+    one thread is doing this for a key, other threads asking for
+    the same key wait for its result, so the API is called once.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    unique_key: str
+        The cache key of the request.
+    fetch: callable
+        Called without arguments to request the data from the API.
+
+    Returns
+    -------
+    tuple
+        The response, and where it came from: "cache", "api", or
+        "shared" when another thread's request was waited for.
+    """
+    with in_flight_lock:
+        in_flight = IN_FLIGHT_REQUESTS.get((provider, unique_key))
+        if in_flight is None:
+            in_flight = IN_FLIGHT_REQUESTS[(provider, unique_key)] = Future()
+            leader = True
+        else:
+            leader = False
+
+    if not leader:
+        with cache_lock:
+            CACHE_STATS[provider]["coalesced"] += 1
+        return in_flight.result(), "shared"
+
+    try:
+        data = None if CACHE_REFRESH else lookup_cache(provider, unique_key)
+        source = "cache"
+        if data is None:
+            data = fetch()
+            store_cache(provider, unique_key, data)
+            source = "api"
+        in_flight.set_result(data)
+        return data, source
+    except BaseException as error:
+        in_flight.set_exception(error)
+        raise
+    finally:
+        with in_flight_lock:
+            del IN_FLIGHT_REQUESTS[(provider, unique_key)]
+
+
+def make_google_request_using_cache(google_baseurl, search_term):
+    """
+    Check the Google cache for a saved result with this unique_key. 
+    If the result is found, return it. 
+    Otherwise send a new request, save it, then return it.
+    If another thread is already sending the same request, its
+    result is waited for and shared instead.
+    
+    Parameters
+    ----------
+    google_baseurl: string
+        The URL for the API endpoint
+    search_term:
+        The search term provided by user input.
+    
+    Returns
+    -------
+    google_data: dict
+        the results of the query as a dictionary loaded from
+        the cache database or the API
+    """
+    params = build_google_params(search_term)
+    google_unique_key = construct_unique_key_google(google_baseurl, params)
+
+    def fetch():
+        print("\nFetching from Google\n")
+        return fetch_google_data(google_baseurl, search_term)
+
+    google_data, source = request_once("google", google_unique_key, fetch)
+    if source == "cache":
+        print("\nUsing Google cache\n")
+    elif source == "shared":
+        print("\nUsing Google results fetched for another search\n")
+    return google_data
+
+
+def make_yelp_request_using_cache(yelp_baseurl, search_term, offset=0, limit=YELP_PAGE_SIZE):
+    """
+    Check the Yelp cache for a saved result with this unique_key. 
+    If the result is found, return it. 
+    Otherwise send a new request, save it, then return it.
+    If another thread is already sending the same request, its
+    result is waited for and shared instead.
+    
+    Parameters
+    ----------
+    yelp_baseurl: string
+        The URL for the API endpoint
+    search_term:
+        The search term provided by user input.
+    offset: int
+        The index of the first business to return.
+    limit: int
+        The number of businesses to return, at most 50.
+    
+    Returns
+    -------
+    yelp_data: dict
+        the results of the query as a dictionary loaded from
+        the cache database or the API
+    """
+    params = build_yelp_params(search_term, offset, limit)
+    yelp_unique_key = construct_unique_key_yelp(yelp_baseurl, params)
+
+    def fetch():
+        print("\nFetching from Yelp\n")
+        return fetch_yelp_data(yelp_baseurl, search_term, offset, limit)
+
+    yelp_data, source = request_once("yelp", yelp_unique_key, fetch)
+    if source == "cache":
+        print("\nUsing Yelp cache\n")
+    elif source == "shared":
+        print("\nUsing Yelp results fetched for another search\n")
+    return yelp_data
+
+
+def harvest_google_pages(google_baseurl, search_term, max_pages=GOOGLE_MAX_PAGES):
+    """
+    Follows Google's next_page_token through up to max_pages
+    pages of results and merges them into a single response,
+    which is cached as a whole: a page token is only valid for
+    the search that issued it, so later pages cannot be requested
+    on their own after the first page came from the cache.
+
+    Parameters
+    ----------
+    google_baseurl: string
+        The URL for the API endpoint
+    search_term: str or tuple
+        The "city, state" search term, or a (latitude,
+        longitude, radius in meters) area.
+    max_pages: int
+        The maximum number of pages to request.
+
+    Returns
+    -------
+    google_data: dict
+        The first page's response with "results" replaced by
+        the results of every page, without duplicate place_ids.
+
+    Raises
+    ------
+    ApiRequestError
+        If any page fails, so that a partial result is not cached.
+    """
+    params = build_google_params(search_term)
+    params["pages"] = max_pages
+    google_unique_key = construct_unique_key_google(google_baseurl, params)
+
+    def fetch():
+        print("\nFetching from Google\n")
+        page_data = fetch_google_data(google_baseurl, search_term)
+        pages = [page_data]
+        while len(pages) < max_pages and "next_page_token" in page_data:
+            page_data = fetch_google_data(google_baseurl, search_term, page_data["next_page_token"])
+            pages.append(page_data)
+
+        google_data = dict(pages[0])
+        google_data.pop("next_page_token", None)
+        google_data["results"] = merge_unique(pages, "results", "place_id")
+        return google_data
+
+    google_data, source = request_once("google", google_unique_key, fetch)
+    if source == "cache":
+        print("\nUsing Google cache\n")
+    elif source == "shared":
+        print("\nUsing Google results fetched for another search\n")
+    return google_data
+
+
+def harvest_yelp_pages(yelp_baseurl, search_term, max_results=YELP_MAX_RESULTS):
+    """
+    Requests the first page of Yelp results, then fetches the
+    remaining offsets concurrently up to the provider's result
+    cap, caching each page separately, and merges them into a
+    single response.
+
+    Parameters
+    ----------
+    yelp_baseurl: string
+        The URL for the API endpoint
+    search_term: str or tuple
+        The "city, state" search term, or a (latitude,
+        longitude, radius in meters) area.
+    max_results: int
+        The maximum number of businesses to request.
+
+    Returns
+    -------
+    yelp_data: dict
+        The first page's response with "businesses" replaced by
+        the businesses of every page, without duplicate ids.
+    """
+    first_page = make_yelp_request_using_cache(yelp_baseurl, search_term)
+    last_result = min(first_page.get("total", 0), max_results)
+    offsets = list(range(YELP_PAGE_SIZE, last_result, YELP_PAGE_SIZE))
+
+    with ThreadPoolExecutor(max_workers=YELP_PAGE_WORKERS) as executor:
+        later_pages = list(executor.map(
+            lambda offset: make_yelp_request_using_cache(yelp_baseurl, search_term, offset, min(YELP_PAGE_SIZE, last_result - offset)),
+            offsets))
+
+    yelp_data = dict(first_page)
+    yelp_data["businesses"] = merge_unique([first_page] + later_pages, "businesses", "id")
+    return yelp_data
+
+
+@timed_stage("fetch_city")
+def fetch_city_data(search_term, all_pages=None, tiled=None):
+    """
+    Fetches the Google and Yelp results for a search term at the
+    same time, so the wait is that of the slower provider rather
+    than the sum of both.
+
+    Parameters
+    ----------
+    search_term: str
+        The "city, state" search term.
+    all_pages: bool
+        Whether to harvest every page of results. Defaults to
+        HARVEST_ALL_PAGES.
+    tiled: bool
+        Whether to search the city cell by cell instead, see
+        harvest_city_tiles. Defaults to HARVEST_TILED.
+
+    Returns
+    -------
+    tuple
+        The Google response and the Yelp response, as dicts.
+    """
+    if tiled is None:
+        tiled = HARVEST_TILED
+    if tiled:
+        return harvest_city_tiles(search_term)
+    if all_pages is None:
+        all_pages = HARVEST_ALL_PAGES
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        if all_pages:
+            google_future = executor.submit(harvest_google_pages, google_baseurl, search_term)
+            yelp_future = executor.submit(harvest_yelp_pages, yelp_baseurl, search_term)
+        else:
+            google_future = executor.submit(make_google_request_using_cache, google_baseurl, search_term)
+            yelp_future = executor.submit(make_yelp_request_using_cache, yelp_baseurl, search_term)
+        return google_future.result(), yelp_future.result()
+
+
+def get_harvest_mode(all_pages=None, tiled=None):
+    """
+    Names the way fetch_city_data harvests a city with these
+    options, as recorded in Harvest_Log.
+
+    Parameters
+    ----------
+    all_pages: bool
+        Whether every page of results is harvested. Defaults to
+        HARVEST_ALL_PAGES.
+    tiled: bool
+        Whether the city is harvested tile by tile. Defaults to
+        HARVEST_TILED.
+
+    Returns
+    -------
+    str
+        The HARVEST_MODES key.
+    """
+    if tiled is None:
+        tiled = HARVEST_TILED
+    if all_pages is None:
+        all_pages = HARVEST_ALL_PAGES
+    if tiled:
+        return "tiled"
+    return "all_pages" if all_pages else "first_page"
+
+
+def merge_unique(pages, list_key, id_key):
+    """
+    Concatenates the result lists of several response pages,
+    keeping the first occurrence of each id.
+
+    Parameters
+    ----------
+    pages: list
+        The response dictionaries, in page order.
+    list_key: str
+        The key of the result list in each page.
+    id_key: str
+        The key identifying a result.
+
+    Returns
+    -------
+    list
+        The merged results.
+    """
+    merged = []
+    seen_ids = set()
+    for page_data in pages:
+        for item in page_data.get(list_key, []):
+            if item[id_key] not in seen_ids:
+                seen_ids.add(item[id_key])
+                merged.append(item)
+    return merged
+
+
+@timed_stage("geocode")
+def geocode_city(search_term):
+    """
+    Looks up the bounding box of a city with the Google Geocoding
+    API, through the response cache.
+
+    Parameters
+    ----------
+    search_term: str
+        The "city, state" search term.
+
+    Returns
+    -------
+    tuple
+        The (south, west, north, east) bounds, in degrees.
+
+    Raises
+    ------
+    ApiRequestError
+        If the request fails or the city cannot be located.
+    """
+    import google_secrets
+
+    params = {"address": search_term, "key": google_secrets.google_api_key}
+    unique_key = construct_unique_key_google(google_geocode_baseurl, params)
+    geocode_data, source = request_once("google", unique_key,
+                                        lambda: request_with_retries("google", google_geocode_baseurl, params))
+    results = geocode_data.get("results") or [{}]
+    geometry = results[0].get("geometry", {})
+    box = geometry.get("bounds") or geometry.get("viewport")
+    if box is None:
+        raise ApiRequestError(f"google could not locate {search_term}")
+    return box["southwest"]["lat"], box["southwest"]["lng"], box["northeast"]["lat"], box["northeast"]["lng"]
+
+
+def tile_dimensions(tile):
+    """
+    Approximates the size of a tile on the ground.
+
+    Parameters
+    ----------
+    tile: tuple
+        The (south, west, north, east) bounds, in degrees.
+
+    Returns
+    -------
+    tuple
+        The height and width in meters.
+    """
+    south, west, north, east = tile
+    height = math.radians(north - south) * EARTH_RADIUS_METERS
+    width = math.radians(east - west) * EARTH_RADIUS_METERS * math.cos(math.radians((south + north) / 2))
+    return height, width
+
+
+def split_into_tiles(bounds, rows=None, columns=None):
+    """
+    Cuts a bounding box into a grid of equal tiles, by default
+    about TILE_SIZE_METERS across.
+
+    Parameters
+    ----------
+    bounds: tuple
+        The (south, west, north, east) bounds, in degrees.
+    rows: int
+        The number of rows of tiles, if not from TILE_SIZE_METERS.
+    columns: int
+        The number of columns of tiles, if not from TILE_SIZE_METERS.
+
+    Returns
+    -------
+    list
+        The (south, west, north, east) tiles.
+    """
+    south, west, north, east = bounds
+    height, width = tile_dimensions(bounds)
+    if rows is None:
+        rows = max(1, math.ceil(height / TILE_SIZE_METERS))
+    if columns is None:
+        columns = max(1, math.ceil(width / TILE_SIZE_METERS))
+    latitude_step = (north - south) / rows
+    longitude_step = (east - west) / columns
+    return [(south + row * latitude_step, west + column * longitude_step,
+             south + (row + 1) * latitude_step, west + (column + 1) * longitude_step)
+            for row in range(rows) for column in range(columns)]
+
+
+def tile_search_area(tile):
+    """
+    Gives the smallest circle covering a tile, as searched by the
+    providers.
+
+    Parameters
+    ----------
+    tile: tuple
+        The (south, west, north, east) bounds, in degrees.
+
+    Returns
+    -------
+    tuple
+        The (latitude, longitude, radius in meters) area.
+    """
+    south, west, north, east = tile
+    height, width = tile_dimensions(tile)
+    return (south + north) / 2, (west + east) / 2, math.hypot(height, width) / 2
+
+
+def record_coordinates(provider, record):
+    """
+    Reads the location of a Google place or Yelp business.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    record: dict
+        The place or business from a response.
+
+    Returns
+    -------
+    tuple or None
+        The (latitude, longitude), or None if it is not given.
+    """
+    if provider == "google":
+        location = (record.get("geometry") or {}).get("location") or {}
+        latitude, longitude = location.get("lat"), location.get("lng")
+    else:
+        coordinates = record.get("coordinates") or {}
+        latitude, longitude = coordinates.get("latitude"), coordinates.get("longitude")
+    if latitude is None or longitude is None:
+        return None
+    return latitude, longitude
+
+
+def fetch_tile(provider, tile):
+    """
+    Searches one tile with every page of results.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    tile: tuple
+        The (south, west, north, east) bounds, in degrees.
+
+    Returns
+    -------
+    tuple
+        The places or businesses found, and whether there were as
+        many as the provider returns for one search, so there may
+        be more.
+    """
+    area = tile_search_area(tile)
+    with measure_stage(f"tile.{provider}"):
+        if provider == "google":
+            google_data = harvest_google_pages(google_nearby_baseurl, area)
+            return google_data["results"], len(google_data["results"]) >= GOOGLE_MAX_PAGES * GOOGLE_PAGE_SIZE
+        yelp_data = harvest_yelp_pages(yelp_baseurl, area)
+        return yelp_data["businesses"], yelp_data.get("total", 0) > YELP_MAX_RESULTS
+
+
+def harvest_tiles(provider, bounds):
+    """
+    Searches a bounding box tile by tile for one provider, several
+    tiles at a time, splitting any tile that reaches the result cap
+    into four smaller ones, up to TILE_MAX_DEPTH times.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    bounds: tuple
+        The (south, west, north, east) bounds, in degrees.
+
+    Returns
+    -------
+    list
+        The places or businesses inside the bounds, each once.
+    """
+    south, west, north, east = bounds
+    records = []
+    searched = 0
+    capped = 0
+    with ThreadPoolExecutor(max_workers=TILE_WORKERS) as executor:
+        pending = {executor.submit(fetch_tile, provider, tile): (tile, 0) for tile in split_into_tiles(bounds)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                tile, depth = pending.pop(future)
+                tile_records, saturated = future.result()
+                searched += 1
+                records.extend(tile_records)
+                if saturated and depth < TILE_MAX_DEPTH:
+                    for quarter in split_into_tiles(tile, 2, 2):
+                        pending[executor.submit(fetch_tile, provider, quarter)] = (quarter, depth + 1)
+                elif saturated:
+                    capped += 1
+
+    inside = []
+    for record in records:
+        coordinates = record_coordinates(provider, record)
+        if coordinates is None or (south <= coordinates[0] <= north and west <= coordinates[1] <= east):
+            inside.append(record)
+    list_key = CACHE_RECORD_LISTS[provider]
+    merged = merge_unique([{list_key: inside}], list_key, "place_id" if provider == "google" else "id")
+    print(f"\nSearched {searched} {provider.capitalize()} tiles: {len(merged)} restaurants\n")
+    if capped > 0:
+        print(f"\n[Note] {capped} of the smallest {provider.capitalize()} tiles still reached the result cap, "
+              f"so some restaurants there may be missing\n")
+    return merged
+
+
+def harvest_city_tiles(search_term):
+    """
+    Harvests a whole city rather than the top of one search: the
+    city's bounding box is searched tile by tile for both providers
+    at the same time.
+
+    Parameters
+    ----------
+    search_term: str
+        The "city, state" search term.
+
+    Returns
+    -------
+    tuple
+        A Google response with every place found in "results" and a
+        Yelp response with every business found in "businesses".
+    """
+    bounds = geocode_city(search_term)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        google_future = executor.submit(harvest_tiles, "google", bounds)
+        yelp_future = executor.submit(harvest_tiles, "yelp", bounds)
+        google_results = google_future.result()
+        yelp_businesses = yelp_future.result()
+    return {"results": google_results, "status": "OK"}, {"businesses": yelp_businesses, "total": len(yelp_businesses)}
+
+
+# Tables from before schema version 3, kept so old databases can be migrated.
+drop_google_rating_info = '''
+    DROP TABLE IF EXISTS "Google_Rating_Info";
+'''
+
+drop_google_price_info = '''
+    DROP TABLE IF EXISTS "Google_Price_Info";
+'''
+
+drop_yelp_rating_info = '''
+    DROP TABLE IF EXISTS "Yelp_Rating_Info";
+'''
+
+drop_yelp_price_info = '''
+    DROP TABLE IF EXISTS "Yelp_Price_Info";
+'''
+
+# One row per business and harvested city. Price levels are small integers
+# (Google 0-4, Yelp 1-4 for $ to $$$$), NULL when the provider gives none.
+create_google_place_info = '''
+    CREATE TABLE IF NOT EXISTS "Google_Place_Info" (
+        'place_id' TEXT NOT NULL,
+        'harvest_city' TEXT NOT NULL,
+        'harvest_state' TEXT NOT NULL,
+        'name' TEXT,
+        'formatted_address' TEXT,
+        'rating' REAL NOT NULL,
+        'user_ratings_total' INTEGER NOT NULL,
+        'price_level' INTEGER,
+        PRIMARY KEY (place_id, harvest_city, harvest_state)
+    ) WITHOUT ROWID;
+'''
+
+create_yelp_business_info = '''
+    CREATE TABLE IF NOT EXISTS "Yelp_Business_Info" (
+        'id' TEXT NOT NULL,
+        'harvest_city' TEXT NOT NULL,
+        'harvest_state' TEXT NOT NULL,
+        'alias' TEXT,
+        'name' TEXT,
+        'display_address' TEXT,
+        'phone' TEXT,
+        'rating' REAL NOT NULL,
+        'review_count' INTEGER NOT NULL,
+        'price_level' INTEGER,
+        PRIMARY KEY (id, harvest_city, harvest_state)
+    ) WITHOUT ROWID;
+'''
+
+# Covering indexes for the chart queries, which filter by city and state, group
+# by price level and read rating and review counts.
+create_google_place_index = '''
+    CREATE INDEX IF NOT EXISTS "Google_Place_By_City"
+    ON Google_Place_Info (harvest_city, harvest_state, price_level, rating, user_ratings_total);
+'''
+
+create_yelp_business_index = '''
+    CREATE INDEX IF NOT EXISTS "Yelp_Business_By_City"
+    ON Yelp_Business_Info (harvest_city, harvest_state, price_level, rating, review_count);
+'''
+
+# Upserts: a re-harvested business only has its row rewritten if a value changed.
+insert_google_place_info = '''
+    INSERT INTO Google_Place_Info (place_id, harvest_city, harvest_state, name, formatted_address, rating, user_ratings_total, price_level)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (place_id, harvest_city, harvest_state) DO UPDATE SET
+        name = excluded.name,
+        formatted_address = excluded.formatted_address,
+        rating = excluded.rating,
+        user_ratings_total = excluded.user_ratings_total,
+        price_level = excluded.price_level
+    WHERE name IS NOT excluded.name
+        OR formatted_address IS NOT excluded.formatted_address
+        OR rating IS NOT excluded.rating
+        OR user_ratings_total IS NOT excluded.user_ratings_total
+        OR price_level IS NOT excluded.price_level
+'''
+
+insert_yelp_business_info = '''
+    INSERT INTO Yelp_Business_Info (id, harvest_city, harvest_state, alias, name, display_address, phone, rating, review_count, price_level)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (id, harvest_city, harvest_state) DO UPDATE SET
+        alias = excluded.alias,
+        name = excluded.name,
+        display_address = excluded.display_address,
+        phone = excluded.phone,
+        rating = excluded.rating,
+        review_count = excluded.review_count,
+        price_level = excluded.price_level
+    WHERE alias IS NOT excluded.alias
+        OR name IS NOT excluded.name
+        OR display_address IS NOT excluded.display_address
+        OR phone IS NOT excluded.phone
+        OR rating IS NOT excluded.rating
+        OR review_count IS NOT excluded.review_count
+        OR price_level IS NOT excluded.price_level
+'''
+
+# Schema version 2 indexes on the pre-version-3 tables.
+create_legacy_indexes = [
+    'CREATE INDEX IF NOT EXISTS "Google_Price_By_City" ON Google_Price_Info (harvest_city, harvest_state, price_level, place_id);',
+    'CREATE INDEX IF NOT EXISTS "Google_Rating_Covering" ON Google_Rating_Info (place_id, harvest_city, harvest_state, rating, user_ratings_total);',
+    'CREATE INDEX IF NOT EXISTS "Yelp_Price_By_City" ON Yelp_Price_Info (harvest_city, harvest_state, price, id);',
+    'CREATE INDEX IF NOT EXISTS "Yelp_Rating_Covering" ON Yelp_Rating_Info (id, harvest_city, harvest_state, rating, review_count);',
+]
+
+# Schema version 3: fold each provider's rating and price tables into one typed table.
+copy_google_tables_to_place_info = '''
+    INSERT OR IGNORE INTO Google_Place_Info
+    SELECT rating_i.place_id, rating_i.harvest_city, rating_i.harvest_state, rating_i.name, rating_i.formatted_address,
+        rating_i.rating, rating_i.user_ratings_total,
+        CASE WHEN price_i.price_level IN ('0', '1', '2', '3', '4') THEN CAST(price_i.price_level AS INTEGER) END
+    FROM Google_Rating_Info AS rating_i
+    LEFT JOIN Google_Price_Info AS price_i
+    ON price_i.place_id = rating_i.place_id
+        AND price_i.harvest_city = rating_i.harvest_city
+        AND price_i.harvest_state = rating_i.harvest_state
+    WHERE typeof(rating_i.rating) IN ('real', 'integer')
+'''
+
+copy_yelp_tables_to_business_info = '''
+    INSERT OR IGNORE INTO Yelp_Business_Info
+    SELECT rating_i.id, rating_i.harvest_city, rating_i.harvest_state, rating_i.alias, rating_i.name, rating_i.display_address,
+        price_i.phone, rating_i.rating,
+        CASE WHEN rating_i.review_count GLOB '[0-9]*' THEN CAST(rating_i.review_count AS INTEGER) ELSE 0 END,
+        CASE WHEN price_i.price IN ('$', '$$', '$$$', '$$$$') THEN LENGTH(price_i.price) END
+    FROM Yelp_Rating_Info AS rating_i
+    LEFT JOIN Yelp_Price_Info AS price_i
+    ON price_i.id = rating_i.id
+        AND price_i.harvest_city = rating_i.harvest_city
+        AND price_i.harvest_state = rating_i.harvest_state
+    WHERE typeof(rating_i.rating) IN ('real', 'integer')
+'''
+
+# Running totals per (provider, city, state, price level), kept up to date by the
+# triggers below whenever a business row is inserted, updated or deleted.
+create_price_level_rollup = '''
+    CREATE TABLE IF NOT EXISTS "Price_Level_Rollup" (
+        'provider' TEXT NOT NULL,
+        'harvest_city' TEXT NOT NULL,
+        'harvest_state' TEXT NOT NULL,
+        'price_level' INTEGER NOT NULL,
+        'item_count' INTEGER NOT NULL,
+        'rating_sum' REAL NOT NULL,
+        'rating_sum_sq' REAL NOT NULL,
+        'reviews_sum' INTEGER NOT NULL,
+        'reviews_sum_sq' INTEGER NOT NULL,
+        PRIMARY KEY (provider, harvest_city, harvest_state, price_level)
+    ) WITHOUT ROWID;
+'''
+
+add_new_row_to_rollup = '''
+        INSERT INTO Price_Level_Rollup
+        VALUES ('{provider}', NEW.harvest_city, NEW.harvest_state, NEW.price_level, 1,
+            NEW.rating, NEW.rating * NEW.rating, NEW.{reviews_column}, NEW.{reviews_column} * NEW.{reviews_column})
+        ON CONFLICT (provider, harvest_city, harvest_state, price_level) DO UPDATE SET
+            item_count = item_count + 1,
+            rating_sum = rating_sum + excluded.rating_sum,
+            rating_sum_sq = rating_sum_sq + excluded.rating_sum_sq,
+            reviews_sum = reviews_sum + excluded.reviews_sum,
+            reviews_sum_sq = reviews_sum_sq + excluded.reviews_sum_sq;
+'''
+
+remove_old_row_from_rollup = '''
+        UPDATE Price_Level_Rollup SET
+            item_count = item_count - 1,
+            rating_sum = rating_sum - OLD.rating,
+            rating_sum_sq = rating_sum_sq - OLD.rating * OLD.rating,
+            reviews_sum = reviews_sum - OLD.{reviews_column},
+            reviews_sum_sq = reviews_sum_sq - OLD.{reviews_column} * OLD.{reviews_column}
+        WHERE provider = '{provider}' AND harvest_city = OLD.harvest_city
+            AND harvest_state = OLD.harvest_state AND price_level = OLD.price_level;
+        DELETE FROM Price_Level_Rollup
+        WHERE provider = '{provider}' AND harvest_city = OLD.harvest_city
+            AND harvest_state = OLD.harvest_state AND price_level = OLD.price_level AND item_count <= 0;
+'''
+
+create_rollup_triggers = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS "{table}_Rollup_Insert"
+    AFTER INSERT ON {table}
+    WHEN NEW.price_level IS NOT NULL
+    BEGIN
+    ''' + add_new_row_to_rollup + '''
+    END;
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS "{table}_Rollup_Delete"
+    AFTER DELETE ON {table}
+    WHEN OLD.price_level IS NOT NULL
+    BEGIN
+    ''' + remove_old_row_from_rollup + '''
+    END;
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS "{table}_Rollup_Update_Remove"
+    AFTER UPDATE OF rating, {reviews_column}, price_level ON {table}
+    WHEN OLD.price_level IS NOT NULL
+    BEGIN
+    ''' + remove_old_row_from_rollup + '''
+    END;
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS "{table}_Rollup_Update_Add"
+    AFTER UPDATE OF rating, {reviews_column}, price_level ON {table}
+    WHEN NEW.price_level IS NOT NULL
+    BEGIN
+    ''' + add_new_row_to_rollup + '''
+    END;
+    ''',
+]
+
+delete_price_level_rollup = '''
+    DELETE FROM Price_Level_Rollup
+    WHERE provider = '{provider}'
+'''
+
+backfill_price_level_rollup = '''
+    INSERT INTO Price_Level_Rollup
+    SELECT '{provider}', harvest_city, harvest_state, price_level, COUNT(*),
+        SUM(rating), SUM(rating * rating), SUM({reviews_column}), SUM({reviews_column} * {reviews_column})
+    FROM {table}
+    WHERE price_level IS NOT NULL
+    GROUP BY harvest_city, harvest_state, price_level
+'''
+
+# Google places and Yelp businesses found to be the same restaurant in a harvested city.
+create_google_yelp_link = '''
+    CREATE TABLE IF NOT EXISTS "Google_Yelp_Link" (
+        'place_id' TEXT NOT NULL,
+        'yelp_id' TEXT NOT NULL,
+        'harvest_city' TEXT NOT NULL,
+        'harvest_state' TEXT NOT NULL,
+        'match_score' REAL NOT NULL,
+        PRIMARY KEY (place_id, harvest_city, harvest_state),
+        UNIQUE (yelp_id, harvest_city, harvest_state)
+    ) WITHOUT ROWID;
+'''
+
+select_google_businesses_for_matching = '''
+    SELECT place_id, name, formatted_address
+    FROM Google_Place_Info
+    WHERE harvest_city = ? AND harvest_state = ?
+'''
+
+select_yelp_businesses_for_matching = '''
+    SELECT id, name, display_address
+    FROM Yelp_Business_Info
+    WHERE harvest_city = ? AND harvest_state = ?
+'''
+
+delete_city_links = '''
+    DELETE FROM Google_Yelp_Link
+    WHERE harvest_city = ? AND harvest_state = ?
+'''
+
+insert_google_yelp_link = '''
+    INSERT INTO Google_Yelp_Link
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+select_matched_businesses = '''
+    SELECT google_i.name, google_i.rating, yelp_i.rating, google_i.user_ratings_total, yelp_i.review_count,
+        google_i.price_level, yelp_i.price_level, link_i.match_score
+    FROM Google_Yelp_Link AS link_i
+    JOIN Google_Place_Info AS google_i
+    ON google_i.place_id = link_i.place_id
+        AND google_i.harvest_city = link_i.harvest_city
+        AND google_i.harvest_state = link_i.harvest_state
+    JOIN Yelp_Business_Info AS yelp_i
+    ON yelp_i.id = link_i.yelp_id
+        AND yelp_i.harvest_city = link_i.harvest_city
+        AND yelp_i.harvest_state = link_i.harvest_state
+    {where_clause}
+'''
+
+select_business_export = '''
+    SELECT *
+    FROM {table} AS business_i
+    {where_clause}
+'''
+
+select_harvested_cities = '''
+    SELECT DISTINCT harvest_city, harvest_state
+    FROM Price_Level_Rollup
+    ORDER BY harvest_state, harvest_city
+'''
+
+select_table_names = '''
+    SELECT name
+    FROM sqlite_master
+    WHERE type = 'table'
+'''
+
+# When each city was last harvested, in seconds since the epoch.
+create_harvest_log = '''
+    CREATE TABLE IF NOT EXISTS "Harvest_Log" (
+        'harvest_city' TEXT NOT NULL,
+        'harvest_state' TEXT NOT NULL,
+        'harvested_at' REAL NOT NULL,
+        'harvest_mode' TEXT NOT NULL DEFAULT 'unknown',
+        PRIMARY KEY (harvest_city, harvest_state)
+    ) WITHOUT ROWID;
+'''
+
+add_harvest_log_mode_column = '''
+    ALTER TABLE Harvest_Log ADD COLUMN 'harvest_mode' TEXT NOT NULL DEFAULT 'unknown'
+'''
+
+select_harvest_log_columns = '''
+    PRAGMA table_info(Harvest_Log)
+'''
+
+upsert_harvest_log = '''
+    INSERT INTO Harvest_Log
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (harvest_city, harvest_state) DO UPDATE SET
+        harvested_at = excluded.harvested_at,
+        harvest_mode = excluded.harvest_mode
+'''
+
+select_harvest_mode = '''
+    SELECT harvest_mode
+    FROM Harvest_Log
+    WHERE harvest_city = ? AND harvest_state = ?
+'''
+
+select_stale_cities = '''
+    SELECT harvest_city, harvest_state
+    FROM Harvest_Log
+    WHERE harvested_at < ?
+    ORDER BY harvested_at
+'''
+
+backfill_harvest_log = '''
+    INSERT OR IGNORE INTO Harvest_Log
+    SELECT DISTINCT harvest_city, harvest_state, 0, 'unknown'
+    FROM {table}
+'''
+
+# The rating, review count and price level of each business as first stored and
+# after every harvest that changed one of them, stamped with that harvest's time,
+# plus a 'removed' row when a refresh no longer finds the business.
+# Unchanged businesses add no rows, so the table grows with the amount of change,
+# not with the number of harvests. Written by the triggers below.
+create_business_history = '''
+    CREATE TABLE IF NOT EXISTS "Business_History" (
+        'provider' TEXT NOT NULL,
+        'harvest_city' TEXT NOT NULL,
+        'harvest_state' TEXT NOT NULL,
+        'business_id' TEXT NOT NULL,
+        'observed_at' REAL NOT NULL,
+        'rating' REAL NOT NULL,
+        'reviews' INTEGER NOT NULL,
+        'price_level' INTEGER,
+        'removed' INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (provider, harvest_city, harvest_state, business_id, observed_at)
+    ) WITHOUT ROWID;
+'''
+
+create_business_history_index = '''
+    CREATE INDEX IF NOT EXISTS "Business_History_By_Business"
+    ON Business_History (provider, business_id, observed_at);
+'''
+
+add_new_row_to_history = '''
+        INSERT OR REPLACE INTO Business_History
+        VALUES ('{provider}', NEW.harvest_city, NEW.harvest_state, NEW.{id_column},
+            COALESCE((SELECT harvested_at FROM Harvest_Log
+                      WHERE harvest_city = NEW.harvest_city AND harvest_state = NEW.harvest_state),
+                     (julianday('now') - 2440587.5) * 86400.0),
+            NEW.rating, NEW.{reviews_column}, NEW.price_level, 0);
+'''
+
+add_removed_row_to_history = '''
+        INSERT OR REPLACE INTO Business_History
+        VALUES ('{provider}', OLD.harvest_city, OLD.harvest_state, OLD.{id_column},
+            COALESCE((SELECT harvested_at FROM Harvest_Log
+                      WHERE harvest_city = OLD.harvest_city AND harvest_state = OLD.harvest_state),
+                     (julianday('now') - 2440587.5) * 86400.0),
+            OLD.rating, OLD.{reviews_column}, OLD.price_level, 1);
+'''
+
+create_history_triggers = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS "{table}_History_Insert"
+    AFTER INSERT ON {table}
+    BEGIN
+    ''' + add_new_row_to_history + '''
+    END;
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS "{table}_History_Update"
+    AFTER UPDATE OF rating, {reviews_column}, price_level ON {table}
+    WHEN OLD.rating IS NOT NEW.rating
+        OR OLD.{reviews_column} IS NOT NEW.{reviews_column}
+        OR OLD.price_level IS NOT NEW.price_level
+    BEGIN
+    ''' + add_new_row_to_history + '''
+    END;
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS "{table}_History_Delete"
+    AFTER DELETE ON {table}
+    BEGIN
+    ''' + add_removed_row_to_history + '''
+    END;
+    ''',
+]
+
+drop_history_triggers = [
+    'DROP TRIGGER IF EXISTS "{table}_History_Insert"',
+    'DROP TRIGGER IF EXISTS "{table}_History_Update"',
+    'DROP TRIGGER IF EXISTS "{table}_History_Delete"',
+]
+
+add_business_history_removed_column = '''
+    ALTER TABLE Business_History ADD COLUMN 'removed' INTEGER NOT NULL DEFAULT 0
+'''
+
+select_business_history_columns = '''
+    PRAGMA table_info(Business_History)
+'''
+
+# The businesses a refresh no longer found in a city (the ids it did find are a JSON list).
+delete_missing_businesses = '''
+    DELETE FROM {table}
+    WHERE harvest_city = ? AND harvest_state = ?
+        AND {id_column} NOT IN (SELECT value FROM json_each(?))
+'''
+
+backfill_business_history = '''
+    INSERT OR IGNORE INTO Business_History
+    SELECT '{provider}', harvest_city, harvest_state, {id_column}, ?, rating, {reviews_column}, price_level, 0
+    FROM {table}
+'''
+
+# Each business's latest history row at or before a time, summed by price level,
+# leaving out businesses whose latest row records their removal.
+select_price_levels_as_of = '''
+    SELECT history_i.price_level, COUNT(*), SUM(history_i.{column}), SUM(history_i.{column} * history_i.{column})
+    FROM Business_History AS history_i
+    {where_clause}
+        AND history_i.price_level IS NOT NULL
+        AND history_i.removed = 0
+        AND history_i.observed_at = (
+            SELECT MAX(latest_i.observed_at)
+            FROM Business_History AS latest_i
+            WHERE latest_i.provider = history_i.provider
+                AND latest_i.harvest_city = history_i.harvest_city
+                AND latest_i.harvest_state = history_i.harvest_state
+                AND latest_i.business_id = history_i.business_id
+                AND latest_i.observed_at <= ?)
+    GROUP BY history_i.price_level
+'''
+
+select_city_history = '''
+    SELECT business_id, observed_at, rating, reviews, price_level, removed
+    FROM Business_History
+    WHERE provider = ? AND harvest_city = ? AND harvest_state = ?
+    ORDER BY observed_at
+'''
+
+select_business_history = '''
+    SELECT harvest_city, harvest_state, observed_at, rating, reviews, price_level, removed
+    FROM Business_History
+    WHERE provider = ? AND business_id = ?
+    ORDER BY observed_at
+'''
+
+count_harvest_changes = '''
+    SELECT COUNT(*)
+    FROM Business_History AS history_i
+    JOIN Harvest_Log AS log_i
+    ON log_i.harvest_city = history_i.harvest_city
+        AND log_i.harvest_state = history_i.harvest_state
+    WHERE history_i.provider = ? AND history_i.harvest_city = ? AND history_i.harvest_state = ?
+        AND history_i.observed_at = log_i.harvested_at
+'''
+
+# Bumped whenever the harvest schema changes. Each DATABASE_MIGRATIONS entry is
+# (version, function) and upgrades a database from the previous version.
+SCHEMA_VERSION = 8
+
+aggregate_by_price_level_query = '''
+    SELECT price_level, SUM(item_count), SUM({sum_column}), SUM({sum_sq_column})
+    FROM Price_Level_Rollup AS rollup_i
+    {where_clause}
+    GROUP BY price_level
+'''
+
+# Where each provider keeps its businesses, and how its price levels are labelled.
+AGGREGATE_SOURCES = {
+    "google": {
+        "table": "Google_Place_Info",
+        "id_column": "place_id",
+        "price_levels": [(0, '0'), (1, '1'), (2, '2'), (3, '3'), (4, '4')],
+        "metrics": {"rating": "rating", "number_of_ratings": "user_ratings_total"},
+        "reviews_column": "user_ratings_total",
+    },
+    "yelp": {
+        "table": "Yelp_Business_Info",
+        "id_column": "id",
+        "price_levels": [(1, '$'), (2, '$$'), (3, '$$$'), (4, '$$$$')],
+        "metrics": {"rating": "rating", "number_of_ratings": "review_count"},
+        "reviews_column": "review_count",
+    },
+}
+
+# Metric -> its running sum and sum-of-squares columns in Price_Level_Rollup.
+ROLLUP_COLUMNS = {"rating": ("rating_sum", "rating_sum_sq"), "number_of_ratings": ("reviews_sum", "reviews_sum_sq")}
+
+# Metric -> its column in Business_History.
+HISTORY_COLUMNS = {"rating": "rating", "number_of_ratings": "reviews"}
+
+select_statistics_columns = '''
+    SELECT price_level, rating, {reviews_column}
+    FROM {table} AS business_i
+    {where_clause}
+'''
+
+# Price level statistics: the percentiles reported, the z-score of the
+# confidence interval around each mean (1.96 for 95%), and the number of
+# reviews the Bayesian rating weighs the overall mean as (None uses the
+# median review count of the selection).
+STATISTICS_PERCENTILES = [10, 25, 50, 75, 90]
+CONFIDENCE_Z = 1.96
+BAYESIAN_PRIOR_REVIEWS = None
+
+# Cross-provider matching. Names and addresses are normalized, then only
+# businesses sharing a blocking key (house number + street, or first name word)
+# are compared; blocks bigger than MATCH_MAX_BLOCK_SIZE on either side are skipped.
+NAME_STOPWORDS = {"the", "a", "an", "and", "of", "restaurant"}
+STREET_ABBREVIATIONS = {"street": "st", "avenue": "ave", "av": "ave", "road": "rd", "boulevard": "blvd",
+                        "drive": "dr", "lane": "ln", "court": "ct", "place": "pl", "highway": "hwy",
+                        "parkway": "pkwy", "suite": "ste", "north": "n", "south": "s", "east": "e", "west": "w"}
+STREET_DIRECTIONS = {"n", "s", "e", "w", "ne", "nw", "se", "sw"}
+MATCH_THRESHOLD = 0.75
+MATCH_MAX_BLOCK_SIZE = 50
+MATCH_AFTER_INGEST = True
+
+# Menu input -> metric name, and the chart labels for each provider and metric.
+CHART_METRICS = {"average rating": "rating", "average number of ratings": "number_of_ratings"}
+
+CHART_LABELS = {
+    ("google", "rating"): ("Average Google Ratings by Price Level for Restaurants in {search_term}",
+                           "Price Level from Least to Most Expensive (0 [free] to 4)",
+                           "Average Google Rating (1 = lowest, 5 = highest)"),
+    ("yelp", "rating"): ("Average Yelp Ratings by Price Level for Restaurants in {search_term}",
+                         "Price Level from Least to Most Expensive ($ to $$$$)",
+                         "Average Yelp Rating (1 = lowest, 5 = highest)"),
+    ("google", "number_of_ratings"): ("Average Number of Google User Ratings by Price Level for Restaurants in {search_term}",
+                                      "Price Level from Least to Most Expensive (0 [free] to 4)",
+                                      "Average Number of Google User Ratings"),
+    ("yelp", "number_of_ratings"): ("Average Number of Yelp User Ratings by Price Level for Restaurants in {search_term}",
+                                    "Price Level from Least to Most Expensive ($ to $$$$)",
+                                    "Average Number of Yelp User Ratings"),
+}
+
+# The four price level views of a dashboard, one column each, with their short subplot titles.
+DASHBOARD_VIEWS = [("google", "rating"), ("yelp", "rating"), ("google", "number_of_ratings"), ("yelp", "number_of_ratings")]
+DASHBOARD_VIEW_TITLES = {
+    ("google", "rating"): "Average Google Rating",
+    ("yelp", "rating"): "Average Yelp Rating",
+    ("google", "number_of_ratings"): "Average Number of Google Ratings",
+    ("yelp", "number_of_ratings"): "Average Number of Yelp Ratings",
+}
+DASHBOARD_ROW_HEIGHT = 320
+DASHBOARD_INDEX_FILE_NAME = "index.html"
+
+# Local HTTP query service. Reads run on a pool of read-only connections and
+# answers are kept in memory for SERVICE_CACHE_TTL_SECONDS (cleared by a harvest),
+# up to SERVICE_CACHE_MAX_ENTRIES answers and SERVICE_CACHE_MAX_BYTES of bodies.
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8507
+SERVICE_READ_CONNECTIONS = 4
+SERVICE_CACHE_TTL_SECONDS = 60
+SERVICE_CACHE_MAX_ENTRIES = 1000
+SERVICE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+SERVICE_STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                       500: "Internal Server Error", 502: "Bad Gateway"}
+
+
+def get_connection():
+    """
+    Returns the connection to harvested_data.sqlite, opening it
+    on first use so commands that never touch the database do
+    not open it.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    sqlite3.Connection
+        The shared connection.
+    """
+    global conn
+    with connection_lock:
+        if conn is None:
+            conn = sqlite3.connect(DATABASE_FILE_NAME, check_same_thread=False, cached_statements=256)
+        return conn
+
+
+@contextmanager
+def read_cursor(connection=None):
+    """
+    Yields a cursor for a read query. Without a connection, uses
+    the shared connection and holds db_lock while the query runs;
+    a dedicated connection, such as one of the query service's
+    read-only connections, is used without the lock.
+
+    Parameters
+    ----------
+    connection: sqlite3.Connection
+        The connection to read from, or None for the shared one.
+
+    Returns
+    -------
+    sqlite3.Cursor
+        The cursor, valid inside the with block.
+    """
+    if connection is not None:
+        yield connection.cursor()
+        return
+    cur = get_connection().cursor()
+    with db_lock:
+        yield cur
+
+
+def create_tables():
+    """
+    Creates the Google and Yelp tables if they do not exist yet,
+    and brings an existing database up to SCHEMA_VERSION.
+    Tables from before harvest cities were recorded only ever
+    held the last search, so they are dropped and rebuilt empty.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    with db_lock:
+        cur.execute("PRAGMA user_version")
+        version = cur.fetchone()[0]
+        if version == 0:
+            cur.execute(drop_google_price_info)
+            cur.execute(drop_google_rating_info)
+            cur.execute(drop_yelp_price_info)
+            cur.execute(drop_yelp_rating_info)
+
+        cur.execute(select_table_names)
+        table_names = [row[0] for row in cur.fetchall()]
+        if "Google_Rating_Info" not in table_names and "Google_Place_Info" not in table_names:
+            version = SCHEMA_VERSION
+
+        for migration_version, migration in DATABASE_MIGRATIONS:
+            if version < migration_version:
+                migration()
+
+        cur.execute(create_google_place_info)
+        cur.execute(create_yelp_business_info)
+        cur.execute(create_google_place_index)
+        cur.execute(create_yelp_business_index)
+        create_price_level_rollup_table()
+        cur.execute(create_google_yelp_link)
+        create_history_tables()
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+
+
+def migrate_to_indexed_schema():
+    """
+    Schema version 2: adds the chart query indexes to an existing
+    database and refreshes the query planner's statistics.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    cur = get_connection().cursor()
+    for create_index in create_legacy_indexes:
+        cur.execute(create_index)
+    cur.execute("ANALYZE")
+
+
+def migrate_to_compact_schema():
+    """
+    Schema version 3: copies each provider's rating and price
+    tables into a single table with one typed row per business,
+    then drops the old tables.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    cur = get_connection().cursor()
+    cur.execute(create_google_place_info)
+    cur.execute(create_yelp_business_info)
+    cur.execute(copy_google_tables_to_place_info)
+    cur.execute(copy_yelp_tables_to_business_info)
+    cur.execute(drop_google_price_info)
+    cur.execute(drop_google_rating_info)
+    cur.execute(drop_yelp_price_info)
+    cur.execute(drop_yelp_rating_info)
+
+
+def create_price_level_rollup_table():
+    """
+    Creates the Price_Level_Rollup table and the triggers that
+    keep it in step with the business tables, if they do not
+    exist yet. Callers must hold db_lock.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    cur = get_connection().cursor()
+    cur.execute(create_price_level_rollup)
+    for provider, source in AGGREGATE_SOURCES.items():
+        for create_trigger in create_rollup_triggers:
+            cur.execute(create_trigger.format(provider=provider, **source))
+
+
+def rebuild_price_level_rollup():
+    """
+    Recomputes Price_Level_Rollup from the business tables.
+    Only needed for databases harvested before the rollup
+    existed, since the triggers keep it current afterwards.
+    Callers must hold db_lock.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    cur = get_connection().cursor()
+    for provider, source in AGGREGATE_SOURCES.items():
+        cur.execute(delete_price_level_rollup.format(provider=provider))
+        cur.execute(backfill_price_level_rollup.format(provider=provider, **source))
+
+
+def migrate_to_rollup_schema():
+    """
+    Schema version 4: adds the price level rollup table and its
+    triggers, then fills it from the businesses already stored.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    create_price_level_rollup_table()
+    rebuild_price_level_rollup()
+
+
+def create_history_tables():
+    """
+    Creates the Harvest_Log and Business_History tables and the
+    triggers that record business changes, if they do not exist
+    yet. Callers must hold db_lock.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    cur = get_connection().cursor()
+    cur.execute(create_harvest_log)
+    cur.execute(create_business_history)
+    cur.execute(create_business_history_index)
+    for provider, source in AGGREGATE_SOURCES.items():
+        for create_trigger in create_history_triggers:
+            cur.execute(create_trigger.format(provider=provider, **source))
+
+
+def migrate_to_history_schema():
+    """
+    Schema version 6: adds the harvest log and business history
+    with its triggers. The businesses already stored become the
+    first history rows, as of the migration, and their cities are
+    logged as never harvested so the next refresh includes them.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    create_history_tables()
+    cur = get_connection().cursor()
+    now = time.time()
+    for provider, source in AGGREGATE_SOURCES.items():
+        cur.execute(backfill_harvest_log.format(**source))
+        cur.execute(backfill_business_history.format(provider=provider, **source), [now])
+
+
+def migrate_to_removal_history():
+    """
+    Schema version 7: adds the 'removed' column to Business_History
+    and recreates the history triggers, adding the one that records
+    a business deleted by a refresh.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    cur = get_connection().cursor()
+    cur.execute(select_business_history_columns)
+    if "removed" not in [row[1] for row in cur.fetchall()]:
+        cur.execute(add_business_history_removed_column)
+    for source in AGGREGATE_SOURCES.values():
+        for drop_trigger in drop_history_triggers:
+            cur.execute(drop_trigger.format(**source))
+    create_history_tables()
+
+
+def migrate_to_harvest_mode_log():
+    """
+    Schema version 8: adds the 'harvest_mode' column to Harvest_Log.
+    Cities already logged get the mode "unknown", so a refresh does
+    not remove their businesses until it knows how they were
+    harvested.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    cur = get_connection().cursor()
+    cur.execute(select_harvest_log_columns)
+    if "harvest_mode" not in [row[1] for row in cur.fetchall()]:
+        cur.execute(add_harvest_log_mode_column)
+
+
+DATABASE_MIGRATIONS = [
+    (2, migrate_to_indexed_schema),
+    (3, migrate_to_compact_schema),
+    (4, migrate_to_rollup_schema),
+    (6, migrate_to_history_schema),
+    (7, migrate_to_removal_history),
+    (8, migrate_to_harvest_mode_log),
+]
+
+
+def build_google_rows(google_data, harvest_city, harvest_state):
+    """
+    Turns a Google response into rows for the Google_Place_Info
+    table. Places without a rating are left out.
+
+    Parameters
+    ----------
+    google_data: dict
+        A Google Text Search response.
+    harvest_city: str
+        The city that was searched.
+    harvest_state: str
+        The state that was searched.
+
+    Returns
+    -------
+    list
+        The rows, one per place.
+    """
+    google_rows = []
+
+    for result in google_data["results"]:
+        rating = result.get("rating")
+        if rating is None:
+            continue
+        place_id = result["place_id"]
+        name = result["name"]
+        formatted_address = result.get("formatted_address", result.get("vicinity", "N/A"))
+        user_ratings_total = result.get("user_ratings_total", 0)
+        price_level = result.get("price_level")
+        google_rows.append([place_id, harvest_city, harvest_state, name, formatted_address, rating, user_ratings_total, price_level])
+
+    return google_rows
+
+
+def build_yelp_rows(yelp_data, harvest_city, harvest_state):
+    """
+    Turns a Yelp response into rows for the Yelp_Business_Info
+    table, storing the "$" to "$$$$" price as 1 to 4. Businesses
+    without a rating are left out.
+
+    Parameters
+    ----------
+    yelp_data: dict
+        A Yelp Business Search response.
+    harvest_city: str
+        The city that was searched.
+    harvest_state: str
+        The state that was searched.
+
+    Returns
+    -------
+    list
+        The rows, one per business.
+    """
+    yelp_rows = []
+
+    for business in yelp_data["businesses"]:
+        rating = business.get("rating")
+        if rating is None:
+            continue
+        id_string = business["id"]
+        alias = business["alias"]
+        name = business["name"]
+        try:
+            display_address = str(business["location"]["display_address"][0]) + " " + str(business["location"]["display_address"][1])
+        except:
+            display_address = "N/A"
+        review_count = business.get("review_count", 0)
+        phone = business.get("phone", "N/A")
+        price = business.get("price")
+        if price in ('$', '$$', '$$$', '$$$$'):
+            price_level = len(price)
+        else:
+            price_level = None
+        yelp_rows.append([id_string, harvest_city, harvest_state, alias, name, display_address, phone, rating, review_count, price_level])
+
+    return yelp_rows
+
+
+@timed_stage("ingest")
+def ingest_city_data(google_data, yelp_data, harvest_city, harvest_state, verbose=None, progress=None,
+                     remove_missing=False, harvest_mode=None):
+    """
+    Upserts the Google and Yelp results for one city into
+    the database with executemany, all in one transaction, so
+    a failed ingest leaves no partial city behind. Rows already
+    stored for the city are only rewritten if they changed, and
+    the harvest time is logged so that new ratings, review counts
+    and price levels are added to Business_History under it.
+
+    Parameters
+    ----------
+    google_data: dict
+        A Google Text Search response.
+    yelp_data: dict
+        A Yelp Business Search response.
+    harvest_city: str
+        The city that was searched.
+    harvest_state: str
+        The state that was searched.
+    verbose: bool
+        Print an "Inserting ..." line per row. Defaults to
+        VERBOSE_INGEST.
+    progress: bool
+        Show a progress bar per table. Defaults to
+        INGEST_PROGRESS.
+    remove_missing: bool
+        Delete the city's stored businesses that are not in this
+        harvest, recording their removal in Business_History. A
+        provider that returned no businesses is left alone.
+    harvest_mode: str
+        How the data was harvested, logged for later refreshes: a
+        HARVEST_MODES key or "unknown". Defaults to
+        get_harvest_mode().
+
+    Returns
+    -------
+    int
+        The number of rows inserted.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    if verbose is None:
+        verbose = VERBOSE_INGEST
+    if progress is None:
+        progress = INGEST_PROGRESS
+    if harvest_mode is None:
+        harvest_mode = get_harvest_mode()
+
+    # (statement, rows, index of the name column, provider)
+    batches = [
+        (insert_google_place_info, build_google_rows(google_data, harvest_city, harvest_state), 3, "google"),
+        (insert_yelp_business_info, build_yelp_rows(yelp_data, harvest_city, harvest_state), 4, "yelp"),
+    ]
+
+    inserted = 0
+    with db_lock:
+        try:
+            cur.execute("BEGIN")
+            cur.execute(upsert_harvest_log, [harvest_city, harvest_state, time.time(), harvest_mode])
+            for statement, rows, name_index, provider in batches:
+                label = AGGREGATE_SOURCES[provider]["table"]
+                if verbose:
+                    for row in rows:
+                        print("\n Inserting " + str(row[name_index]) + " ...\n")
+                for start in range(0, len(rows), INGEST_CHUNK_SIZE):
+                    cur.executemany(statement, rows[start:start + INGEST_CHUNK_SIZE])
+                    if progress:
+                        print_progress_bar(label, min(start + INGEST_CHUNK_SIZE, len(rows)), len(rows))
+                inserted += len(rows)
+                if remove_missing and rows:
+                    cur.execute(delete_missing_businesses.format(**AGGREGATE_SOURCES[provider]),
+                                [harvest_city, harvest_state, json.dumps([row[0] for row in rows])])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return inserted
+
+
+def print_progress_bar(label, done, total, width=30):
+    """
+    Prints a one-line text progress bar, ending the line once
+    done reaches total.
+
+    Parameters
+    ----------
+    label: str
+        What is being processed.
+    done: int
+        How many items are finished.
+    total: int
+        How many items there are.
+    width: int
+        The width of the bar in characters.
+
+    Returns
+    -------
+    None
+    """
+    filled = width if total == 0 else int(width * done / total)
+    end = "\n" if done >= total else ""
+    print(f"\r{label}: [{'#' * filled}{' ' * (width - filled)}] {done}/{total}", end=end, flush=True)
+
+
+@timed_stage("aggregate")
+def aggregate_by_price_level(provider, metric, harvest_city=None, harvest_state=None, connection=None):
+    """
+    Reads a metric's count, sum, mean and standard deviation by
+    price level from the Price_Level_Rollup table, so the cost
+    depends on the number of price levels (and cities summed),
+    not on the number of businesses stored.
+
+    The rollup is kept per harvested city, so state and national
+    totals add up the cities' rows: a business stored under more
+    than one harvested city (e.g. in the overlap of two tiled
+    harvests) is counted once per city.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    metric: str
+        'rating' or 'number_of_ratings'.
+    harvest_city: str
+        Only include this harvested city. None includes every city.
+    harvest_state: str
+        Only include this harvested state. None includes every state,
+        giving a national rollup.
+    connection: sqlite3.Connection
+        The connection to read from, e.g. one of the query service's
+        read-only connections. Defaults to the shared connection.
+
+    Returns
+    -------
+    list
+        One dict per price level of the provider, cheapest first,
+        with the keys "price_level" (the display label), "count",
+        "sum", "mean" and "std". Price levels without any business
+        have a count of 0 and a mean and std of None.
+    """
+    sum_column, sum_sq_column = ROLLUP_COLUMNS[metric]
+    where_clause, where_params = build_city_filter("rollup_i", harvest_city, harvest_state, provider)
+    query = aggregate_by_price_level_query.format(sum_column=sum_column, sum_sq_column=sum_sq_column, where_clause=where_clause)
+
+    with read_cursor(connection) as cur:
+        cur.execute(query, where_params)
+        rows = cur.fetchall()
+
+    buckets = {price_level: [count, total, total_sq] for price_level, count, total, total_sq in rows}
+    return summarize_price_level_buckets(provider, buckets)
+
+
+def summarize_price_level_buckets(provider, buckets):
+    """
+    Turns running count, sum and sum-of-squares totals by price
+    level into the rows returned by aggregate_by_price_level. The
+    std is the sample standard deviation (0 for a single business),
+    the same estimator as compute_price_level_statistics.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    buckets: dict
+        price_level -> [count, sum, sum of squares].
+
+    Returns
+    -------
+    list
+        One dict per price level of the provider, cheapest first,
+        with the keys "price_level", "count", "sum", "mean" and
+        "std".
+    """
+    aggregates = []
+    for price_level, price_label in AGGREGATE_SOURCES[provider]["price_levels"]:
+        count, total, total_sq = buckets.get(price_level, [0, 0, 0])
+        if count > 0:
+            mean = total / count
+            std = (max(0.0, total_sq - count * mean * mean) / max(count - 1, 1)) ** 0.5
+        else:
+            mean = None
+            std = None
+        aggregates.append({"price_level": price_label, "count": count, "sum": total, "mean": mean, "std": std})
+    return aggregates
+
+
+def parse_timestamp(text):
+    """
+    Reads an ISO 8601 date or date and time, such as 2024-05-01
+    or 2024-05-01T18:30, as local time unless it gives a UTC
+    offset.
+
+    Parameters
+    ----------
+    text: str
+        The date and time.
+
+    Returns
+    -------
+    float
+        Seconds since the epoch.
+
+    Raises
+    ------
+    ValueError
+        If text is not an ISO 8601 date.
+    """
+    return datetime.fromisoformat(text).timestamp()
+
+
+def format_timestamp(seconds):
+    """
+    Writes seconds since the epoch as an ISO 8601 UTC time.
+
+    Parameters
+    ----------
+    seconds: float
+        Seconds since the epoch.
+
+    Returns
+    -------
+    str
+        The time to the second, e.g. '2024-05-01T18:30:00+00:00'.
+    """
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat(timespec="seconds")
+
+
+def aggregate_as_of(provider, metric, as_of, harvest_city=None, harvest_state=None, connection=None):
+    """
+    Computes a metric's averages by price level as they stood at
+    a past time, from each business's latest Business_History row
+    at or before it.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    metric: str
+        'rating' or 'number_of_ratings'.
+    as_of: float
+        The time, in seconds since the epoch.
+    harvest_city: str
+        Only include this harvested city. None includes every city.
+    harvest_state: str
+        Only include this harvested state. None includes every state.
+    connection: sqlite3.Connection
+        The connection to read from. Defaults to the shared connection.
+
+    Returns
+    -------
+    list
+        The same rows as aggregate_by_price_level.
+    """
+    where_clause, where_params = build_city_filter("history_i", harvest_city, harvest_state, provider)
+    query = select_price_levels_as_of.format(column=HISTORY_COLUMNS[metric], where_clause=where_clause)
+
+    with read_cursor(connection) as cur:
+        cur.execute(query, where_params + [as_of])
+        rows = cur.fetchall()
+
+    buckets = {price_level: [count, total, total_sq] for price_level, count, total, total_sq in rows}
+    return summarize_price_level_buckets(provider, buckets)
+
+
+def compute_price_level_trend(provider, metric, harvest_city, harvest_state, connection=None):
+    """
+    Replays a city's Business_History in time order, keeping
+    running totals by price level, to give the averages after
+    every harvest that changed something, in one pass over the
+    history. Removed businesses drop out of the totals, and the
+    std is the sample standard deviation, as in
+    compute_price_level_statistics.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    metric: str
+        'rating' or 'number_of_ratings'.
+    harvest_city: str
+        The harvested city.
+    harvest_state: str
+        The harvested state.
+    connection: sqlite3.Connection
+        The connection to read from. Defaults to the shared connection.
+
+    Returns
+    -------
+    list
+        One dict per harvest and price level, oldest first, with
+        the keys "observed_at" (ISO 8601), "price_level", "count",
+        "mean" and "std".
+    """
+    with read_cursor(connection) as cur:
+        cur.execute(select_city_history, [provider, harvest_city, harvest_state])
+        rows = cur.fetchall()
+
+    # business_id -> (price_level, value) as of the row being replayed
+    current = {}
+    buckets = {}
+    trend = []
+
+    def add_to_bucket(price_level, value, sign):
+        if price_level is None:
+            return
+        bucket = buckets.setdefault(price_level, [0, 0, 0])
+        bucket[0] += sign
+        bucket[1] += sign * value
+        bucket[2] += sign * value * value
+
+    for position, (business_id, observed_at, rating, reviews, price_level, removed) in enumerate(rows):
+        value = rating if metric == "rating" else reviews
+        if business_id in current:
+            add_to_bucket(*current.pop(business_id), -1)
+        if not removed:
+            add_to_bucket(price_level, value, 1)
+            current[business_id] = (price_level, value)
+
+        if position + 1 < len(rows) and rows[position + 1][1] == observed_at:
+            continue
+        for aggregate in summarize_price_level_buckets(provider, buckets):
+            trend.append({"observed_at": format_timestamp(observed_at), "price_level": aggregate["price_level"],
+                          "count": aggregate["count"], "mean": aggregate["mean"], "std": aggregate["std"]})
+    return trend
+
+
+def get_business_history(provider, business_id, connection=None):
+    """
+    Reads every recorded state of one business, oldest first.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    business_id: str
+        The Google place_id or Yelp id.
+    connection: sqlite3.Connection
+        The connection to read from. Defaults to the shared connection.
+
+    Returns
+    -------
+    list
+        One dict per change, with the keys "city", "state",
+        "observed_at" (ISO 8601), "rating", "reviews",
+        "price_level" and "removed" (True when a refresh no
+        longer found the business).
+    """
+    with read_cursor(connection) as cur:
+        cur.execute(select_business_history, [provider, business_id])
+        rows = cur.fetchall()
+    return [{"city": city, "state": state, "observed_at": format_timestamp(observed_at), "rating": rating,
+             "reviews": reviews, "price_level": price_level, "removed": bool(removed)}
+            for city, state, observed_at, rating, reviews, price_level, removed in rows]
+
+
+def build_city_filter(table_alias, harvest_city=None, harvest_state=None, provider=None):
+    """
+    Builds a WHERE clause restricting a query to a harvested city
+    and/or state, and to a provider for tables that hold both.
+    Filters that are None are left out entirely, so the query
+    planner can still use the indexes.
+
+    Parameters
+    ----------
+    table_alias: str
+        The alias of the table holding harvest_city/harvest_state.
+    harvest_city: str
+        The city to keep, or None.
+    harvest_state: str
+        The state to keep, or None.
+    provider: str
+        The provider to keep, or None.
+
+    Returns
+    -------
+    tuple
+        The WHERE clause (empty if there is no filter) and
+        its list of parameters.
+    """
+    conditions = []
+    params = []
+    if provider is not None:
+        conditions.append(f"{table_alias}.provider = ?")
+        params.append(provider)
+    if harvest_city is not None:
+        conditions.append(f"{table_alias}.harvest_city = ?")
+        params.append(harvest_city)
+    if harvest_state is not None:
+        conditions.append(f"{table_alias}.harvest_state = ?")
+        params.append(harvest_state)
+    if not conditions:
+        return "", params
+    return "WHERE " + " AND ".join(conditions), params
+
+
+def load_statistics_arrays(provider, harvest_city=None, harvest_state=None, connection=None):
+    """
+    Loads the price level, rating and review count of every
+    business in a selection into NumPy arrays with one query.
+    Businesses without a price level are left out.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    harvest_city: str
+        Only include this harvested city. None includes every city.
+    harvest_state: str
+        Only include this harvested state. None includes every state.
+    connection: sqlite3.Connection
+        The connection to read from, e.g. one of the query service's
+        read-only connections. Defaults to the shared connection.
+
+    Returns
+    -------
+    tuple
+        The price levels (int), ratings and review counts (float),
+        as three arrays of the same length.
+    """
+    import numpy as np
+
+    source = AGGREGATE_SOURCES[provider]
+    where_clause, where_params = build_city_filter("business_i", harvest_city, harvest_state)
+    query = select_statistics_columns.format(where_clause=where_clause, **source)
+
+    with read_cursor(connection) as cur:
+        cur.execute(query, where_params)
+        columns = np.array(cur.fetchall(), dtype=float).reshape(-1, 3)
+
+    columns = columns[~np.isnan(columns[:, 0])]
+    return columns[:, 0].astype(int), columns[:, 1], columns[:, 2]
+
+
+def summarize_groups(group_ids, values):
+    """
+    Computes count, mean, sample standard deviation, confidence
+    interval half-width and STATISTICS_PERCENTILES of values for
+    every group at once, using sorted segments and reduceat
+    instead of looping over rows or groups.
+
+    Parameters
+    ----------
+    group_ids: numpy.ndarray
+        The group (price level) of each value.
+    values: numpy.ndarray
+        The values to summarize.
+
+    Returns
+    -------
+    dict
+        Arrays keyed "group", "count", "mean", "std", "ci" (the
+        confidence interval half-width) and "p<percentile>",
+        one entry per distinct group in ascending order.
+    """
+    import numpy as np
+
+    order = np.lexsort((values, group_ids))
+    group_ids = group_ids[order]
+    values = values[order]
+
+    groups, starts, counts = np.unique(group_ids, return_index=True, return_counts=True)
+    if len(groups) == 0:
+        return {"group": groups}
+    means = np.add.reduceat(values, starts) / counts
+    squared_deviations = (values - np.repeat(means, counts)) ** 2
+    stds = np.sqrt(np.add.reduceat(squared_deviations, starts) / np.maximum(counts - 1, 1))
+
+    summary = {"group": groups, "count": counts, "mean": means, "std": stds, "ci": CONFIDENCE_Z * stds / np.sqrt(counts)}
+    for percentile in STATISTICS_PERCENTILES:
+        positions = starts + (counts - 1) * percentile / 100
+        lower = np.floor(positions).astype(int)
+        upper = np.ceil(positions).astype(int)
+        summary[f"p{percentile}"] = values[lower] + (values[upper] - values[lower]) * (positions - lower)
+    return summary
+
+
+@timed_stage("statistics")
+def compute_price_level_statistics(provider, harvest_city=None, harvest_state=None, prior_reviews=None, connection=None):
+    """
+    Describes the rating and review count distributions of each
+    price level in a selection: count, mean, median, percentiles,
+    standard deviation and confidence interval of the mean, plus
+    a Bayesian-weighted rating that pulls businesses with few
+    reviews toward the overall mean rating.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    harvest_city: str
+        Only include this harvested city. None includes every city.
+    harvest_state: str
+        Only include this harvested state. None includes every state.
+    prior_reviews: float
+        How many reviews' worth of weight the overall mean gets in
+        the Bayesian rating. Defaults to BAYESIAN_PRIOR_REVIEWS.
+    connection: sqlite3.Connection
+        The connection to read from, e.g. one of the query service's
+        read-only connections. Defaults to the shared connection.
+
+    Returns
+    -------
+    list
+        One dict per price level of the provider, cheapest first,
+        with the keys "price_level" (the display label), "count",
+        "rating" and "number_of_ratings" (each a dict of "mean",
+        "median", "std", "ci_low", "ci_high" and "p<percentile>")
+        and "bayesian_rating". Empty price levels have a count of
+        0 and None everywhere else.
+    """
+    import numpy as np
+
+    if prior_reviews is None:
+        prior_reviews = BAYESIAN_PRIOR_REVIEWS
+
+    price_levels, ratings, reviews = load_statistics_arrays(provider, harvest_city, harvest_state, connection)
+
+    metric_summaries = {"rating": summarize_groups(price_levels, ratings),
+                        "number_of_ratings": summarize_groups(price_levels, reviews)}
+    bayesian_means = {}
+    if len(ratings) > 0:
+        if prior_reviews is None:
+            prior_reviews = float(np.median(reviews))
+        overall_mean = ratings.mean()
+        weights = reviews + prior_reviews
+        safe_weights = np.where(weights > 0, weights, 1)
+        weighted_ratings = np.where(weights > 0, (reviews * ratings + prior_reviews * overall_mean) / safe_weights, overall_mean)
+        bayesian_summary = summarize_groups(price_levels, weighted_ratings)
+        bayesian_means = dict(zip(bayesian_summary["group"].tolist(), bayesian_summary["mean"].tolist()))
+
+    statistics = []
+    for price_level, price_label in AGGREGATE_SOURCES[provider]["price_levels"]:
+        level_statistics = {"price_level": price_label, "count": 0, "bayesian_rating": bayesian_means.get(price_level)}
+        for metric, summary in metric_summaries.items():
+            matches = np.nonzero(summary["group"] == price_level)[0]
+            if len(matches) == 0:
+                level_statistics[metric] = None
+                continue
+            index = matches[0]
+            mean = float(summary["mean"][index])
+            ci = float(summary["ci"][index])
+            level_statistics["count"] = int(summary["count"][index])
+            level_statistics[metric] = {"mean": mean, "std": float(summary["std"][index]), "ci_low": mean - ci, "ci_high": mean + ci}
+            for percentile in STATISTICS_PERCENTILES:
+                level_statistics[metric][f"p{percentile}"] = float(summary[f"p{percentile}"][index])
+            level_statistics[metric]["median"] = level_statistics[metric].get("p50")
+        statistics.append(level_statistics)
+    return statistics
+
+
+def print_price_level_statistics(provider, harvest_city=None, harvest_state=None):
+    """
+    Prints a table of compute_price_level_statistics for a
+    provider and selection.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    harvest_city: str
+        Only include this harvested city. None includes every city.
+    harvest_state: str
+        Only include this harvested state. None includes every state.
+
+    Returns
+    -------
+    None
+    """
+    print(f"\n{provider.capitalize()} statistics by price level\n")
+    print(f"{'price':>6} {'n':>6} {'rating':>7} {'std':>6} {'95% CI':>13} {'bayes':>6} {'reviews':>8}")
+    for level_statistics in compute_price_level_statistics(provider, harvest_city, harvest_state):
+        rating = level_statistics["rating"]
+        reviews = level_statistics["number_of_ratings"]
+        if rating is None:
+            print(f"{level_statistics['price_level']:>6} {0:>6}")
+            continue
+        print(f"{level_statistics['price_level']:>6} {level_statistics['count']:>6} {rating['mean']:>7.2f} "
+              f"{rating['std']:>6.2f} {rating['ci_low']:>6.2f}-{rating['ci_high']:<6.2f} {level_statistics['bayesian_rating']:>6.2f} "
+              f"{reviews['mean']:>8.1f}")
+    print()
+
+
+@timed_stage("chart")
+def show_price_level_chart(provider, metric, search_term, harvest_city=None, harvest_state=None):
+    """
+    Draws a bar chart of a metric's average by price level in the
+    web browser. Empty price levels are drawn as 0 and every bar
+    is labelled with its number of restaurants.
+
+    Parameters
+    ----------
+    provider: str
+        'google' or 'yelp'.
+    metric: str
+        'rating' or 'number_of_ratings'.
+    search_term: str
+        The "city, state" search term, for the title.
+    harvest_city: str
+        The harvested city to chart. None charts every city.
+    harvest_state: str
+        The harvested state to chart. None charts every state.
+
+    Returns
+    -------
+    None
+    """
+    import plotly.graph_objects as go
+
+    aggregates = aggregate_by_price_level(provider, metric, harvest_city, harvest_state)
+    title, xaxis_title, yaxis_title = CHART_LABELS[(provider, metric)]
+
+    bar_data = go.Bar(x=[aggregate["price_level"] for aggregate in aggregates],
+                      y=[aggregate["mean"] or 0 for aggregate in aggregates],
+                      text=[f"n={aggregate['count']}" for aggregate in aggregates])
+    basic_layout = go.Layout(title=title.format(search_term=search_term), 
+                                xaxis_title = xaxis_title,
+                                yaxis_title = yaxis_title)
+    fig = go.Figure(data=bar_data, layout=basic_layout)
+    with measure_stage("browser_show"):
+        fig.show()
+
+
+def get_harvested_cities(connection=None):
+    """
+    Lists every city stored in the database.
+
+    Parameters
+    ----------
+    connection: sqlite3.Connection
+        The connection to read from, e.g. one of the query service's
+        read-only connections. Defaults to the shared connection.
+
+    Returns
+    -------
+    list
+        (city, state) pairs, ordered by state then city.
+    """
+    with read_cursor(connection) as cur:
+        cur.execute(select_harvested_cities)
+        return cur.fetchall()
+
+
+@timed_stage("dashboard_figure")
+def build_dashboard_figure(city_pairs):
+    """
+    Builds one figure holding every DASHBOARD_VIEWS bar chart for
+    each city: one row per city, one column per view, read from
+    the price level rollup.
+
+    Parameters
+    ----------
+    city_pairs: list
+        The (city, state) pairs to chart, one row each.
+
+    Returns
+    -------
+    plotly.graph_objects.Figure
+        The dashboard figure.
+    """
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+
+    subplot_titles = [f"{DASHBOARD_VIEW_TITLES[view]}<br>{city.title()}, {state.title()}"
+                      for city, state in city_pairs for view in DASHBOARD_VIEWS]
+    fig = make_subplots(rows=len(city_pairs), cols=len(DASHBOARD_VIEWS), subplot_titles=subplot_titles,
+                        vertical_spacing=min(0.1, 0.3 / len(city_pairs)))
+
+    for row, (city, state) in enumerate(city_pairs, start=1):
+        for column, (provider, metric) in enumerate(DASHBOARD_VIEWS, start=1):
+            aggregates = aggregate_by_price_level(provider, metric, city, state)
+            fig.add_trace(go.Bar(x=[aggregate["price_level"] for aggregate in aggregates],
+                                 y=[aggregate["mean"] or 0 for aggregate in aggregates],
+                                 text=[f"n={aggregate['count']}" for aggregate in aggregates],
+                                 name=DASHBOARD_VIEW_TITLES[(provider, metric)],
+                                 showlegend=False),
+                          row=row, col=column)
+
+    fig.update_layout(title="Restaurant Ratings by Price Level", height=DASHBOARD_ROW_HEIGHT * len(city_pairs) + 100)
+    return fig
+
+
+@timed_stage("chart")
+def show_dashboard(city_pairs):
+    """
+    Draws the dashboard of one or more cities in the web browser,
+    as a single page.
+
+    Parameters
+    ----------
+    city_pairs: list
+        The (city, state) pairs to chart.
+
+    Returns
+    -------
+    None
+    """
+    fig = build_dashboard_figure(city_pairs)
+    with measure_stage("browser_show"):
+        fig.show()
+
+
+@timed_stage("dashboard_export")
+def export_dashboards(city_pairs, output_directory):
+    """
+    Writes each city's dashboard to its own static HTML file, plus
+    an index page linking to all of them. Every page loads the
+    same plotly.min.js, written once next to the pages, so the
+    files stay small and open without an internet connection.
+
+    Parameters
+    ----------
+    city_pairs: list
+        The (city, state) pairs to export.
+    output_directory: str
+        The directory to write the pages into. Created if needed.
+
+    Returns
+    -------
+    list
+        The file names of the pages written.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    file_names = []
+    for city, state in city_pairs:
+        file_name = re.sub(r"[^a-z0-9]+", "_", f"{city} {state}".lower()).strip("_") + ".html"
+        build_dashboard_figure([(city, state)]).write_html(os.path.join(output_directory, file_name),
+                                                           include_plotlyjs="directory", auto_open=False)
+        file_names.append(file_name)
+
+    links = "\n".join(f'<li><a href="{file_name}">{city.title()}, {state.title()}</a></li>'
+                      for (city, state), file_name in zip(city_pairs, file_names))
+    with open(os.path.join(output_directory, DASHBOARD_INDEX_FILE_NAME), 'w') as index_file:
+        index_file.write(f"<!DOCTYPE html>\n<html>\n<head><title>Restaurant Dashboards</title></head>\n"
+                         f"<body>\n<h1>Restaurant Dashboards</h1>\n<ul>\n{links}\n</ul>\n</body>\n</html>\n")
+    return file_names
+
+
+def normalize_tokens(text):
+    """
+    Lowercases text, strips accents and punctuation, spells out
+    "&" and splits it into words.
+
+    Parameters
+    ----------
+    text: str
+        A business name or address.
+
+    Returns
+    -------
+    list
+        The normalized words.
+    """
+    text = unicodedata.normalize("NFKD", text or "").encode("ascii", "ignore").decode("ascii")
+    text = text.lower().replace("&", " and ").replace("'", "")
+    return re.sub(r"[^a-z0-9]+", " ", text).split()
+
+
+def normalize_business(name, address):
+    """
+    Reduces a business to the parts used for matching: its name
+    without filler words, and the house number and street words
+    of its address, with street suffixes and directions
+    abbreviated.
+
+    Parameters
+    ----------
+    name: str
+        The business name.
+    address: str
+        The Google formatted_address or Yelp display_address.
+
+    Returns
+    -------
+    tuple
+        The normalized name (str), the house number (str, or None
+        when the address does not start with one), the set of
+        street words and a list holding the first street word.
+    """
+    name_tokens = [token for token in normalize_tokens(name) if token not in NAME_STOPWORDS]
+    address_tokens = [STREET_ABBREVIATIONS.get(token, token) for token in normalize_tokens((address or "").split(",")[0])]
+
+    house_number = None
+    if address_tokens and address_tokens[0].isdigit():
+        house_number = address_tokens[0]
+        address_tokens = address_tokens[1:]
+    street_tokens = [token for token in address_tokens if token not in STREET_DIRECTIONS]
+    return " ".join(name_tokens), house_number, set(street_tokens), street_tokens[:1]
+
+
+def blocking_keys(normalized_business):
+    """
+    Lists the blocks a normalized business belongs to: its house
+    number and first street word, and the first word of its name.
+
+    Parameters
+    ----------
+    normalized_business: tuple
+        The result of normalize_business.
+
+    Returns
+    -------
+    list
+        The blocking keys.
+    """
+    name, house_number, street_tokens, first_street_token = normalized_business
+    keys = []
+    if house_number is not None and first_street_token:
+        keys.append(("address", house_number, first_street_token[0]))
+    if name:
+        keys.append(("name", name.split()[0]))
+    return keys
+
+
+def score_match(google_business, yelp_business):
+    """
+    Scores how likely two normalized businesses are the same
+    restaurant, from 0 to 1: 60% name similarity and 40% address
+    agreement (same house number and overlapping street words).
+
+    Parameters
+    ----------
+    google_business: tuple
+        A normalized Google place.
+    yelp_business: tuple
+        A normalized Yelp business.
 
-conn = sqlite3.connect("harvested_data.sqlite")
-cur = conn.cursor()
+    Returns
+    -------
+    float
+        The match score.
+    """
+    google_name, google_number, google_street, _ = google_business
+    yelp_name, yelp_number, yelp_street, _ = yelp_business
+
+    name_similarity = SequenceMatcher(None, google_name, yelp_name).ratio()
+    street_overlap = 0.0
+    if google_street and yelp_street:
+        street_overlap = len(google_street & yelp_street) / min(len(google_street), len(yelp_street))
+    number_agreement = 1.0 if google_number is not None and google_number == yelp_number else 0.0
+    return 0.6 * name_similarity + 0.4 * (0.5 * number_agreement + 0.5 * street_overlap)
 
 
-def fetch_google_data(google_baseurl, search_term):
+@timed_stage("match")
+def match_city_businesses(harvest_city, harvest_state):
     """
-    Takes a URL and a search term (both strings)
-    in order to retrieve a JSON object of 
-    Google data for up to 20 results relevant
-    to the given search term. Then returns the
-    JSON as a Python dictionary.
+    Links the Google places and Yelp businesses of a harvested
+    city that are the same restaurant. Both sides are grouped by
+    blocking key so only businesses sharing an address or name
+    key are compared, then the best-scoring pairs above
+    MATCH_THRESHOLD are linked one to one. Replaces the city's
+    previous links.
 
     Parameters
     ----------
-    google_baseurl: str
-        The URL forming the base of the API query.
+    harvest_city: str
+        The harvested city.
+    harvest_state: str
+        The harvested state.
 
     Returns
+    -------
+    int
+        The number of links stored.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    with db_lock:
+        cur.execute(select_google_businesses_for_matching, [harvest_city, harvest_state])
+        google_rows = cur.fetchall()
+        cur.execute(select_yelp_businesses_for_matching, [harvest_city, harvest_state])
+        yelp_rows = cur.fetchall()
+
+    google_businesses = {place_id: normalize_business(name, address) for place_id, name, address in google_rows}
+    yelp_businesses = {yelp_id: normalize_business(name, address) for yelp_id, name, address in yelp_rows}
+
+    blocks = {}
+    for place_id, business in google_businesses.items():
+        for key in blocking_keys(business):
+            blocks.setdefault(key, ([], []))[0].append(place_id)
+    for yelp_id, business in yelp_businesses.items():
+        for key in blocking_keys(business):
+            if key in blocks:
+                blocks[key][1].append(yelp_id)
+
+    scores = {}
+    for place_ids, yelp_ids in blocks.values():
+        if len(place_ids) > MATCH_MAX_BLOCK_SIZE or len(yelp_ids) > MATCH_MAX_BLOCK_SIZE:
+            continue
+        for place_id in place_ids:
+            for yelp_id in yelp_ids:
+                if (place_id, yelp_id) not in scores:
+                    scores[(place_id, yelp_id)] = score_match(google_businesses[place_id], yelp_businesses[yelp_id])
+
+    links = []
+    linked_google = set()
+    linked_yelp = set()
+    for (place_id, yelp_id), score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+        if score < MATCH_THRESHOLD:
+            break
+        if place_id in linked_google or yelp_id in linked_yelp:
+            continue
+        linked_google.add(place_id)
+        linked_yelp.add(yelp_id)
+        links.append([place_id, yelp_id, harvest_city, harvest_state, score])
+
+    with db_lock:
+        try:
+            cur.execute("BEGIN")
+            cur.execute(delete_city_links, [harvest_city, harvest_state])
+            cur.executemany(insert_google_yelp_link, links)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return len(links)
+
+
+def get_matched_businesses(harvest_city=None, harvest_state=None, connection=None):
+    """
+    Lists restaurants found on both Google and Yelp, with both
+    providers' ratings side by side.
+
+    Parameters
     ----------
-    google_data: dict
-        A Python dictionary rendered from
-        JSON, comprising the search results, 
-        maximum 50.
+    harvest_city: str
+        Only include this harvested city. None includes every city.
+    harvest_state: str
+        Only include this harvested state. None includes every state.
+    connection: sqlite3.Connection
+        The connection to read from, e.g. one of the query service's
+        read-only connections. Defaults to the shared connection.
+
+    Returns
+    -------
+    list
+        One dict per matched restaurant, with the keys "name",
+        "google_rating", "yelp_rating", "google_reviews",
+        "yelp_reviews", "google_price_level", "yelp_price_level"
+        and "match_score".
     """
-    params = {"query": search_term, "key": google_secrets.google_api_key, "language": language, "type": place_type}
-    response_data = requests.get(google_baseurl, params=params)
-    text_data_response = response_data.text
-    google_data = json.loads(text_data_response)
-    return google_data
+    where_clause, where_params = build_city_filter("link_i", harvest_city, harvest_state)
+    with read_cursor(connection) as cur:
+        cur.execute(select_matched_businesses.format(where_clause=where_clause), where_params)
+        rows = cur.fetchall()
+    keys = ["name", "google_rating", "yelp_rating", "google_reviews", "yelp_reviews",
+            "google_price_level", "yelp_price_level", "match_score"]
+    return [dict(zip(keys, row)) for row in rows]
 
 
-def fetch_yelp_data(yelp_baseurl, search_term):
+@timed_stage("chart")
+def show_cross_provider_chart(search_term, harvest_city=None, harvest_state=None):
     """
-    Takes a URL and a search term (both strings)
-    in order to retrieve a JSON object of 
-    Yelp data for up to 50 results relevant
-    to the given search term. Then returns the
-    JSON as a Python dictionary.
+    Draws a scatter plot of Google rating against Yelp rating for
+    every restaurant found on both, in the web browser.
 
     Parameters
     ----------
-    yelp_baseurl: str
-        The URL forming the base of the API query.
+    search_term: str
+        The "city, state" search term, for the title.
+    harvest_city: str
+        The harvested city to chart. None charts every city.
+    harvest_state: str
+        The harvested state to chart. None charts every state.
 
     Returns
-    ----------
-    yelp_data: dict
-        A Python dictionary rendered from
-        JSON, comprising the search results, 
-        maximum 50.
+    -------
+    int
+        The number of restaurants plotted.
     """
-    headers = {"Authorization": f"Bearer {yelp_secrets.yelp_api_key}"}
-    params = {"categories": category, "location": search_term, "locale": "en_US", "limit": 50}
-    response = requests.get(yelp_baseurl, params=params, headers=headers)
-    text_response = response.text
-    yelp_data = json.loads(text_response)
-    return yelp_data
+    import plotly.graph_objects as go
+
+    matches = get_matched_businesses(harvest_city, harvest_state)
+    scatter_data = go.Scatter(x=[match["google_rating"] for match in matches],
+                              y=[match["yelp_rating"] for match in matches],
+                              text=[match["name"] for match in matches],
+                              mode="markers")
+    basic_layout = go.Layout(title=f"Google vs. Yelp Rating for the Same Restaurants in {search_term}", 
+                                xaxis_title = "Google Rating (1 = lowest, 5 = highest)",
+                                yaxis_title = "Yelp Rating (1 = lowest, 5 = highest)")
+    fig = go.Figure(data=scatter_data, layout=basic_layout)
+    with measure_stage("browser_show"):
+        fig.show()
+    return len(matches)
+
+
+def read_city_list(file_name):
+    """
+    Reads (city, state) pairs from a CSV file with city and state
+    columns, or from a JSON list of [city, state] pairs or of
+    {"city": ..., "state": ...} objects, and checks each state
+    against the states list.
 
+    Parameters
+    ----------
+    file_name: str
+        The path of the .csv or .json file.
 
-def construct_unique_key_google(google_baseurl, params):
+    Returns
+    -------
+    tuple
+        The list of valid (city, state) pairs, lowercased and
+        without duplicates, and the list of rejected entries.
     """
-    Constructs a key that is guaranteed to uniquely and 
-    repeatably identify an API request by its baseurl and params
-    
+    with open(file_name, 'r', newline='') as city_file:
+        if file_name.lower().endswith(".json"):
+            entries = json.load(city_file)
+        else:
+            entries = [row for row in csv.reader(city_file) if row]
+
+    city_pairs = []
+    rejected = []
+    seen_pairs = set()
+    for entry in entries:
+        if isinstance(entry, dict):
+            entry = [entry.get("city", ""), entry.get("state", "")]
+        if len(entry) < 2:
+            rejected.append(entry)
+            continue
+        city = str(entry[0]).strip().lower()
+        state = str(entry[1]).strip().lower()
+        if (city, state) == ("city", "state"):
+            continue
+        if not city or state not in states:
+            rejected.append(entry)
+        elif (city, state) not in seen_pairs:
+            seen_pairs.add((city, state))
+            city_pairs.append((city, state))
+    return city_pairs, rejected
+
+
+def load_batch_progress(progress_file_name):
+    """
+    Reads the search terms already harvested by an earlier,
+    possibly interrupted, batch run.
+
     Parameters
     ----------
-    google_baseurl: string
-        The URL for the API endpoint
-    params: dict
-        A dictionary of param:value pairs
-    
+    progress_file_name: str
+        The progress file written by run_batch_harvest.
+
     Returns
     -------
-    string
-        the unique key as a string
+    set
+        The completed "city, state" search terms.
     """
-    google_unique_key = f"UNIQUE_KEY---{str(google_baseurl)}---{str(params)}---{str(google_secrets.google_api_key)}"
+    try:
+        with open(progress_file_name, 'r') as progress_file:
+            return set(line.strip() for line in progress_file if line.strip())
+    except FileNotFoundError:
+        return set()
 
-    return google_unique_key
 
+def run_batch_harvest(file_name, workers=BATCH_WORKERS, progress_file_name=BATCH_PROGRESS_FILE_NAME, all_pages=None):
+    """
+    Harvests every city in a CSV or JSON city list across a pool
+    of worker threads, using the same fetch, cache and ingest steps
+    as an interactive search. Each finished city is appended to the
+    progress file, so rerunning the same command after an
+    interruption skips the cities that are already done.
 
-def construct_unique_key_yelp(yelp_baseurl, params):
-    ''' constructs a key that is guaranteed to uniquely and 
-    repeatably identify an API request by its baseurl and params
-    
     Parameters
     ----------
-    yelp_baseurl: string
-        The URL for the API endpoint
-    params: dict
-        A dictionary of param:value pairs
-    
+    file_name: str
+        The path of the .csv or .json city list.
+    workers: int
+        The number of cities harvested at the same time.
+    progress_file_name: str
+        The file recording finished cities.
+    all_pages: bool
+        Whether to harvest every page of results. Defaults to
+        HARVEST_ALL_PAGES.
+
     Returns
     -------
-    string
-        the unique key as a string
-    '''
-    yelp_unique_key = f"UNIQUE_KEY---{str(yelp_baseurl)}---{str(params)}---{str(yelp_secrets.yelp_api_key)}"
-
-    return yelp_unique_key
+    tuple
+        The number of cities harvested and the number that failed.
+    """
+    city_pairs, rejected = read_city_list(file_name)
+    for entry in rejected:
+        print(f"\n[Error] Skipping invalid city/state entry: {entry}\n")
+
+    completed = load_batch_progress(progress_file_name)
+    pending = [(city, state) for city, state in city_pairs if f"{city}, {state}" not in completed]
+    print(f"\n{len(city_pairs)} cities in list, {len(city_pairs) - len(pending)} already harvested, {len(pending)} to go.\n")
+
+    create_tables()
+    progress_lock = threading.Lock()
+    counts = {"done": 0, "failed": 0}
+
+    def harvest_city(city_pair):
+        city, state = city_pair
+        search_term = f"{city}, {state}"
+        try:
+            google_data, yelp_data = fetch_city_data(search_term, all_pages)
+            ingest_city_data(google_data, yelp_data, city, state, harvest_mode=get_harvest_mode(all_pages))
+            if MATCH_AFTER_INGEST:
+                match_city_businesses(city, state)
+        except Exception as error:
+            with progress_lock:
+                counts["failed"] += 1
+                print(f"\n[Error] {search_term}: {error}\n")
+            return
+        with progress_lock:
+            with open(progress_file_name, 'a') as progress_file:
+                progress_file.write(search_term + "\n")
+            counts["done"] += 1
+            print(f"\n[{counts['done'] + counts['failed']}/{len(pending)}] Harvested {search_term}: "
+                  f"{len(google_data.get('results', []))} Google, {len(yelp_data.get('businesses', []))} Yelp\n")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(harvest_city, pending))
+
+    flush_cache_writes()
+    print(f"\nBatch finished: {counts['done']} harvested, {counts['failed']} failed.\n")
+    return counts["done"], counts["failed"]
+
+
+def harvest_city_summary(city_term, state_term, all_pages=None, remove_missing=False, tiled=None, harvest_mode=None):
+    """
+    Fetches, stores and matches one city without any prompts and
+    summarizes the result, for the harvest command and the query
+    service.
 
+    Parameters
+    ----------
+    city_term: str
+        The lowercased city.
+    state_term: str
+        The lowercased state, from the states list.
+    all_pages: bool
+        Whether to harvest every page of results. Defaults to
+        HARVEST_ALL_PAGES.
+    remove_missing: bool
+        Delete the city's stored businesses this harvest no longer
+        found, as a refresh does.
+    tiled: bool
+        Whether to harvest the city tile by tile. Defaults to
+        HARVEST_TILED.
+    harvest_mode: str
+        The mode logged in Harvest_Log. Defaults to the one
+        all_pages and tiled give.
 
-def load_cache(CACHE_FILE_NAME):
+    Returns
+    -------
+    dict
+        The "city", "state", number of "google_results" and
+        "yelp_results", the number of restaurants "matched"
+        (None when MATCH_AFTER_INGEST is off), and the number of
+        new, changed or removed ("changed") businesses per provider.
+
+    Raises
+    ------
+    ApiRequestError
+        If either API request fails.
     """
-    Opens the cache file if it exists and loads the JSON into
-    the cache dictionary.
-    if the cache file doesn't exist, creates a new cache dictionary.
-    
+    create_tables()
+    google_data, yelp_data = fetch_city_data(f"{city_term}, {state_term}", all_pages, tiled)
+    if harvest_mode is None:
+        harvest_mode = get_harvest_mode(all_pages, tiled)
+    ingest_city_data(google_data, yelp_data, city_term, state_term, remove_missing=remove_missing, harvest_mode=harvest_mode)
+    matched_count = match_city_businesses(city_term, state_term) if MATCH_AFTER_INGEST else None
+    flush_cache_writes()
+    return {"city": city_term, "state": state_term, "google_results": len(google_data.get("results", [])),
+            "yelp_results": len(yelp_data.get("businesses", [])), "matched": matched_count,
+            "changed": count_harvest_changes_by_provider(city_term, state_term)}
+
+
+def count_harvest_changes_by_provider(harvest_city, harvest_state, connection=None):
+    """
+    Counts the businesses that a city's latest harvest added,
+    changed or removed, i.e. its Business_History rows at that time.
+
     Parameters
     ----------
-    None
-    
+    harvest_city: str
+        The harvested city.
+    harvest_state: str
+        The harvested state.
+    connection: sqlite3.Connection
+        The connection to read from. Defaults to the shared connection.
+
     Returns
     -------
-    The opened cache: dict
+    dict
+        provider -> number of businesses.
     """
-    try:
-        cache_file = open(CACHE_FILE_NAME, 'r')
-        cache_file_contents = cache_file.read()
-        cache = json.loads(cache_file_contents)
-    except:
-        cache = {}
-    return cache
+    changed = {}
+    with read_cursor(connection) as cur:
+        for provider in AGGREGATE_SOURCES:
+            cur.execute(count_harvest_changes, [provider, harvest_city, harvest_state])
+            changed[provider] = cur.fetchone()[0]
+    return changed
 
 
-def save_cache(cache, CACHE_FILE_NAME):
-    '''
-    Saves the current state of the cache.
-    
+def get_logged_harvest_mode(harvest_city, harvest_state, connection=None):
+    """
+    Reads how a city was last harvested.
+
     Parameters
     ----------
-    cache
-        The dictionary to save.
-    CACHE_FILE_NAME
-        The name of the file to which
-        to save the cache.
-    
+    harvest_city: str
+        The harvested city.
+    harvest_state: str
+        The harvested state.
+    connection: sqlite3.Connection
+        The connection to read from. Defaults to the shared connection.
+
     Returns
     -------
-    None
-    '''
-    cache_file = open(CACHE_FILE_NAME, 'w')
-    contents_to_write = json.dumps(cache)
-    cache_file.write(contents_to_write)
-    cache_file.close()
+    str or None
+        The HARVEST_MODES key, "unknown" for a city logged before
+        modes were recorded, or None if it was never harvested.
+    """
+    with read_cursor(connection) as cur:
+        cur.execute(select_harvest_mode, [harvest_city, harvest_state])
+        row = cur.fetchone()
+    return None if row is None else row[0]
 
 
-def make_google_request_using_cache(google_baseurl, search_term):
+def get_stale_cities(max_age_hours, connection=None):
     """
-    Check the Google cache for a saved result with this unique_key. 
-    If the result is found, return it. 
-    Otherwise send a new request, save it, then return it.
-    
+    Lists the cities last harvested more than max_age_hours ago,
+    least recently harvested first.
+
     Parameters
     ----------
-    google_baseurl: string
-        The URL for the API endpoint
-    search_term:
-        The search term provided by user input.
-    
+    max_age_hours: float
+        The age in hours after which a city is due for a refresh.
+    connection: sqlite3.Connection
+        The connection to read from. Defaults to the shared connection.
+
     Returns
     -------
-    CACHE_DICT[google_unique_key]
-        the results of the query as a dictionary loaded from cache
-        JSON
+    list
+        (city, state) pairs.
     """
-    CACHE_DICT = load_cache(GOOGLE_CACHE_FILE_NAME)
-    params = {"query": search_term, "key": google_secrets.google_api_key, "language": language, "type": place_type}
-    google_unique_key = construct_unique_key_google(google_baseurl, params)
+    with read_cursor(connection) as cur:
+        cur.execute(select_stale_cities, [time.time() - max_age_hours * 60 * 60])
+        return cur.fetchall()
 
-    if google_unique_key in CACHE_DICT.keys():
-        print("\nUsing Google cache\n")
-        return CACHE_DICT[google_unique_key]
-    else:
-        print("\nFetching from Google\n")
-        CACHE_DICT[google_unique_key] = fetch_google_data(google_baseurl, search_term)
-        save_cache(CACHE_DICT, GOOGLE_CACHE_FILE_NAME)
-        return CACHE_DICT[google_unique_key]
 
+def refresh_cities(city_pairs, workers=BATCH_WORKERS):
+    """
+    Re-harvests cities across a pool of worker threads. Run with
+    CACHE_REFRESH set, so the APIs are asked again instead of the
+    cache; only businesses whose rating, review count or price
+    level changed are added to Business_History. Each city is
+    searched the way Harvest_Log says it was last harvested, and
+    businesses that search no longer returns are removed and
+    recorded as such. Cities whose mode is "unknown", or never
+    harvested, are searched with HARVEST_ALL_PAGES and
+    HARVEST_TILED and keep the businesses not found; "unknown"
+    stays logged until a harvest records a mode.
+
+    Parameters
+    ----------
+    city_pairs: list
+        The (city, state) pairs to refresh.
+    workers: int
+        The number of cities refreshed at the same time.
 
-def make_yelp_request_using_cache(yelp_baseurl, search_term):
+    Returns
+    -------
+    tuple
+        The harvest_city_summary of each refreshed city, and the
+        number of cities that failed.
     """
-    Check the Yelp cache for a saved result with this unique_key. 
-    If the result is found, return it. 
-    Otherwise send a new request, save it, then return it.
-    
+    summaries = []
+    failures = []
+    summary_lock = threading.Lock()
+
+    def refresh_city(city_pair):
+        city, state = city_pair
+        try:
+            harvest_mode = get_logged_harvest_mode(city, state)
+            if harvest_mode in HARVEST_MODES:
+                all_pages, tiled = HARVEST_MODES[harvest_mode]
+                summary = harvest_city_summary(city, state, all_pages, True, tiled)
+            else:
+                summary = harvest_city_summary(city, state, harvest_mode=harvest_mode)
+        except Exception as error:
+            with summary_lock:
+                failures.append(city_pair)
+                print(f"\n[Error] {city}, {state}: {error}\n")
+            return
+        with summary_lock:
+            summaries.append(summary)
+            print(f"\nRefreshed {city}, {state}: {summary['changed']['google']} Google and "
+                  f"{summary['changed']['yelp']} Yelp restaurants new, changed or gone\n")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(refresh_city, city_pairs))
+    return summaries, len(failures)
+
+
+def export_businesses(provider, harvest_city=None, harvest_state=None, connection=None):
+    """
+    Reads every stored business of a provider, for the export
+    command.
+
     Parameters
     ----------
-    yelp_baseurl: string
-        The URL for the API endpoint
-    search_term:
-        The search term provided by user input.
-    
+    provider: str
+        'google' or 'yelp'.
+    harvest_city: str
+        Only include this harvested city. None includes every city.
+    harvest_state: str
+        Only include this harvested state. None includes every state.
+    connection: sqlite3.Connection
+        The connection to read from, e.g. one of the query service's
+        read-only connections. Defaults to the shared connection.
+
     Returns
     -------
-    CACHE_DICT[yelp_unique_key]
-        the results of the query as a dictionary loaded from cache
-        JSON
+    list
+        One dict per business, keyed by column name.
     """
-    CACHE_DICT = load_cache(YELP_CACHE_FILE_NAME)
-    search_term = f"{city_term}, {state_term}"
-    params = {"categories": category, "location": search_term, "locale": "en_US", "limit": 50}
-    yelp_unique_key = construct_unique_key_yelp(yelp_baseurl, params)
+    where_clause, where_params = build_city_filter("business_i", harvest_city, harvest_state)
+    query = select_business_export.format(table=AGGREGATE_SOURCES[provider]["table"], where_clause=where_clause)
+    with read_cursor(connection) as cur:
+        cur.execute(query, where_params)
+        columns = [column[0] for column in cur.description]
+        rows = cur.fetchall()
+    return [dict(zip(columns, row)) for row in rows]
 
-    if yelp_unique_key in CACHE_DICT.keys():
-        print("\nUsing Yelp cache\n")
-        return CACHE_DICT[yelp_unique_key]
-    else:
-        print("\nFetching from Yelp\n")
-        CACHE_DICT[yelp_unique_key] = fetch_yelp_data(yelp_baseurl, search_term)
-        save_cache(CACHE_DICT, YELP_CACHE_FILE_NAME)
-        return CACHE_DICT[yelp_unique_key]
 
+def write_records(records, output_format, output_file=None):
+    """
+    Writes a list of flat dicts as JSON or CSV, for the
+    non-interactive commands.
 
-drop_google_rating_info = '''
-    DROP TABLE IF EXISTS "Google_Rating_Info";
-'''
+    Parameters
+    ----------
+    records: list or dict
+        The rows to write. A dict is only supported as JSON.
+    output_format: str
+        'json' or 'csv'.
+    output_file: file
+        Where to write. Defaults to standard output.
 
-create_google_rating_info = '''
-    CREATE TABLE IF NOT EXISTS "Google_Rating_Info" (
-        'place_id' TEXT PRIMARY KEY,
-        'name' TEXT,
-        'formatted_address' TEXT,
-        'rating' FLOAT NOT NULL,
-        'user_ratings_total' INTEGER NOT NULL
-    );
-'''
+    Returns
+    -------
+    None
+    """
+    if output_file is None:
+        output_file = sys.stdout
+    if output_format == "json":
+        json.dump(records, output_file, indent=2)
+        output_file.write("\n")
+        return
 
-drop_google_price_info = '''
-    DROP TABLE IF EXISTS "Google_Price_Info";
-'''
+    field_names = list(records[0].keys()) if records else []
+    writer = csv.DictWriter(output_file, fieldnames=field_names)
+    writer.writeheader()
+    writer.writerows(records)
 
-create_google_price_info = '''
-    CREATE TABLE IF NOT EXISTS "Google_Price_Info" (
-        'place_id' TEXT,
-        'name' TEXT,
-        'formatted_address' TEXT,
-        'price_level' TEXT,
-        FOREIGN KEY (place_id) REFERENCES Google_Rating_Info (place_id)
-    );
-'''
 
-drop_yelp_rating_info = '''
-    DROP TABLE IF EXISTS "Yelp_Rating_Info";
-'''
+def open_read_connections(count):
+    """
+    Opens read-only connections to harvested_data.sqlite for the
+    query service and puts them in a pool.
 
-create_yelp_rating_info = '''
-    CREATE TABLE IF NOT EXISTS "Yelp_Rating_Info" (
-        'id' TEXT PRIMARY KEY,
-        'alias'  TEXT,
-        'name' TEXT,
-        'display_address' TEXT,
-        'rating' FLOAT NOT NULL,
-        'review_count' TEXT NOT NULL
-    );
-'''
+    Parameters
+    ----------
+    count: int
+        The number of connections.
 
-drop_yelp_price_info = '''
-    DROP TABLE IF EXISTS "Yelp_Price_Info";
-'''
+    Returns
+    -------
+    queue.Queue
+        The idle connections.
+    """
+    pool = queue.Queue()
+    for _ in range(count):
+        connection = sqlite3.connect(f"file:{DATABASE_FILE_NAME}?mode=ro", uri=True,
+                                     check_same_thread=False, cached_statements=256)
+        pool.put(connection)
+    return pool
 
-create_yelp_price_info = '''
-    CREATE TABLE IF NOT EXISTS "Yelp_Price_Info" (
-        'id' TEXT,
-        'alias'  TEXT,
-        'name' TEXT,
-        'display_address' TEXT,
-        'phone' TEXT,
-        'price' TEXT NOT NULL,
-        FOREIGN KEY (id) REFERENCES Yelp_Rating_Info (id)
-    );
-'''
 
-insert_google_rating_info = '''
-    INSERT INTO Google_Rating_Info
-    VALUES (?, ?, ?, ?, ?)
-'''
+def answer_service_query(path, params, connection):
+    """
+    Answers one read request of the query service.
 
-insert_google_price_info = '''
-    INSERT INTO Google_Price_Info
-    VALUES (?, ?, ?, ?)
-'''
+    Parameters
+    ----------
+    path: str
+        The endpoint: /cities, /aggregate, /statistics,
+        /businesses, /matches or /trend.
+    params: dict
+        The query string parameters: provider, metric, city, state,
+        and as_of (an ISO date) for /aggregate or business (an id)
+        for /trend.
+    connection: sqlite3.Connection
+        A read-only connection from the pool.
 
-insert_yelp_rating_info = '''
-    INSERT INTO Yelp_Rating_Info
-    VALUES (?, ?, ?, ?, ?, ?)
-'''
+    Returns
+    -------
+    tuple
+        The HTTP status code and the JSON-serializable answer.
+    """
+    city = params["city"].lower() if params.get("city") else None
+    state = params["state"].lower() if params.get("state") else None
+    provider = params.get("provider")
+    if path in ("/aggregate", "/statistics", "/businesses", "/trend") and provider not in AGGREGATE_SOURCES:
+        return 400, {"error": f"provider must be one of {sorted(AGGREGATE_SOURCES)}"}
+
+    if path == "/cities":
+        return 200, [{"city": city, "state": state} for city, state in get_harvested_cities(connection)]
+    metric = params.get("metric", "rating")
+    if path in ("/aggregate", "/trend") and metric not in ROLLUP_COLUMNS:
+        return 400, {"error": f"metric must be one of {sorted(ROLLUP_COLUMNS)}"}
+    if path == "/aggregate" and params.get("as_of"):
+        try:
+            as_of = parse_timestamp(params["as_of"])
+        except ValueError:
+            return 400, {"error": "as_of must be an ISO date or time"}
+        return 200, aggregate_as_of(provider, metric, as_of, city, state, connection)
+    if path == "/aggregate":
+        return 200, aggregate_by_price_level(provider, metric, city, state, connection)
+    if path == "/statistics":
+        return 200, compute_price_level_statistics(provider, city, state, connection=connection)
+    if path == "/businesses":
+        return 200, export_businesses(provider, city, state, connection)
+    if path == "/matches":
+        return 200, get_matched_businesses(city, state, connection)
+    if path == "/trend" and params.get("business"):
+        return 200, get_business_history(provider, params["business"], connection)
+    if path == "/trend":
+        if city is None or state is None:
+            return 400, {"error": "city and state, or business, are required"}
+        return 200, compute_price_level_trend(provider, metric, city, state, connection)
+    return 404, {"error": f"unknown endpoint {path}"}
+
+
+async def serve_queries(host, port, read_connections):
+    """
+    Runs the query service until interrupted. Each connection may
+    send several requests (HTTP keep-alive). GET requests are
+    answered from the response cache when possible, otherwise on a
+    worker thread holding one of the pooled read-only connections.
+    GET /metrics returns the stage metrics in Prometheus format.
+    POST /harvest?city=...&state=... harvests a city on a single
+    writer thread and clears the response cache. A request that
+    fails unexpectedly (e.g. the database is locked) is answered
+    with a JSON 500 instead of dropping the connection.
 
-insert_yelp_price_info = '''
-    INSERT INTO Yelp_Price_Info
-    VALUES (?, ?, ?, ?, ?, ?)
-'''
+    Parameters
+    ----------
+    host: str
+        The address to listen on.
+    port: int
+        The port to listen on.
+    read_connections: int
+        The number of read-only connections and read threads.
 
-if __name__ == "__main__":
+    Returns
+    -------
+    None
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    pool = open_read_connections(read_connections)
+    read_executor = ThreadPoolExecutor(max_workers=read_connections)
+    harvest_executor = ThreadPoolExecutor(max_workers=1)
+    response_cache = OrderedDict()
+    cached_bytes = 0
+    # Bumped by every /harvest, so a read that started before it is not cached after it.
+    cache_generation = 0
+
+    def run_read(path, params):
+        connection = pool.get()
+        try:
+            return answer_service_query(path, params, connection)
+        except Exception as error:
+            return 500, {"error": f"{type(error).__name__}: {error}"}
+        finally:
+            pool.put(connection)
+
+    def run_harvest(params):
+        city_term = params.get("city", "").strip().lower()
+        state_term = params.get("state", "").strip().lower()
+        if not city_term or state_term not in states:
+            return 400, {"error": "city and a full U.S. state name are required"}
+        try:
+            return 200, harvest_city_summary(city_term, state_term)
+        except ApiRequestError as error:
+            return 502, {"error": str(error)}
+        except Exception as error:
+            return 500, {"error": f"{type(error).__name__}: {error}"}
+
+    def cache_response(cache_key, body):
+        nonlocal cached_bytes
+        if cache_key in response_cache:
+            cached_bytes -= len(response_cache.pop(cache_key)[0])
+        if len(body) > SERVICE_CACHE_MAX_BYTES:
+            return
+        response_cache[cache_key] = [body, time.time()]
+        cached_bytes += len(body)
+        while len(response_cache) > SERVICE_CACHE_MAX_ENTRIES or cached_bytes > SERVICE_CACHE_MAX_BYTES:
+            cached_bytes -= len(response_cache.popitem(last=False)[1][0])
+
+    async def respond(method, target):
+        nonlocal cached_bytes, cache_generation
+        url = urlsplit(target)
+        params = dict(parse_qsl(url.query))
+        if method == "GET" and url.path == "/metrics":
+            return 200, format_prometheus_metrics().encode(), "BYPASS"
+        if method == "POST" and url.path == "/harvest":
+            status, answer = await loop.run_in_executor(harvest_executor, run_harvest, params)
+            response_cache.clear()
+            cached_bytes = 0
+            cache_generation += 1
+            return status, json.dumps(answer).encode(), "BYPASS"
+        if method != "GET":
+            return 405, json.dumps({"error": f"{method} not allowed"}).encode(), "BYPASS"
+
+        cache_key = (url.path, tuple(sorted(params.items())))
+        cached = response_cache.get(cache_key)
+        if cached is not None and time.time() - cached[1] <= SERVICE_CACHE_TTL_SECONDS:
+            response_cache.move_to_end(cache_key)
+            return 200, cached[0], "HIT"
+
+        read_generation = cache_generation
+        status, answer = await loop.run_in_executor(read_executor, run_read, url.path, params)
+        body = json.dumps(answer).encode()
+        if status == 200 and read_generation == cache_generation:
+            cache_response(cache_key, body)
+        return status, body, "MISS"
+
+    async def handle_client(reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    header_line = await reader.readline()
+                    if header_line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header_line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if int(headers.get("content-length", 0)) > 0:
+                    await reader.readexactly(int(headers["content-length"]))
+
+                status, body, cache_state = await respond(method.upper(), target)
+                content_type = "text/plain; version=0.0.4" if urlsplit(target).path == "/metrics" else "application/json"
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                writer.write(f"HTTP/1.1 {status} {SERVICE_STATUS_TEXT[status]}\r\n"
+                             f"Content-Type: {content_type}\r\n"
+                             f"Content-Length: {len(body)}\r\n"
+                             f"X-Cache: {cache_state}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle_client, host, port)
+    print(f"\nServing harvested_data.sqlite on http://{host}:{port} (Ctrl-C to stop)\n")
+    async with server:
+        await server.serve_forever()
+
+
+def run_query_service(host=SERVICE_HOST, port=SERVICE_PORT, read_connections=SERVICE_READ_CONNECTIONS):
+    """
+    Starts the local HTTP query service over harvested_data.sqlite.
+    The database is switched to write-ahead logging so the
+    read-only connections keep answering while a harvest writes.
 
-    GOOGLE_CACHE_DICT = load_cache(GOOGLE_CACHE_FILE_NAME)
-    YELP_CACHE_DICT = load_cache(YELP_CACHE_FILE_NAME)
+    Parameters
+    ----------
+    host: str
+        The address to listen on.
+    port: int
+        The port to listen on.
+    read_connections: int
+        The number of pooled read-only connections.
 
-    while True:
+    Returns
+    -------
+    None
+    """
+    import asyncio
 
-        cur.execute(drop_google_rating_info)
-        cur.execute(create_google_rating_info)
-        cur.execute(drop_google_price_info)
-        cur.execute(create_google_price_info)
+    create_tables()
+    with db_lock:
+        get_connection().execute("PRAGMA journal_mode=WAL")
+    try:
+        asyncio.run(serve_queries(host, port, read_connections))
+    except KeyboardInterrupt:
+        print("\nQuery service stopped.\n")
 
-        cur.execute(drop_yelp_rating_info)
-        cur.execute(create_yelp_rating_info)
-        cur.execute(drop_yelp_price_info)
-        cur.execute(create_yelp_price_info)
 
-        conn.commit()
+if __name__ == "__main__":
 
-        google_baseurl = "https://maps.googleapis.com/maps/api/place/textsearch/json?"
-        yelp_baseurl = "https://api.yelp.com/v3/businesses/search"
-        category = "restaurants, All"
+    parser = argparse.ArgumentParser(description="Compare Google and Yelp restaurant ratings by price level.")
+    parser.add_argument("--batch", metavar="FILE", help="harvest every city in a CSV or JSON list instead of prompting")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="cities harvested at the same time in batch mode")
+    parser.add_argument("--progress-file", default=BATCH_PROGRESS_FILE_NAME, help="file recording finished cities, for resuming")
+    parser.add_argument("--all-pages", action="store_true", help="harvest every page of results")
+    parser.add_argument("--tiled", action="store_true", help="search each city cell by cell over its whole area, beyond the per-search caps")
+    parser.add_argument("--verbose-ingest", action="store_true", help="print every row as it is inserted")
+    parser.add_argument("--progress", action="store_true", help="show a progress bar while inserting rows")
+    parser.add_argument("--metrics-json", metavar="FILE", help="write per-stage timings, bytes and cache counters as JSON on exit")
+    parser.add_argument("--metrics-prometheus", metavar="FILE", help="write the same metrics in Prometheus text format on exit")
+    parser.add_argument("--profile", metavar="FILE", help="save a cProfile profile of one search (harvest, or the first interactive search)")
+    subparsers = parser.add_subparsers(dest="command", help="run one step without prompting (no command starts the interactive search)")
+
+    harvest_parser = subparsers.add_parser("harvest", help="harvest one city and print a JSON summary")
+    harvest_parser.add_argument("city", help="U.S. city name without the state, e.g. 'Ann Arbor'")
+    harvest_parser.add_argument("state", help="full U.S. state name, e.g. 'Michigan'")
+
+    aggregate_parser = subparsers.add_parser("aggregate", help="print a metric's average by price level")
+    aggregate_parser.add_argument("provider", choices=sorted(AGGREGATE_SOURCES))
+    aggregate_parser.add_argument("--metric", choices=sorted(ROLLUP_COLUMNS), default="rating")
+    aggregate_parser.add_argument("--statistics", action="store_true", help="print the full statistics instead (JSON only)")
+    aggregate_parser.add_argument("--as-of", metavar="WHEN", help="the averages as they stood at an ISO date or time, e.g. 2024-05-01")
+
+    trend_parser = subparsers.add_parser("trend", help="print a city's averages by price level after every harvest that changed them")
+    trend_parser.add_argument("provider", choices=sorted(AGGREGATE_SOURCES))
+    trend_parser.add_argument("--metric", choices=sorted(ROLLUP_COLUMNS), default="rating")
+    trend_parser.add_argument("--business", metavar="ID", help="print the recorded changes of one Google place_id or Yelp id instead")
+
+    export_parser = subparsers.add_parser("export", help="print the stored businesses or cross-provider matches")
+    export_parser.add_argument("source", choices=sorted(AGGREGATE_SOURCES) + ["matches"])
+    export_parser.add_argument("--output", metavar="FILE", help="write to FILE instead of standard output")
+
+    dashboard_parser = subparsers.add_parser("dashboard", help="chart every view for several cities on one page, or export them as HTML")
+    dashboard_parser.add_argument("places", nargs="*", metavar="PLACE", help="'city, state' to include (default: every harvested city)")
+    dashboard_parser.add_argument("--cities", metavar="FILE", help="read the cities from a CSV or JSON list, as for --batch")
+    dashboard_parser.add_argument("--output-dir", metavar="DIR", help="write one static HTML page per city into DIR instead of opening the browser")
+
+    subparsers.add_parser("compact-cache", help="re-store old verbatim cache entries compressed and deduplicated, then vacuum")
+
+    refresh_parser = subparsers.add_parser("refresh", help="re-harvest cities from the APIs, bypassing the cache, and record what changed")
+    refresh_parser.add_argument("places", nargs="*", metavar="PLACE", help="'city, state' to refresh (default: every city due for a refresh)")
+    refresh_parser.add_argument("--cities", metavar="FILE", help="read the cities from a CSV or JSON list, as for --batch")
+    refresh_parser.add_argument("--older-than", type=float, default=REFRESH_MAX_AGE_HOURS, metavar="HOURS",
+                                help="by default, refresh the cities last harvested more than HOURS ago")
+    refresh_parser.add_argument("--every", type=float, metavar="HOURS", help="keep running, refreshing again every HOURS")
+
+    serve_parser = subparsers.add_parser("serve", help="answer aggregate, business and harvest requests over local HTTP")
+    serve_parser.add_argument("--host", default=SERVICE_HOST)
+    serve_parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    serve_parser.add_argument("--read-connections", type=int, default=SERVICE_READ_CONNECTIONS, help="pooled read-only database connections")
+
+    for command_parser, default_format in [(aggregate_parser, "json"), (export_parser, "csv"), (trend_parser, "json")]:
+        command_parser.add_argument("--city", help="only include this harvested city (default: every city)")
+        command_parser.add_argument("--state", help="only include this harvested state (default: every state)")
+        command_parser.add_argument("--format", choices=["json", "csv"], default=default_format)
+
+    args = parser.parse_args()
+
+    if args.all_pages:
+        HARVEST_ALL_PAGES = True
+    if args.tiled:
+        HARVEST_TILED = True
+    VERBOSE_INGEST = args.verbose_ingest
+    INGEST_PROGRESS = args.progress
+    if args.metrics_json or args.metrics_prometheus:
+        atexit.register(write_metrics_report, args.metrics_json, args.metrics_prometheus)
+
+    if args.command == "compact-cache":
+        converted, size_before, size_after = compact_cache_store()
+        write_records({"converted_entries": converted, "bytes_before": size_before, "bytes_after": size_after}, "json")
+        quit()
+
+    if args.command == "serve":
+        run_query_service(args.host, args.port, args.read_connections)
+        quit()
+
+    city_pairs = []
+    if args.command in ("dashboard", "refresh"):
+        for place in args.places:
+            city, _, state = place.rpartition(",")
+            if not city.strip() or state.strip().lower() not in states:
+                parser.error(f"invalid 'city, state': {place}")
+            city_pairs.append((city.strip().lower(), state.strip().lower()))
+        if args.cities:
+            listed_pairs, rejected = read_city_list(args.cities)
+            for entry in rejected:
+                print(f"\n[Error] Skipping invalid city/state entry: {entry}\n", file=sys.stderr)
+            city_pairs.extend(listed_pairs)
+
+    if args.command == "dashboard":
+        create_tables()
+        if not city_pairs:
+            city_pairs = get_harvested_cities()
+        if not city_pairs:
+            parser.error("no harvested cities to chart")
+        if args.output_dir:
+            file_names = export_dashboards(city_pairs, args.output_dir)
+            print(f"\nWrote {len(file_names)} dashboards to {args.output_dir}\n")
+        else:
+            show_dashboard(city_pairs)
+        quit()
+
+    if args.command in ("aggregate", "export", "trend"):
+        city_filter = args.city.lower() if args.city else None
+        state_filter = args.state.lower() if args.state else None
+        create_tables()
+        if args.command == "aggregate" and args.statistics:
+            if args.format != "json":
+                parser.error("--statistics is only available as JSON")
+            if args.as_of:
+                parser.error("--statistics cannot be combined with --as-of")
+            write_records(compute_price_level_statistics(args.provider, city_filter, state_filter), "json")
+        elif args.command == "aggregate" and args.as_of:
+            try:
+                as_of = parse_timestamp(args.as_of)
+            except ValueError:
+                parser.error(f"invalid --as-of date: {args.as_of}")
+            write_records(aggregate_as_of(args.provider, args.metric, as_of, city_filter, state_filter), args.format)
+        elif args.command == "trend" and args.business:
+            write_records(get_business_history(args.provider, args.business), args.format)
+        elif args.command == "trend":
+            if city_filter is None or state_filter is None:
+                parser.error("trend needs --city and --state, or --business")
+            write_records(compute_price_level_trend(args.provider, args.metric, city_filter, state_filter), args.format)
+        elif args.command == "aggregate":
+            write_records(aggregate_by_price_level(args.provider, args.metric, city_filter, state_filter), args.format)
+        else:
+            if args.source == "matches":
+                records = get_matched_businesses(city_filter, state_filter)
+            else:
+                records = export_businesses(args.source, city_filter, state_filter)
+            if args.output:
+                with open(args.output, 'w', newline='') as output_file:
+                    write_records(records, args.format, output_file)
+            else:
+                write_records(records, args.format)
+        quit()
+
+    initialize_cache_store()
+    atexit.register(print_cache_stats)
+
+    if args.command == "harvest":
+        city_term = args.city.lower()
+        state_term = args.state.lower()
+        if state_term not in states:
+            parser.error(f"invalid state name: {args.state}")
+        try:
+            if args.profile:
+                summary = profile_call(args.profile, harvest_city_summary, city_term, state_term)
+            else:
+                summary = harvest_city_summary(city_term, state_term)
+            write_records(summary, "json")
+        except ApiRequestError as error:
+            print(f"\n[Error] {error}\n", file=sys.stderr)
+            sys.exit(1)
+        quit()
+
+    if args.command == "refresh":
+        CACHE_REFRESH = True
+        create_tables()
+        while True:
+            pending = city_pairs or get_stale_cities(args.older_than)
+            print(f"\nRefreshing {len(pending)} cities.\n")
+            summaries, failed = refresh_cities(pending, args.workers)
+            print(f"\nRefresh finished: {len(summaries)} refreshed, {failed} failed.\n")
+            if args.every is None:
+                break
+            time.sleep(args.every * 60 * 60)
+        quit()
+
+    if args.batch:
+        run_batch_harvest(args.batch, args.workers, args.progress_file)
+        quit()
+
+    create_tables()
+
+    while True:
 
         city_term = input("\nEnter U.S. city name WITHOUT state (e.g. 'Ann Arbor'), or 'exit program' to quit: ")
 
@@ -361,91 +5122,32 @@ if __name__ == "__main__":
             elif state_term.lower() in states:
                 state_term = state_term.lower()
                 search_term = f"{city_term}, {state_term}"
-                language = "en"
-                place_type = "restaurant"
-                google_data = make_google_request_using_cache(google_baseurl, search_term)
+                try:
+                    if args.profile:
+                        google_data, yelp_data = profile_call(args.profile, fetch_city_data, search_term)
+                        args.profile = None
+                    else:
+                        google_data, yelp_data = fetch_city_data(search_term)
+                except ApiRequestError as error:
+                    print(f"\n[Error] {error}\n")
+                    continue
                 print(google_data)
                 print("\n\n\n")
                 print(len(google_data["results"])) 
                 print("\n\n\n")
-                yelp_data = make_yelp_request_using_cache(yelp_baseurl, search_term)
                 print(yelp_data)
                 print("\n\n\n")
                 print(len(yelp_data["businesses"])) 
                 print("\n\n\n")
 
-                google_data_for_ratings_info = []
-                google_data_for_price_info = []
-
-                yelp_data_for_ratings_info = []
-                yelp_data_for_price_info = []
-
-
-                for result in google_data["results"]:
-                    place_id = result["place_id"]
-                    name = result["name"]
-                    formatted_address = result["formatted_address"]
-                    rating = result["rating"]
-                    user_ratings_total = result["user_ratings_total"]
-                    try:
-                        price_level = result["price_level"]
-                    except:
-                        price_level = "N/A"
-                    google_data_for_ratings_info.append([place_id, name, formatted_address, rating, user_ratings_total])
-                    google_data_for_price_info.append([place_id, name, formatted_address, price_level])
-    
-
-                for business in yelp_data["businesses"]:
-                    id_string = business["id"]
-                    alias = business["alias"]
-                    name = business["name"]
-                    try:
-                        display_address = str(business["location"]["display_address"][0]) + " " + str(business["location"]["display_address"][1])
-                    except:
-                        display_address = "N/A"
-                    try:
-                        rating = business["rating"]
-                    except:
-                        rating = "N/A"
-                    try:
-                        review_count = business["review_count"]
-                    except:
-                        review_count = "N/A"
-                    try:
-                        phone = business["phone"]
-                    except:
-                        phone = "N/A"
-                    
-                    try:
-                        price = business["price"]
-                    except:
-                        price = "N/A"
-                    yelp_data_for_ratings_info.append([id_string, alias, name, display_address, rating, review_count])
-                    yelp_data_for_price_info.append([id_string, alias, name, display_address, phone, price])
-
-
-                for result in google_data_for_ratings_info:
-                    print("\n Inserting " + result[1] + " ...\n")
-                    cur.execute(insert_google_rating_info, result)
-                
-                for result in google_data_for_price_info:
-                    print("\n Inserting " + result[1] + " ...\n")
-                    cur.execute(insert_google_price_info, result)
-
-                for business in yelp_data_for_ratings_info:
-                    print("\n Inserting " + business[2] + " ...\n")
-                    cur.execute(insert_yelp_rating_info, business)
-
-                for business in yelp_data_for_price_info:
-                    print("\n Inserting " + business[2] + " ...\n")
-                    cur.execute(insert_yelp_price_info, business)
-                
-                conn.commit()
+                ingest_city_data(google_data, yelp_data, city_term, state_term)
+                if MATCH_AFTER_INGEST:
+                    match_city_businesses(city_term, state_term)
 
 
                 while True:
                     
-                    google_or_yelp_user_input = input("Enter 'GOOGLE' or 'YELP' to select graph data source, 'BACK' to search another city, or 'EXIT PROGRAM' to quit: ")
+                    google_or_yelp_user_input = input("Enter 'GOOGLE' or 'YELP' to select graph data source, 'DASHBOARD' to see every graph at once, 'COMPARE' to chart restaurants found on both, 'BACK' to search another city, or 'EXIT PROGRAM' to quit: ")
 
                     if google_or_yelp_user_input.lower() == "exit program":
                         quit()
@@ -453,6 +5155,16 @@ if __name__ == "__main__":
                     if google_or_yelp_user_input.lower() == "back":
                         break
 
+                    if google_or_yelp_user_input.lower() == "dashboard":
+                        show_dashboard([(city_term, state_term)])
+                        print("\n\nSee dashboard in web browser.\n\n")
+                        continue
+
+                    if google_or_yelp_user_input.lower() == "compare":
+                        matched_count = show_cross_provider_chart(search_term, city_term, state_term)
+                        print(f"\n\n{matched_count} restaurants found on both Google and Yelp. See graph in web browser.\n\n")
+                        continue
+
                     if google_or_yelp_user_input.lower() != "exit program":
                         if google_or_yelp_user_input.lower() != "back":
                             if google_or_yelp_user_input.lower() != "google":
@@ -468,471 +5180,17 @@ if __name__ == "__main__":
                         elif google_or_yelp_user_input.lower() == "yelp":
                             print("\nYelp selected as graph data source.\n")
                             
-                        graph_display_user_input = input("Enter 'AVERAGE RATING' or 'AVERAGE NUMBER OF RATINGS' to see averages by price level, 'BACK' to search another city, or 'EXIT PROGRAM' to quit: ")
-
-                        if graph_display_user_input.lower() == "average rating":
-                            
-                            if google_or_yelp_user_input.lower() == "google":
-
-                                q1 = '''
-                                SELECT *
-                                FROM Google_Price_Info as g_price_i
-                                JOIN Google_Rating_Info as g_rating_i
-                                ON g_price_i.place_id = g_rating_i.place_id
-                                '''
-
-                                cur.execute(q1)
-                                conn.commit()
-                                google_user_rating_result = cur.fetchall()
-
-                                price_levels = ['0', '1', '2', '3', '4']
-                                average_user_ratings_by_price_level = []
-                                item_count_price_level_0 = 0
-                                item_count_price_level_1 = 0
-                                item_count_price_level_2 = 0
-                                item_count_price_level_3 = 0
-                                item_count_price_level_4 = 0
-                                user_ratings_sum_price_level_0 = 0
-                                user_ratings_sum_price_level_1 = 0
-                                user_ratings_sum_price_level_2 = 0
-                                user_ratings_sum_price_level_3 = 0
-                                user_ratings_sum_price_level_4 = 0
-                                price_levels_0 = []
-                                price_levels_1 = []
-                                price_levels_2 = []
-                                price_levels_3 = []
-                                price_levels_4 = []
-
-
-                                row_values_list = []
-                                for row in google_user_rating_result:
-                                    values_dict = {"price_level": row[3], "user_ratings_total": row[-1], "rating": row[-2]}
-                                    row_values_list.append(values_dict)
-                                
-                                    
-                                for values_dict in row_values_list:
-                                    if values_dict["price_level"] == price_levels[0]:
-                                        price_levels_0.append(values_dict)
-                                    if values_dict["price_level"] == price_levels[1]:
-                                        price_levels_1.append(values_dict)
-                                    if values_dict["price_level"] == price_levels[2]:
-                                        price_levels_2.append(values_dict)
-                                    if values_dict["price_level"] == price_levels[3]:
-                                        price_levels_3.append(values_dict)
-                                    if values_dict["price_level"] == price_levels[4]:
-                                        price_levels_4.append(values_dict)
-
-
-                                if len(price_levels_0) > 0:
-
-                                    for dict_item in price_levels_0:
-                                        item_count_price_level_0 += 1
-                                        user_ratings_sum_price_level_0 += float(dict_item["rating"])
-                                    
-                                        try:
-                                            user_ratings_average_for_price_level_0 = float(user_ratings_sum_price_level_0 / item_count_price_level_0)
-                                        except ZeroDivisionError:
-                                            user_ratings_average_for_price_level_0 = 0
-
-                                    average_user_ratings_by_price_level.append(user_ratings_average_for_price_level_0)
-                                
-                                else:
-                                    average_user_ratings_by_price_level.append(0)
-                            
-
-                                for dict_item in price_levels_1:
-                                    item_count_price_level_1 += 1
-                                    user_ratings_sum_price_level_1 += float(dict_item["rating"])
-
-                                    try:
-                                        user_ratings_average_for_price_level_1 = float(user_ratings_sum_price_level_1 / item_count_price_level_1)
-                                    except ZeroDivisionError:
-                                        user_ratings_average_for_price_level_1 = 0
-
-                                average_user_ratings_by_price_level.append(user_ratings_average_for_price_level_1)
-
-
-                                for dict_item in price_levels_2:
-                                    item_count_price_level_2 += 1
-                                    user_ratings_sum_price_level_2 += float(dict_item["rating"])
-
-                                    try:
-                                        user_ratings_average_for_price_level_2 = float(user_ratings_sum_price_level_2 / item_count_price_level_2)
-                                    except ZeroDivisionError:
-                                        user_ratings_average_for_price_level_2 = 0
-
-                                average_user_ratings_by_price_level.append(user_ratings_average_for_price_level_2)
-
-
-                                for dict_item in price_levels_3:
-                                    item_count_price_level_3 += 1
-                                    user_ratings_sum_price_level_3 += float(dict_item["rating"])
-
-                                    try:
-                                        user_ratings_average_for_price_level_3 = float(user_ratings_sum_price_level_3 / item_count_price_level_3)
-                                    except ZeroDivisionError:
-                                        user_ratings_average_for_price_level_3 = 0
-
-                                average_user_ratings_by_price_level.append(user_ratings_average_for_price_level_3)
-
-
-                                for dict_item in price_levels_4:
-                                    item_count_price_level_4 += 1
-                                    user_ratings_sum_price_level_4 += float(dict_item["rating"])
-
-                                    try:
-                                        user_ratings_average_for_price_level_4 = float(user_ratings_sum_price_level_4 / item_count_price_level_4)
-                                    except ZeroDivisionError:
-                                        user_ratings_average_for_price_level_4 = 0
-
-                                average_user_ratings_by_price_level.append(user_ratings_average_for_price_level_4)
-
-
-                                bar_data = go.Bar(x=price_levels, y=average_user_ratings_by_price_level)
-                                basic_layout = go.Layout(title=f"Average Google Ratings by Price Level for Restaurants in {search_term}", 
-                                                            xaxis_title = "Price Level from Least to Most Expensive (0 [free] to 4)",
-                                                            yaxis_title = "Average Google Rating (1 = lowest, 5 = highest)")
-                                fig = go.Figure(data=bar_data, layout=basic_layout)
-                                fig.show()
-                                print("\n\nSee graph in web browser.\n\n")
-                                continue
-
-
-
-                            elif google_or_yelp_user_input.lower() == "yelp":
-
-                                q2 = '''
-                                SELECT *
-                                FROM Yelp_Price_Info as y_price_i
-                                JOIN Yelp_Rating_Info as y_rating_i
-                                ON y_price_i.id = y_rating_i.id
-                                '''
-
-                                cur.execute(q2)
-                                conn.commit()
-                                yelp_user_rating_result = cur.fetchall()
-
-                                price_levels = ['$', '$$', '$$$', '$$$$']
-                                average_user_ratings_by_price_level = []
-                                item_count_price_level_0 = 0
-                                item_count_price_level_1 = 0
-                                item_count_price_level_2 = 0
-                                item_count_price_level_3 = 0
-                                user_ratings_sum_price_level_0 = 0
-                                user_ratings_sum_price_level_1 = 0
-                                user_ratings_sum_price_level_2 = 0
-                                user_ratings_sum_price_level_3 = 0
-                                price_levels_0 = []
-                                price_levels_1 = []
-                                price_levels_2 = []
-                                price_levels_3 = []
-
-                                row_values_list = []
-                                for row in yelp_user_rating_result:
-                                    values_dict = {"price": row[5], "review_count": row[-1], "rating": row[-2]}
-                                    row_values_list.append(values_dict)
-                                
-                                    
-                                for values_dict in row_values_list:
-                                    if values_dict["price"] == price_levels[0]:
-                                        price_levels_0.append(values_dict)
-                                    if values_dict["price"] == price_levels[1]:
-                                        price_levels_1.append(values_dict)
-                                    if values_dict["price"] == price_levels[2]:
-                                        price_levels_2.append(values_dict)
-                                    if values_dict["price"] == price_levels[3]:
-                                        price_levels_3.append(values_dict)
-
-
-                                for dict_item in price_levels_0:
-                                    item_count_price_level_0 += 1
-                                    user_ratings_sum_price_level_0 += float(dict_item["rating"])
-                                    
-                                    try:
-                                        user_ratings_average_for_price_level_0 = float(user_ratings_sum_price_level_0 / item_count_price_level_0)
-                                    except ZeroDivisionError:
-                                        user_ratings_average_for_price_level_0 = 0
-
-                                average_user_ratings_by_price_level.append(user_ratings_average_for_price_level_0)
-                                
-                            
-                                for dict_item in price_levels_1:
-                                    item_count_price_level_1 += 1
-                                    user_ratings_sum_price_level_1 += float(dict_item["rating"])
-
-                                    try:
-                                        user_ratings_average_for_price_level_1 = float(user_ratings_sum_price_level_1 / item_count_price_level_1)
-                                    except ZeroDivisionError:
-                                        user_ratings_average_for_price_level_1 = 0
-
-                                average_user_ratings_by_price_level.append(user_ratings_average_for_price_level_1)
-
-
-                                for dict_item in price_levels_2:
-                                    item_count_price_level_2 += 1
-                                    user_ratings_sum_price_level_2 += float(dict_item["rating"])
-
-                                    try:
-                                        user_ratings_average_for_price_level_2 = float(user_ratings_sum_price_level_2 / item_count_price_level_2)
-                                    except ZeroDivisionError:
-                                        user_ratings_average_for_price_level_2 = 0
-
-                                average_user_ratings_by_price_level.append(user_ratings_average_for_price_level_2)
-
-
-                                for dict_item in price_levels_3:
-                                    item_count_price_level_3 += 1
-                                    user_ratings_sum_price_level_3 += float(dict_item["rating"])
-
-                                    try:
-                                        user_ratings_average_for_price_level_3 = float(user_ratings_sum_price_level_3 / item_count_price_level_3)
-                                    except ZeroDivisionError:
-                                        user_ratings_average_for_price_level_3 = 0
-
-                                average_user_ratings_by_price_level.append(user_ratings_average_for_price_level_3)
-
-
-                                bar_data = go.Bar(x=price_levels, y=average_user_ratings_by_price_level)
-                                basic_layout = go.Layout(title=f"Average Yelp Ratings by Price Level for Restaurants in {search_term}", 
-                                                            xaxis_title = "Price Level from Least to Most Expensive ($ to $$$$)",
-                                                            yaxis_title = "Average Yelp Rating (1 = lowest, 5 = highest)")
-                                fig = go.Figure(data=bar_data, layout=basic_layout)
-                                fig.show()
-                                print("\n\nSee graph in web browser.\n\n")
-                                continue
-
-                            
-                        elif graph_display_user_input.lower() == "average number of ratings":
-                                
-                            if google_or_yelp_user_input.lower() == "google":
-
-                                q3 = '''
-                                SELECT *
-                                FROM Google_Price_Info as g_price_i
-                                JOIN Google_Rating_Info as g_rating_i
-                                ON g_price_i.place_id = g_rating_i.place_id
-                                '''
-
-                                cur.execute(q3)
-                                conn.commit()
-                                google_number_rating_result = cur.fetchall()
-                            
-                                price_levels = ['0', '1', '2', '3', '4']
-                                average_number_ratings_by_price_level = []
-                                item_count_price_level_0 = 0
-                                item_count_price_level_1 = 0
-                                item_count_price_level_2 = 0
-                                item_count_price_level_3 = 0
-                                item_count_price_level_4 = 0
-                                number_of_ratings_sum_price_level_0 = 0
-                                number_of_ratings_sum_price_level_1 = 0
-                                number_of_ratings_sum_price_level_2 = 0
-                                number_of_ratings_sum_price_level_3 = 0
-                                number_of_ratings_sum_price_level_4 = 0
-                                price_levels_0 = []
-                                price_levels_1 = []
-                                price_levels_2 = []
-                                price_levels_3 = []
-                                price_levels_4 = []
-
-
-                                row_values_list = []
-                                for row in google_number_rating_result:
-                                    values_dict = {"price_level": row[3], "user_ratings_total": row[-1], "rating": row[-2]}
-                                    row_values_list.append(values_dict)
-                                
-                                    
-                                for values_dict in row_values_list:
-                                    if values_dict["price_level"] == price_levels[0]:
-                                        price_levels_0.append(values_dict)
-                                    if values_dict["price_level"] == price_levels[1]:
-                                        price_levels_1.append(values_dict)
-                                    if values_dict["price_level"] == price_levels[2]:
-                                        price_levels_2.append(values_dict)
-                                    if values_dict["price_level"] == price_levels[3]:
-                                        price_levels_3.append(values_dict)
-                                    if values_dict["price_level"] == price_levels[4]:
-                                        price_levels_4.append(values_dict)
-
-
-                                if len(price_levels_0) > 0:
-
-                                    for dict_item in price_levels_0:
-                                        item_count_price_level_0 += 1
-                                        number_of_ratings_sum_price_level_0 += int(dict_item["user_ratings_total"])
-                                    
-                                        try:
-                                            number_of_ratings_average_for_price_level_0 = float(number_of_ratings_sum_price_level_0 / item_count_price_level_0)
-                                        except ZeroDivisionError:
-                                            number_of_ratings_average_for_price_level_0 = 0
-
-                                    average_number_ratings_by_price_level.append(number_of_ratings_average_for_price_level_0)
-                                
-                                else:
-                                    average_number_ratings_by_price_level.append(0)
-                            
+                        graph_display_user_input = input("Enter 'AVERAGE RATING' or 'AVERAGE NUMBER OF RATINGS' to see averages by price level, 'STATISTICS' for a summary table, 'BACK' to search another city, or 'EXIT PROGRAM' to quit: ")
 
-                                for dict_item in price_levels_1:
-                                    item_count_price_level_1 += 1
-                                    number_of_ratings_sum_price_level_1 += int(dict_item["user_ratings_total"])
-
-                                    try:
-                                        number_of_ratings_average_for_price_level_1 = float(number_of_ratings_sum_price_level_1 / item_count_price_level_1)
-                                    except ZeroDivisionError:
-                                        number_of_ratings_average_for_price_level_1 = 0
-
-                                average_number_ratings_by_price_level.append(number_of_ratings_average_for_price_level_1)
-
-
-                                for dict_item in price_levels_2:
-                                    item_count_price_level_2 += 1
-                                    number_of_ratings_sum_price_level_2 += int(dict_item["user_ratings_total"])
-                                    
-                                    try:
-                                        number_of_ratings_average_for_price_level_2 = float(number_of_ratings_sum_price_level_2 / item_count_price_level_2)
-                                    except ZeroDivisionError:
-                                        number_of_ratings_average_for_price_level_2 = 0
-
-                                average_number_ratings_by_price_level.append(number_of_ratings_average_for_price_level_2)
-
-
-                                for dict_item in price_levels_3:
-                                    item_count_price_level_3 += 1
-                                    number_of_ratings_sum_price_level_3 += int(dict_item["user_ratings_total"])
-                                    
-                                    try:
-                                        number_of_ratings_average_for_price_level_3 = float(number_of_ratings_sum_price_level_3 / item_count_price_level_3)
-                                    except ZeroDivisionError:
-                                        number_of_ratings_average_for_price_level_3 = 0
-
-                                average_number_ratings_by_price_level.append(number_of_ratings_average_for_price_level_3)
-
-
-                                for dict_item in price_levels_4:
-                                    item_count_price_level_4 += 1
-                                    number_of_ratings_sum_price_level_4 += int(dict_item["user_ratings_total"])
-                                    
-                                    try:
-                                        number_of_ratings_average_for_price_level_4 = float(number_of_ratings_sum_price_level_4 / item_count_price_level_4)
-                                    except ZeroDivisionError:
-                                        number_of_ratings_average_for_price_level_4 = 0
-                                        
-                                average_number_ratings_by_price_level.append(number_of_ratings_average_for_price_level_4)
-
-                                bar_data = go.Bar(x=price_levels, y=average_number_ratings_by_price_level)
-                                basic_layout = go.Layout(title=f"Average Number of Google User Ratings by Price Level for Restaurants in {search_term}", 
-                                                            xaxis_title = "Price Level from Least to Most Expensive (0 [free] to 4)",
-                                                            yaxis_title = "Average Number of Google User Ratings")
-                                fig = go.Figure(data=bar_data, layout=basic_layout)
-                                fig.show()
-                                print("\nSee graph in web browser.\n")
-                                continue
-
-
-                            elif google_or_yelp_user_input.lower() == "yelp":
-
-                                q4 = '''
-                                SELECT *
-                                FROM Yelp_Price_Info as y_price_i
-                                JOIN Yelp_Rating_Info as y_rating_i
-                                ON y_price_i.id = y_rating_i.id
-                                '''
-
-                                cur.execute(q4)
-                                conn.commit()
-                                yelp_number_rating_result = cur.fetchall()
-
-
-                                price_levels = ['$', '$$', '$$$', '$$$$']
-                                average_number_ratings_by_price_level = []
-                                item_count_price_level_0 = 0
-                                item_count_price_level_1 = 0
-                                item_count_price_level_2 = 0
-                                item_count_price_level_3 = 0
-                                number_ratings_sum_price_level_0 = 0
-                                number_ratings_sum_price_level_1 = 0
-                                number_ratings_sum_price_level_2 = 0
-                                number_ratings_sum_price_level_3 = 0
-                                price_levels_0 = []
-                                price_levels_1 = []
-                                price_levels_2 = []
-                                price_levels_3 = []
-
-
-                                row_values_list = []
-                                for row in yelp_number_rating_result:
-                                    values_dict = {"price": row[5], "review_count": row[-1], "rating": row[-2]}
-                                    row_values_list.append(values_dict)
-                                
-                                    
-                                for values_dict in row_values_list:
-                                    if values_dict["price"] == price_levels[0]:
-                                        price_levels_0.append(values_dict)
-                                    if values_dict["price"] == price_levels[1]:
-                                        price_levels_1.append(values_dict)
-                                    if values_dict["price"] == price_levels[2]:
-                                        price_levels_2.append(values_dict)
-                                    if values_dict["price"] == price_levels[3]:
-                                        price_levels_3.append(values_dict)
-
-
-                                for dict_item in price_levels_0:
-                                    item_count_price_level_0 += 1
-                                    number_ratings_sum_price_level_0 += float(dict_item["review_count"])
-                                    
-                                    try:
-                                        number_ratings_average_for_price_level_0 = float(number_ratings_sum_price_level_0 / item_count_price_level_0)
-                                    except ZeroDivisionError:
-                                        number_ratings_average_for_price_level_0 = 0
-
-                                average_number_ratings_by_price_level.append(number_ratings_average_for_price_level_0)
-                                
-                            
-                                for dict_item in price_levels_1:
-                                    item_count_price_level_1 += 1
-                                    number_ratings_sum_price_level_1 += float(dict_item["review_count"])
-                                    
-                                    try:
-                                        number_ratings_average_for_price_level_1 = float(number_ratings_sum_price_level_1 / item_count_price_level_1)
-                                    except ZeroDivisionError:
-                                        number_ratings_average_for_price_level_1 = 0
-
-                                average_number_ratings_by_price_level.append(number_ratings_average_for_price_level_1)
-
-
-                                for dict_item in price_levels_2:
-                                    item_count_price_level_2 += 1
-                                    number_ratings_sum_price_level_2 += float(dict_item["review_count"])
-                                    
-                                    try:
-                                        number_ratings_average_for_price_level_2 = float(number_ratings_sum_price_level_2 / item_count_price_level_2)
-                                    except ZeroDivisionError:
-                                        number_ratings_average_for_price_level_2 = 0
-
-                                average_number_ratings_by_price_level.append(number_ratings_average_for_price_level_2)
-
-
-                                for dict_item in price_levels_3:
-                                    item_count_price_level_3 += 1
-                                    number_ratings_sum_price_level_3 += float(dict_item["review_count"])
-                                    
-                                    try:
-                                        number_ratings_average_for_price_level_3 = float(number_ratings_sum_price_level_3 / item_count_price_level_3)
-                                    except ZeroDivisionError:
-                                        number_ratings_average_for_price_level_3 = 0
-
-                                average_number_ratings_by_price_level.append(number_ratings_average_for_price_level_3)
-
-
-                                bar_data = go.Bar(x=price_levels, y=average_number_ratings_by_price_level)
-                                basic_layout = go.Layout(title=f"Average Number of Yelp User Ratings by Price Level for Restaurants in {search_term}", 
-                                                            xaxis_title = "Price Level from Least to Most Expensive ($ to $$$$)",
-                                                            yaxis_title = "Average Number of Yelp User Ratings")
-                                fig = go.Figure(data=bar_data, layout=basic_layout)
-                                fig.show()
-                                print("\n\nSee graph in web browser.\n\n")
-                                continue
+                        if graph_display_user_input.lower() in CHART_METRICS:
+                            metric = CHART_METRICS[graph_display_user_input.lower()]
+                            show_price_level_chart(google_or_yelp_user_input.lower(), metric, search_term, city_term, state_term)
+                            print("\n\nSee graph in web browser.\n\n")
+                            continue
 
+                        elif graph_display_user_input.lower() == "statistics":
+                            print_price_level_statistics(google_or_yelp_user_input.lower(), city_term, state_term)
+                            continue
 
                         elif graph_display_user_input.lower() == "back":
                             break